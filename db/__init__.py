@@ -1,38 +1,141 @@
 import aiomysql
+import asyncio
+import logging
 import os
+import time
+import traceback
+from contextlib import asynccontextmanager
 from config import DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PASS
+from config import DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_POOL_RECYCLE, DB_POOL_ACQUIRE_TIMEOUT, DB_POOL_PING_IDLE
+from config import DB_LEASE_WARN_MS
+from utils.metrics import register_metrics
 
 
 ## For connections pool..
 _pool = None
+_pool_lock = asyncio.Lock()
+
+## Connections handed out by acquire(): id(conn) -> (acquired at, acquiring stack or None)
+_leases = {}
+_pool_stats = {
+    "acquired": 0, "waiting": 0, "timeouts": 0, "reconnects": 0, "slow_leases": 0,
+    "acquire_ms_total": 0.0, "acquire_ms_max": 0.0,
+}
 
 
 async def get_pool():
     global _pool
     if _pool is None:
-        _pool = await aiomysql.create_pool(
-            host=DB_HOST,
-            port=int(DB_PORT),
-            user=DB_USER,
-            password=DB_PASS,
-            db=DB_NAME,
-            autocommit=True,
-            minsize=1,
-            maxsize=5,
-            charset="utf8mb4"
-        )
+        async with _pool_lock:
+            if _pool is None:
+                _pool = await aiomysql.create_pool(
+                    host=DB_HOST,
+                    port=int(DB_PORT),
+                    user=DB_USER,
+                    password=DB_PASS,
+                    db=DB_NAME,
+                    autocommit=True,
+                    minsize=DB_POOL_MIN_SIZE,
+                    maxsize=DB_POOL_MAX_SIZE,
+                    pool_recycle=DB_POOL_RECYCLE,
+                    charset="utf8mb4"
+                )
     return _pool
 
 
-async def get_conn():
+async def close_pool():
+    global _pool
+    pool, _pool = _pool, None
+    if pool is not None:
+        pool.close()
+        await pool.wait_closed()
+
+
+async def _checked_out(pool, timeout):
+    """
+    Connection from pool; one idle longer than DB_POOL_PING_IDLE s is pinged and replaced if dead.
+    Waiting and ping are limited by `timeout` separately; a connection taken from the pool is closed
+    and given back if the ping fails, times out or is cancelled, so it never leaks.
+    """
+    conn = await asyncio.wait_for(pool.acquire(), timeout)
+    if DB_POOL_PING_IDLE > 0 and asyncio.get_running_loop().time() - conn.last_usage > DB_POOL_PING_IDLE:
+        try:
+            await asyncio.wait_for(conn.ping(reconnect=False), timeout)
+        except BaseException as e:
+            conn.close()
+            pool.release(conn)
+            if not isinstance(e, Exception):
+                raise
+            _pool_stats["reconnects"] += 1
+            logging.warning("DB pool: dropping dead connection", exc_info=True)
+            conn = await asyncio.wait_for(pool.acquire(), timeout)
+    return conn
+
+
+@asynccontextmanager
+async def acquire():
+    """
+    Connection leased from the pool, always given back on exit:
+
+        async with acquire() as conn:
+            ...
+
+    Waits for a free connection at most DB_POOL_ACQUIRE_TIMEOUT s (raises asyncio.TimeoutError).
+    Leases held longer than DB_LEASE_WARN_MS ms are logged with the stack that acquired them.
+    """
     pool = await get_pool()
-    return await pool.acquire()
+    t0 = time.monotonic()
+    _pool_stats["waiting"] += 1
+    try:
+        conn = await _checked_out(pool, DB_POOL_ACQUIRE_TIMEOUT or None)
+    except asyncio.TimeoutError:
+        _pool_stats["timeouts"] += 1
+        logging.error("DB pool: no free connection in %s s (%s in use)", DB_POOL_ACQUIRE_TIMEOUT, pool.size - pool.freesize)
+        raise
+    finally:
+        _pool_stats["waiting"] -= 1
+    acquired_at = time.monotonic()
+    wait_ms = (acquired_at - t0) * 1000
+    _pool_stats["acquired"] += 1
+    _pool_stats["acquire_ms_total"] += wait_ms
+    _pool_stats["acquire_ms_max"] = max(_pool_stats["acquire_ms_max"], wait_ms)
+    ## Stack is only taken when slow leases are reported
+    _leases[id(conn)] = (acquired_at, traceback.extract_stack(limit=12)[:-2] if DB_LEASE_WARN_MS > 0 else None)
+    try:
+        yield conn
+    finally:
+        acquired_at, stack = _leases.pop(id(conn))
+        held_ms = (time.monotonic() - acquired_at) * 1000
+        if DB_LEASE_WARN_MS > 0 and held_ms > DB_LEASE_WARN_MS:
+            _pool_stats["slow_leases"] += 1
+            logging.warning(
+                "DB pool: connection held %.0f ms, acquired at:\n%s", held_ms, "".join(traceback.format_list(stack))
+            )
+        if conn.get_transaction_status():
+            ## Left in a transaction (error in the middle) - don't give it to the next user as is
+            conn.close()
+        pool.release(conn)
+
+
+def db_pool_stats():
+    now = time.monotonic()
+    stats = dict(_pool_stats)
+    acquired = stats.pop("acquire_ms_total")
+    stats["acquire_ms_avg"] = round(acquired / stats["acquired"], 2) if stats["acquired"] else 0.0
+    stats["acquire_ms_max"] = round(stats["acquire_ms_max"], 2)
+    stats["in_use"] = len(_leases)
+    stats["oldest_lease_ms"] = round(max(((now - t) * 1000 for t, _ in _leases.values()), default=0.0))
+    if _pool is not None:
+        stats.update(size=_pool.size, free=_pool.freesize, maxsize=_pool.maxsize)
+    return stats
+
+
+register_metrics("db_pool", db_pool_stats)
 
 
 ## asyncly perform any request w/o fetch
 async def execute(query, params=None):
-    pool = await get_pool()
-    async with pool.acquire() as conn:
+    async with acquire() as conn:
         async with conn.cursor() as cur:
             await cur.execute(query, params)
             return cur.lastrowid
@@ -40,8 +143,7 @@ async def execute(query, params=None):
 
 ## Asyncly get one record
 async def fetchone(query, params=None):
-    pool = await get_pool()
-    async with pool.acquire() as conn:
+    async with acquire() as conn:
         async with conn.cursor(aiomysql.DictCursor) as cur:
             await cur.execute(query, params)
             return await cur.fetchone()
@@ -49,8 +151,7 @@ async def fetchone(query, params=None):
 
 ## asyncly get all records
 async def fetchall(query, params=None):
-    pool = await get_pool()
-    async with pool.acquire() as conn:
+    async with acquire() as conn:
         async with conn.cursor(aiomysql.DictCursor) as cur:
             await cur.execute(query, params)
             return await cur.fetchall()
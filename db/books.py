@@ -1,34 +1,121 @@
+import asyncio
+import logging
+from array import array
+
 from db import fetchone, fetchall, execute
+from db.writer import enqueue, register_batch_writer
+
+
+## In-memory books catalog: normalized name/synonym -> book dict.
+## Loaded once at startup and reloaded by `watch_books_catalog()` when `books` changes (rootster edits this table).
+_catalog = {}
+_catalog_checksum = None
+_catalog_lock = asyncio.Lock()
+
+## `hits` is excluded on purpose - it changes on every request and must not trigger reloads.
+_CHECKSUM_SQL = """
+    SELECT COUNT(*) AS cnt,
+           BIT_XOR(CRC32(CONCAT_WS('#', id, bookname_ru, bookname_en, category,
+                                   IFNULL(synonyms_ru, ''), IFNULL(synonyms_en, ''),
+                                   max_chapter, max_verses))) AS crc
+    FROM books
+"""
+
 
+def normalize_book_name(name):
+    """Lowercase, trim and collapse inner spaces."""
+    return " ".join((name or "").lower().split())
 
-async def find_book_entry(book, conn):
+
+def _parse_max_verses(max_verses):
     """
-    Search book name through bookname_ru, bookname_en and all synonyms (ru, en).
-    Return string from DB or None.
+    Convert `max_verses` string (ex. '31,25,24') to compact array of unsigned shorts.
+    Replaces the old eval() of the DB value.
+    """
+    if isinstance(max_verses, array):
+        return max_verses
+    raw = (max_verses or "").strip().strip("[]()")
+    return array("H", (int(v) for v in raw.split(",") if v.strip()))
+
+
+def _build_catalog(rows):
+    catalog = {}
+    for row in rows:
+        book = dict(row)
+        book["max_verses"] = _parse_max_verses(book.get("max_verses"))
+        names = [book.get("bookname_ru"), book.get("bookname_en")]
+        names += (book.get("synonyms_ru") or "").split(",")
+        names += (book.get("synonyms_en") or "").split(",")
+        for name in names:
+            key = normalize_book_name(name)
+            if not key:
+                continue
+            ## First book wins on collisions, same as `LIMIT 1` in the old SQL lookups
+            catalog.setdefault(key, book)
+            ## Synonyms were also matched with spaces removed ("1 моисея" == "1моисея")
+            catalog.setdefault(key.replace(" ", ""), book)
+    return catalog
+
+
+async def _get_books_checksum():
+    row = await fetchone(_CHECKSUM_SQL)
+    if not row:
+        return None
+    return (row.get("cnt"), row.get("crc"))
+
+
+async def load_books_catalog(force=False):
     """
-    sql_exact = """
-        SELECT * FROM books
-        WHERE bookname_ru = %s OR bookname_en = %s
-        LIMIT 1
+    (Re)load books catalog from DB if table content changed.
+    Returns True if catalog was reloaded.
     """
-    async with conn.cursor() as cur:
-        await cur.execute(sql_exact, (book, book))
-        row = await cur.fetchone()
-        if row:
-            return row
-    sql_syn = """
-        SELECT * FROM books
-        WHERE FIND_IN_SET(%s, REPLACE(synonyms_ru, ' ', '')) > 0
-           OR FIND_IN_SET(%s, REPLACE(synonyms_en, ' ', '')) > 0
-        LIMIT 1
+    global _catalog, _catalog_checksum
+    async with _catalog_lock:
+        checksum = await _get_books_checksum()
+        if not force and _catalog and checksum == _catalog_checksum:
+            return False
+        rows = await fetchall("SELECT * FROM books")
+        _catalog = _build_catalog(rows)
+        _catalog_checksum = checksum
+        logging.info("Books catalog loaded: %s books, %s names", len(rows), len(_catalog))
+        return True
+
+
+async def watch_books_catalog(interval=60):
     """
-    book_nospace = book.replace(" ", "")
-    async with conn.cursor() as cur:
-        await cur.execute(sql_syn, (book_nospace, book_nospace))
-        row = await cur.fetchone()
-        if row:
-            return row
-    return None
+    Background task: poll `books` checksum and reload catalog on changes.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await load_books_catalog()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logging.exception("Failed to refresh books catalog")
+
+
+def get_book_from_catalog(book_name):
+    """
+    Sync O(1) lookup of book by RU/EN name or synonym. Returns book dict or None.
+    """
+    key = normalize_book_name(book_name)
+    return _catalog.get(key) or _catalog.get(key.replace(" ", ""))
+
+
+def get_book_by_id(book_id):
+    """
+    Book dict by `books.id` or None (linear over the catalog - for rare lookups like statistics).
+    """
+    return next((book for book in _catalog.values() if book["id"] == book_id), None)
+
+
+async def find_book_entry(book, conn=None):
+    """
+    Search book name through bookname_ru, bookname_en and all synonyms (ru, en).
+    Return book dict from catalog or None. `conn` is kept for backward compatibility and unused.
+    """
+    return await find_book_by_name_or_synonym(book)
 
 
 async def find_book_by_name_or_synonym(book_name):
@@ -36,30 +123,30 @@ async def find_book_by_name_or_synonym(book_name):
     Searches book name by RU/EN name or by synonyms.
     Returns dict with book data or None.
     """
-    ## Find by RU/EN names
-    query = "SELECT * FROM books WHERE bookname_ru = %s OR bookname_en = %s"
-    book = await fetchone(query, (book_name, book_name))
-    if book:
-        return book
-
-    ## Search by synonyms
-    ## Get all books'es synonyms and find thorugh them
-    books = await fetchall("SELECT * FROM books")
-    for b in books:
-        syn_ru = (b.get('synonyms_ru') or '').lower().split(',')
-        syn_en = (b.get('synonyms_en') or '').lower().split(',')
-        syns = [s.strip() for s in syn_ru + syn_en if s.strip()]
-        if book_name.lower() in syns:
-            return b
-    return None
+    if not _catalog:
+        await load_books_catalog()
+    return get_book_from_catalog(book_name)
 
 
+## Queued (write-behind), see db/writer.py
 async def increment_book_hits(book_id):
-    query = "UPDATE books SET hits = hits + 1 WHERE id = %s"
-    await execute(query, (book_id,))
+    await enqueue("book_hits", book_id)
+
+
+async def _write_book_hits(book_ids):
+    ## One UPDATE for the whole batch: hits = hits + CASE id WHEN ... THEN <count> END
+    counts = {}
+    for book_id in book_ids:
+        counts[book_id] = counts.get(book_id, 0) + 1
+    cases = " ".join(["WHEN %s THEN %s"] * len(counts))
+    placeholders = ",".join(["%s"] * len(counts))
+    params = [v for item in counts.items() for v in item] + list(counts)
+    await execute(f"UPDATE books SET hits = hits + CASE id {cases} END WHERE id IN ({placeholders})", params)
+
+
+register_batch_writer("book_hits", _write_book_hits)
 
 
 ## Get all bookx and all their fields
 async def get_all_books():
     return await fetchall("SELECT * FROM books")
-
@@ -0,0 +1,77 @@
+import csv
+import json
+
+import aiomysql
+
+from db import acquire
+from db.responses import decode_response_row
+
+
+## Bulk export with bounded memory: rows are streamed from unbuffered server-side cursors (SSDictCursor)
+## in keyset chunks `id > last_id ORDER BY id LIMIT chunk`. A connection is held for one chunk only,
+## and export can be resumed from the last written id.
+EXPORTS = {
+    "requests": "SELECT r.* FROM requests r WHERE r.id > %s ORDER BY r.id LIMIT %s",
+    "responses": """
+        SELECT s.id, s.request_id, s.section, s.data, s.data_hash, b.codec, b.data AS blob
+        FROM responses s
+        LEFT JOIN response_blobs b ON b.hash = s.data_hash
+        WHERE s.id > %s ORDER BY s.id LIMIT %s
+    """,
+    "tgpayments": "SELECT p.* FROM tgpayments p WHERE p.id > %s ORDER BY p.id LIMIT %s",
+}
+FORMATS = ("jsonl", "csv")
+
+
+async def iter_export(table, after_id=0, chunk_rows=10000, fetch_size=1000):
+    """
+    Async iterator over rows (dicts) of `table` with id > `after_id`, in id order:
+
+        async for row in iter_export("requests", after_id=last_id):
+            ...
+
+    Response texts are decompressed. Not more than `fetch_size` rows are in memory at once.
+    """
+    sql = EXPORTS[table]
+    while True:
+        count = 0
+        async with acquire() as conn:
+            async with conn.cursor(aiomysql.SSDictCursor) as cur:
+                await cur.execute(sql, (after_id, chunk_rows))
+                while True:
+                    rows = await cur.fetchmany(fetch_size)
+                    if not rows:
+                        break
+                    for row in rows:
+                        after_id = row["id"]
+                        count += 1
+                        yield decode_response_row(row) if table == "responses" else row
+        if count < chunk_rows:
+            return
+
+
+async def export(table, out, fmt="jsonl", after_id=0, header=True, progress=None, **kwargs):
+    """
+    Write rows of `table` to text file object `out` as JSON lines or CSV (with header row unless `header=False`,
+    e.g. when appending to a resumed export). Dict `progress` (if given) always holds "count" and "last_id"
+    of rows already written to `out`, also when export is interrupted.
+    Returns (number of rows, last written id) - pass the id as `after_id` to resume.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown export format: {fmt}")
+    if progress is None:
+        progress = {}
+    progress.update(count=0, last_id=after_id)
+    writer = None
+    async for row in iter_export(table, after_id, **kwargs):
+        if fmt == "jsonl":
+            out.write(json.dumps(row, ensure_ascii=False, default=str) + "\n")
+        else:
+            if writer is None:
+                writer = csv.DictWriter(out, fieldnames=list(row))
+                if header:
+                    writer.writeheader()
+            writer.writerow(row)
+        progress["count"] += 1
+        progress["last_id"] = row["id"]
+    return progress["count"], progress["last_id"]
@@ -1,27 +1,196 @@
-from db import execute, fetchone, fetchall
-import datetime
+import asyncio
+import logging
+
+import aiomysql
+
+from db import execute, fetchall, acquire
+from db.writer import enqueue, register_batch_writer
+from db.users import UPSERT_USER_SQL, touch_user, remember_user
+from config import REQUEST_STALE_SECONDS, REQUEST_STALE_CHECK_INTERVAL
 import json
 
 
 ## Add new request (returns id)
 async def add_request(user_id, user_state, request, status_oai=None, status_tg=None):
-    now = datetime.datetime.now()
     return await execute(
-        "INSERT INTO requests (user_id, user_state, datetime_request, request, status_oai, status_tg) VALUES (%s,%s,%s,%s,%s,%s)",
-        (user_id, json.dumps(user_state), now, request, status_oai, status_tg)
+        "INSERT INTO requests (user_id, user_state, datetime_request, request, status_oai, status_tg) VALUES (%s,%s,NOW(),%s,%s,%s)",
+        (user_id, json.dumps(user_state), request, status_oai, status_tg)
     )
 
 
-## Updete response time and delay
-async def update_request_response(request_id, status_oai, status_tg):
-    now = datetime.datetime.now()
-    req = await fetchone("SELECT datetime_request FROM requests WHERE id=%s", (request_id,))
-    delay = None
-    if req and req["datetime_request"]:
-        delay = (now - req["datetime_request"]).total_seconds()
+## Response columns of `requests`: time and delay are computed in SQL
+_RESPONSE_SET_SQL = """
+    datetime_response = NOW(),
+    delay = TIMESTAMPDIFF(MICROSECOND, datetime_request, NOW(6)) / 1000000,
+    status_oai = %s,
+    status_tg = COALESCE(%s, status_tg),
+    cached_response_id = %s
+"""
+
+
+## Condition for one request row. `requests` is partitioned by `datetime_request` (part of the primary key):
+## with it the lookup touches one partition, by id alone - every partition's index.
+def _request_where(request_id, requested_at=None):
+    if requested_at is None:
+        return "id=%s", (request_id,)
+    return "id=%s AND datetime_request=%s", (request_id, requested_at)
+
+
+## Updete response time and delay (computed in SQL). `cached_response_id` is set when answer was served from response cache.
+## `status_tg=None` keeps current value (delivery is reported separately by outbox).
+async def update_request_response(request_id, status_oai, status_tg, cached_response_id=None, requested_at=None):
+    where, params = _request_where(request_id, requested_at)
     await execute(
-        "UPDATE requests SET datetime_response=%s, delay=%s, status_oai=%s, status_tg=%s WHERE id=%s",
-        (now, delay, status_oai, status_tg, request_id)
+        f"UPDATE requests SET {_RESPONSE_SET_SQL} WHERE {where}",
+        (status_oai, status_tg, cached_response_id, *params)
     )
 
 
+async def begin_request(user_id, firstname, lastname, username, lang, is_bot, user_state, request, price, book_id=None):
+    """
+    Start of request lifecycle, one transaction: upsert user, reserve `price` credits
+    (unlimited accounts with amount -1 are not charged) and insert the request row holding the reservation.
+    Returns {"request_id", "requested_at", "amount"} (amount before reservation) or None if balance is too low -
+    nothing is saved then. `requested_at` (the row's `datetime_request`) goes to later updates of the request.
+    """
+    profile = (firstname, lastname, username, lang, is_bot)
+    async with acquire() as conn:
+        await conn.begin()
+        try:
+            async with conn.cursor(aiomysql.DictCursor) as cur:
+                ## Profile is written only if changed (or unknown), `last_seen` alone goes with flush_last_seen()
+                upserted = not touch_user(user_id, profile)
+                if upserted:
+                    await cur.execute(UPSERT_USER_SQL, (user_id, *profile))
+                ## Row lock: concurrent requests of the same user wait here, so they can't both spend the same credits
+                await cur.execute("SELECT amount, NOW() AS now FROM users WHERE user_id=%s FOR UPDATE", (user_id,))
+                row = await cur.fetchone()
+                if row is None:
+                    ## Cached user was deleted from DB meanwhile
+                    upserted = True
+                    await cur.execute(UPSERT_USER_SQL, (user_id, *profile))
+                    await cur.execute("SELECT amount, NOW() AS now FROM users WHERE user_id=%s FOR UPDATE", (user_id,))
+                    row = await cur.fetchone()
+                amount = row["amount"] or 0
+                requested_at = row["now"]
+                reserved = 0 if amount == -1 else price
+                if amount != -1 and amount < price:
+                    await conn.rollback()
+                    return None
+                if reserved:
+                    await cur.execute("UPDATE users SET amount = amount - %s WHERE user_id=%s", (reserved, user_id))
+                await cur.execute(
+                    """
+                    INSERT INTO requests (user_id, user_state, datetime_request, request, credits, book_id)
+                    VALUES (%s, %s, %s, %s, %s, %s)
+                    """,
+                    (user_id, json.dumps(user_state), requested_at, request, reserved, book_id)
+                )
+                request_id = cur.lastrowid
+            await conn.commit()
+        except BaseException:
+            await conn.rollback()
+            raise
+    if upserted:
+        remember_user(user_id, profile)
+    return {"request_id": request_id, "requested_at": requested_at, "amount": amount}
+
+
+async def finish_request(request_id, status_oai, status_tg=None, cached_response_id=None, price=None, requested_at=None):
+    """
+    End of request lifecycle, one transaction: store response status/time/delay and settle the reservation.
+    Successful request keeps `price` credits (all reserved if None) and refunds the rest; failed request refunds all.
+    Only the first call for a request has effect. `requested_at` (from begin_request) limits lookups to one partition.
+    """
+    where, params = _request_where(request_id, requested_at)
+    async with acquire() as conn:
+        await conn.begin()
+        try:
+            async with conn.cursor(aiomysql.DictCursor) as cur:
+                await cur.execute(
+                    f"SELECT user_id, credits FROM requests WHERE {where} AND datetime_response IS NULL FOR UPDATE",
+                    params
+                )
+                req = await cur.fetchone()
+                if not req:
+                    await conn.rollback()
+                    return
+                reserved = req["credits"] or 0
+                charged = 0 if not status_oai else (reserved if price is None else min(price, reserved))
+                await cur.execute(
+                    f"UPDATE requests SET {_RESPONSE_SET_SQL}, credits = %s WHERE {where}",
+                    (status_oai, status_tg, cached_response_id, charged, *params)
+                )
+                if reserved > charged:
+                    await cur.execute(
+                        "UPDATE users SET amount = amount + %s WHERE user_id=%s AND amount <> -1",
+                        (reserved - charged, req["user_id"])
+                    )
+            await conn.commit()
+        except BaseException:
+            await conn.rollback()
+            raise
+
+
+async def settle_stale_requests(older_than=REQUEST_STALE_SECONDS, lookback_days=7):
+    """
+    Requests never finished (process died between begin_request and finish_request) hold reserved credits.
+    Those started more than `older_than` seconds ago (but within `lookback_days`, so only recent partitions
+    are read) are finished as failed - credits are refunded. Safe to run in several processes at once:
+    finish_request() settles a request only once. Returns number of settled requests.
+    """
+    rows = await fetchall(
+        """
+        SELECT id, datetime_request FROM requests
+        WHERE datetime_response IS NULL
+          AND datetime_request >= NOW() - INTERVAL %s DAY
+          AND datetime_request < NOW() - INTERVAL %s SECOND
+        """,
+        (lookback_days, older_than)
+    )
+    for row in rows:
+        await finish_request(row["id"], status_oai=False, status_tg=False, requested_at=row["datetime_request"])
+    if rows:
+        logging.warning(f"Settled {len(rows)} stale unfinished requests, reserved credits refunded")
+    return len(rows)
+
+
+async def settle_stale_requests_periodically(interval=REQUEST_STALE_CHECK_INTERVAL):
+    """
+    Background task: settle_stale_requests() at startup and then every `interval` seconds.
+    """
+    while True:
+        try:
+            await settle_stale_requests()
+        except Exception:
+            logging.exception("Settling of stale requests failed")
+        await asyncio.sleep(interval)
+
+
+## Report delivery of (a part of) the answer: any failed delivery makes the request failed for Telegram.
+## Queued, see db/writer.py
+async def update_request_delivery(request_id, delivered, requested_at=None):
+    await enqueue("request_delivery", (request_id, requested_at, bool(delivered)))
+
+
+async def _write_request_deliveries(rows):
+    delivered = {}
+    for request_id, requested_at, ok in rows:
+        key = (request_id, requested_at)
+        delivered[key] = delivered.get(key, True) and ok
+    for status_sql, value in (("FALSE", False), ("IFNULL(status_tg, TRUE)", True)):
+        keys = [k for k, ok in delivered.items() if ok == value]
+        ## Rows with known `datetime_request` - pruned to their partitions (ids pick the rows, id is unique)
+        timed = [k for k in keys if k[1] is not None]
+        if timed:
+            await execute(
+                f"UPDATE requests SET status_tg = {status_sql} "
+                f"WHERE id IN ({','.join(['%s'] * len(timed))}) AND datetime_request IN ({','.join(['%s'] * len(timed))})",
+                [i for i, _ in timed] + [t for _, t in timed]
+            )
+        ids = [i for i, t in keys if t is None]
+        if ids:
+            await execute(f"UPDATE requests SET status_tg = {status_sql} WHERE id IN ({','.join(['%s'] * len(ids))})", ids)
+
+
+register_batch_writer("request_delivery", _write_request_deliveries)
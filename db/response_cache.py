@@ -0,0 +1,51 @@
+from db import execute, fetchone
+from db.responses import decode_response_row
+from db.writer import enqueue, register_batch_writer
+
+
+## Get cached response by cache key. Joins `responses` so a hit can be traced back to the original request.
+async def get_cached_response(cache_key):
+    row = await fetchone(
+        """
+        SELECT c.response_id, r.request_id, r.data, b.codec, b.data AS blob
+        FROM response_cache c
+        JOIN responses r ON r.id = c.response_id
+        LEFT JOIN response_blobs b ON b.hash = r.data_hash
+        WHERE c.cache_key = %s
+        """,
+        (cache_key,)
+    )
+    return decode_response_row(row)
+
+
+## Link cache key to stored response (latest response wins)
+async def add_cached_response(cache_key, response_id):
+    await execute(
+        """
+        INSERT INTO response_cache (cache_key, response_id, created_at)
+        VALUES (%s, %s, NOW())
+        ON DUPLICATE KEY UPDATE response_id = VALUES(response_id), created_at = VALUES(created_at)
+        """,
+        (cache_key, response_id)
+    )
+
+
+## Count cache hits - queued, see db/writer.py
+async def touch_cached_response(cache_key):
+    await enqueue("cache_hits", cache_key)
+
+
+async def _write_cache_hits(cache_keys):
+    counts = {}
+    for cache_key in cache_keys:
+        counts[cache_key] = counts.get(cache_key, 0) + 1
+    cases = " ".join(["WHEN %s THEN %s"] * len(counts))
+    placeholders = ",".join(["%s"] * len(counts))
+    params = [v for item in counts.items() for v in item] + list(counts)
+    await execute(
+        f"UPDATE response_cache SET hits = hits + CASE cache_key {cases} END, last_hit = NOW() WHERE cache_key IN ({placeholders})",
+        params
+    )
+
+
+register_batch_writer("cache_hits", _write_cache_hits)
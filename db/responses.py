@@ -1,15 +1,99 @@
-from db import execute, fetchone, fetchall
+import hashlib
+import zlib
 
+from db import execute, fetchone, fetchall, acquire
+from db.writer import enqueue, register_batch_writer
 
-## Store OpeAI responses
-async def add_response(request_id, data):
-    return await execute(
-        "INSERT INTO responses (request_id, data) VALUES (%s,%s)",
-        (request_id, data)
-    )
 
+## Response texts are stored once per content in `response_blobs` (sha256 of text -> compressed text),
+## `responses.data_hash` refers to the blob. `responses.data` is left only in rows not yet migrated
+## by tools/migrate_response_blobs.py.
+CODEC = "zlib"
+COMPRESS_LEVEL = 6
+
+
+def pack_response(data):
+    """Text -> (hash, codec, raw size in bytes, compressed bytes)."""
+    raw = (data or "").encode("utf-8")
+    return hashlib.sha256(raw).hexdigest(), CODEC, len(raw), zlib.compress(raw, COMPRESS_LEVEL)
+
+
+def unpack_response(codec, blob):
+    if blob is None:
+        return None
+    if codec == "zlib":
+        return zlib.decompress(blob).decode("utf-8")
+    if codec == "raw":
+        return bytes(blob).decode("utf-8")
+    raise ValueError(f"Unknown response codec: {codec}")
+
+
+def _blob_rows_sql(count):
+    return f"INSERT IGNORE INTO response_blobs (hash, codec, size, data) VALUES {','.join(['(%s,%s,%s,%s)'] * count)}"
+
+
+## Store OpeAI responses: blob (if new) and response row referring to it - one transaction.
+## `section` - number of verse group of fan-out request (0 for ordinary requests).
+async def add_response(request_id, data, section=0):
+    packed = pack_response(data)
+    async with acquire() as conn:
+        await conn.begin()
+        try:
+            async with conn.cursor() as cur:
+                await cur.execute(_blob_rows_sql(1), packed)
+                await cur.execute(
+                    "INSERT INTO responses (request_id, section, data_hash) VALUES (%s,%s,%s)",
+                    (request_id, section, packed[0])
+                )
+                response_id = cur.lastrowid
+            await conn.commit()
+        except BaseException:
+            await conn.rollback()
+            raise
+    return response_id
 
-## Receive response by request_id
-async def get_response(request_id):
-    return await fetchone("SELECT * FROM responses WHERE request_id=%s", (request_id,))
 
+## Store response when its id is not needed (not cached answers) - queued, see db/writer.py
+async def add_response_later(request_id, data, section=0):
+    await enqueue("responses", (request_id, section, data))
+
+
+async def _write_responses(rows):
+    blobs = {}
+    refs = []
+    for request_id, section, data in rows:
+        packed = pack_response(data)
+        blobs[packed[0]] = packed
+        refs += [request_id, section, packed[0]]
+    ## Blobs go first: a response row never refers to a missing blob
+    await execute(_blob_rows_sql(len(blobs)), [v for packed in blobs.values() for v in packed])
+    await execute(f"INSERT INTO responses (request_id, section, data_hash) VALUES {','.join(['(%s,%s,%s)'] * len(rows))}", refs)
+
+
+register_batch_writer("responses", _write_responses)
+
+
+## Columns of response row with text decompressed on the fly; query must select `b.codec` and `b.data AS blob`
+def decode_response_row(row):
+    if row is None:
+        return None
+    codec, blob = row.pop("codec", None), row.pop("blob", None)
+    if blob is not None:
+        row["data"] = unpack_response(codec, blob)
+    return row
+
+
+## Receive response by request_id (first section of fan-out request)
+async def get_response(request_id):
+    row = await fetchone(
+        """
+        SELECT r.*, b.codec, b.data AS blob
+        FROM responses r
+        LEFT JOIN response_blobs b ON b.hash = r.data_hash
+        WHERE r.request_id=%s
+        ORDER BY r.section
+        LIMIT 1
+        """,
+        (request_id,)
+    )
+    return decode_response_row(row)
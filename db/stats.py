@@ -0,0 +1,193 @@
+import asyncio
+import json
+import logging
+import time
+
+import aiomysql
+
+from config import STATS_AGGREGATE_INTERVAL, STATS_ABANDONED_SECONDS, STATS_BATCH_ROWS
+from db import acquire, fetchall
+from utils.metrics import register_metrics
+
+
+## Rollups of `requests` kept by the background aggregator (aggregate_stats_periodically):
+## `stats_hourly` / `stats_daily` - all users per hour / day, `stats_users` - per user all time,
+## row with user_id GLOBAL_ID - whole bot all time. Every rollup is a JSON dict of empty_stats() shape.
+## Requests are folded once, in id order, when they are finished (`datetime_response` set) - the watermark
+## `stats_state.last_id` (last folded request) stops before the first unfinished one. Requests left unfinished
+## for STATS_ABANDONED_SECONDS (process died) are folded as they are, so they don't hold the watermark forever.
+GLOBAL_ID = 0
+
+## Upper bounds (seconds) of response delay histogram buckets, the last bucket is open.
+## Percentiles are estimated from the histogram, so they can be summed over any period.
+DELAY_BUCKETS = (1, 2, 3, 5, 7, 10, 15, 20, 30, 45, 60, 90, 120, 180, 300)
+
+_ROLLUPS = (("stats_hourly", "hour"), ("stats_daily", "day"), ("stats_users", "user_id"))
+_stats = {"folded": 0, "passes": 0, "last_pass_ms": 0.0, "last_id": 0}
+
+
+def empty_stats():
+    return {
+        "requests": 0, "ok": 0, "credits": 0, "delay_n": 0, "delay_sum": 0.0,
+        "delay_hist": [0] * (len(DELAY_BUCKETS) + 1), "levels": {}, "books": {},
+    }
+
+
+def _level(user_state):
+    try:
+        return json.loads(user_state or "{}").get("level") or "unknown"
+    except (ValueError, AttributeError):
+        return "unknown"
+
+
+def _fold(stats, row, level):
+    stats["requests"] += 1
+    stats["credits"] += row["credits"] or 0
+    stats["levels"][level] = stats["levels"].get(level, 0) + 1
+    if row["book_id"] is not None:
+        book = str(row["book_id"])
+        stats["books"][book] = stats["books"].get(book, 0) + 1
+    if row["status_oai"]:
+        stats["ok"] += 1
+        if row["delay"] is not None:
+            stats["delay_n"] += 1
+            stats["delay_sum"] += row["delay"]
+            bucket = next((i for i, bound in enumerate(DELAY_BUCKETS) if row["delay"] <= bound), len(DELAY_BUCKETS))
+            stats["delay_hist"][bucket] += 1
+
+
+def _merge(stats, add):
+    for key in ("requests", "ok", "credits", "delay_n", "delay_sum"):
+        stats[key] += add[key]
+    stats["delay_hist"] = [a + b for a, b in zip(stats["delay_hist"], add["delay_hist"])]
+    for key in ("levels", "books"):
+        for name, n in add[key].items():
+            stats[key][name] = stats[key].get(name, 0) + n
+    return stats
+
+
+def _load(text):
+    stats = empty_stats()
+    stats.update(json.loads(text))
+    return stats
+
+
+def delay_percentile(stats, q):
+    """Delay (seconds) below which `q` (0..1) of successful requests are, interpolated in its bucket. None if no data."""
+    hist = stats["delay_hist"]
+    total = sum(hist)
+    if not total:
+        return None
+    rank = q * total
+    seen = 0
+    for i, n in enumerate(hist):
+        if n and seen + n >= rank:
+            lower = DELAY_BUCKETS[i - 1] if i else 0
+            if i == len(DELAY_BUCKETS):
+                return lower
+            return lower + (DELAY_BUCKETS[i] - lower) * (rank - seen) / n
+        seen += n
+    return DELAY_BUCKETS[-1]
+
+
+async def aggregate_stats(batch=STATS_BATCH_ROWS):
+    """
+    One pass: fold up to `batch` finished requests after the watermark into all rollups, one transaction.
+    Returns number of folded requests.
+    """
+    async with acquire() as conn:
+        await conn.begin()
+        try:
+            async with conn.cursor(aiomysql.DictCursor) as cur:
+                await cur.execute("INSERT IGNORE INTO stats_state (name, last_id) VALUES ('requests', 0)")
+                ## Watermark row lock: passes never overlap (the aggregator runs in one worker, but e.g. a second
+                ## bot instance during deploy may run its own)
+                await cur.execute("SELECT last_id FROM stats_state WHERE name='requests' FOR UPDATE")
+                last_id = (await cur.fetchone())["last_id"]
+                await cur.execute(
+                    """
+                    SELECT id, user_id, datetime_request, delay, status_oai, credits, book_id, user_state,
+                           datetime_response IS NOT NULL OR datetime_request < NOW() - INTERVAL %s SECOND AS settled
+                    FROM requests
+                    WHERE id > %s
+                    ORDER BY id
+                    LIMIT %s
+                    """,
+                    (STATS_ABANDONED_SECONDS, last_id, batch)
+                )
+                rows = await cur.fetchall()
+                ## Stop at the first request still in progress
+                settled = next((i for i, row in enumerate(rows) if not row["settled"]), len(rows))
+                rows = rows[:settled]
+                if not rows:
+                    await conn.rollback()
+                    return 0
+                increments = {table: {} for table, _ in _ROLLUPS}
+                for row in rows:
+                    level = _level(row["user_state"])
+                    at = row["datetime_request"]
+                    keys = {
+                        "stats_hourly": [at.replace(minute=0, second=0, microsecond=0)],
+                        "stats_daily": [at.date()],
+                        "stats_users": [row["user_id"], GLOBAL_ID],
+                    }
+                    for table, table_keys in keys.items():
+                        for key in table_keys:
+                            _fold(increments[table].setdefault(key, empty_stats()), row, level)
+                for table, column in _ROLLUPS:
+                    added = increments[table]
+                    await cur.execute(
+                        f"SELECT {column} AS k, stats FROM {table} WHERE {column} IN ({','.join(['%s'] * len(added))}) FOR UPDATE",
+                        list(added)
+                    )
+                    current = {row["k"]: _load(row["stats"]) for row in await cur.fetchall()}
+                    values = []
+                    for key, stats in added.items():
+                        if key in current:
+                            stats = _merge(current[key], stats)
+                        values += [key, json.dumps(stats, separators=(",", ":"))]
+                    await cur.execute(
+                        f"""
+                        INSERT INTO {table} ({column}, stats) VALUES {','.join(['(%s,%s)'] * len(added))}
+                        ON DUPLICATE KEY UPDATE stats = VALUES(stats)
+                        """,
+                        values
+                    )
+                await cur.execute("UPDATE stats_state SET last_id=%s WHERE name='requests'", (rows[-1]["id"],))
+            await conn.commit()
+        except BaseException:
+            await conn.rollback()
+            raise
+    _stats["folded"] += len(rows)
+    _stats["last_id"] = rows[-1]["id"]
+    return len(rows)
+
+
+async def aggregate_stats_periodically(interval=STATS_AGGREGATE_INTERVAL):
+    """
+    Background task: fold new requests into rollups every `interval` seconds (catches up in batches).
+    """
+    while True:
+        t0 = time.monotonic()
+        try:
+            while await aggregate_stats() == STATS_BATCH_ROWS:
+                pass
+        except Exception:
+            logging.exception("Stats aggregation failed")
+        _stats["passes"] += 1
+        _stats["last_pass_ms"] = round((time.monotonic() - t0) * 1000, 1)
+        await asyncio.sleep(interval)
+
+
+async def get_user_stats(user_id):
+    """(user's stats, whole bot stats) - one primary key lookup."""
+    rows = await fetchall("SELECT user_id, stats FROM stats_users WHERE user_id IN (%s, %s)", (user_id, GLOBAL_ID))
+    found = {row["user_id"]: _load(row["stats"]) for row in rows}
+    return found.get(user_id, empty_stats()), found.get(GLOBAL_ID, empty_stats())
+
+
+def stats_aggregator_stats():
+    return dict(_stats)
+
+
+register_metrics("stats_aggregator", stats_aggregator_stats)
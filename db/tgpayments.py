@@ -1,4 +1,4 @@
-from db import get_pool
+from db import acquire
 
 
 async def add_tgpayment(
@@ -12,8 +12,7 @@ async def add_tgpayment(
     datetime_val: str = None,
     raw_json: str = None,
 ):
-    pool = await get_pool()
-    async with pool.acquire() as conn:
+    async with acquire() as conn:
         async with conn.cursor() as cur:
             await cur.execute(
                 """
@@ -44,8 +43,7 @@ async def add_tgpayment(
 
 
 async def get_user_amount(user_id: int):
-    pool = await get_pool()
-    async with pool.acquire() as conn:
+    async with acquire() as conn:
         async with conn.cursor() as cur:
             await cur.execute("SELECT amount FROM users WHERE user_id=%s", (user_id,))
             row = await cur.fetchone()
@@ -59,8 +57,7 @@ async def set_user_amount(user_id: int, delta: int, new_external_id: str) -> boo
     Atomically add delta to user's amount and set external_id to new_external_id ONLY if external_id != new_external_id.
     Returns True if updated, False if not (i.e., already processed).
     """
-    pool = await get_pool()
-    async with pool.acquire() as conn:
+    async with acquire() as conn:
         async with conn.cursor() as cur:
             await cur.execute(
                 """
@@ -1,5 +1,11 @@
 from db import execute, fetchone, fetchall
+import asyncio
 import datetime
+import logging
+from collections import OrderedDict
+
+from config import USER_PROFILE_CACHE_SIZE, USER_LAST_SEEN_FLUSH_INTERVAL
+from utils.metrics import register_metrics
 
 
 ## Get user by user_id
@@ -34,14 +40,102 @@ async def update_user(user_id, firstname, lastname, username, lang, is_bot):
     )
 
 
-## Create or update user then he enters (upsert)
+## Create or update user in one statement (`user_id` is unique). Also used inside request transaction (db/requests.py).
+UPSERT_USER_SQL = """
+    INSERT INTO users (user_id, firstname, lastname, username, lang, is_bot, last_seen)
+    VALUES (%s, %s, %s, %s, %s, %s, NOW())
+    ON DUPLICATE KEY UPDATE
+        firstname = VALUES(firstname),
+        lastname = VALUES(lastname),
+        username = VALUES(username),
+        lang = VALUES(lang),
+        is_bot = VALUES(is_bot),
+        last_seen = VALUES(last_seen)
+"""
+
+
+## Profiles already in DB: user_id -> (firstname, lastname, username, lang, is_bot), LRU.
+## A message of a known user with unchanged profile only marks `last_seen`, which is written
+## for many users at once by flush_last_seen().
+_profiles = OrderedDict()
+## user_id -> (profile, time of last message) not yet written
+_seen = {}
+_profile_stats = {"hits": 0, "writes": 0, "last_seen_written": 0}
+
+
+def touch_user(user_id, profile):
+    """
+    True if user with this profile is known to be in DB; his `last_seen` is then queued.
+    False means the profile must be written (new user, changed name / lang, or evicted from cache).
+    """
+    if _profiles.get(user_id) != profile:
+        return False
+    _profiles.move_to_end(user_id)
+    _seen[user_id] = (profile, datetime.datetime.now())
+    _profile_stats["hits"] += 1
+    return True
+
+
+def remember_user(user_id, profile):
+    """Profile was just written to DB (with fresh `last_seen`)."""
+    _profiles[user_id] = profile
+    _profiles.move_to_end(user_id)
+    while len(_profiles) > USER_PROFILE_CACHE_SIZE:
+        _profiles.popitem(last=False)
+    _seen.pop(user_id, None)
+    _profile_stats["writes"] += 1
+
+
+## Create or update user then he enters (upsert). Known users with unchanged profile cost no query.
 async def upsert_user(user_id, firstname, lastname, username, lang, is_bot):
-    print(f"DBG upsert_user(): {user_id=}, {firstname=}, {lastname=}, {username=}, {lang=}, {is_bot=}")
-    user = await get_user(user_id)
-    print(f"upsert_user()->get_user(): {user=}")
-    if user:
-        await update_user(user_id, firstname, lastname, username, lang, is_bot)
-    else:
-        await add_user(user_id, firstname, lastname, username, lang, is_bot)
+    profile = (firstname, lastname, username, lang, is_bot)
+    if touch_user(user_id, profile):
+        return
+    await execute(UPSERT_USER_SQL, (user_id, *profile))
+    remember_user(user_id, profile)
+
+
+async def flush_last_seen():
+    """
+    Write queued `last_seen` with one multi-row upsert (full profile is kept, so a row deleted meanwhile is restored).
+    Returns number of written users.
+    """
+    if not _seen:
+        return 0
+    rows = list(_seen.items())
+    _seen.clear()
+    values = []
+    for user_id, (profile, seen) in rows:
+        values += [user_id, *profile, seen]
+    try:
+        await execute(
+            f"""
+            INSERT INTO users (user_id, firstname, lastname, username, lang, is_bot, last_seen)
+            VALUES {','.join(['(%s,%s,%s,%s,%s,%s,%s)'] * len(rows))}
+            ON DUPLICATE KEY UPDATE last_seen = GREATEST(COALESCE(last_seen, VALUES(last_seen)), VALUES(last_seen))
+            """,
+            values
+        )
+    except Exception:
+        logging.exception("Failed to save last_seen of %s users", len(rows))
+        for user_id, item in rows:
+            _seen.setdefault(user_id, item)
+        return 0
+    _profile_stats["last_seen_written"] += len(rows)
+    return len(rows)
+
+
+async def flush_last_seen_periodically(interval=USER_LAST_SEEN_FLUSH_INTERVAL):
+    """
+    Background task: coalesced `last_seen` updates.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        await flush_last_seen()
+
+
+def user_profiles_stats():
+    return {"cached": len(_profiles), "last_seen_pending": len(_seen), **_profile_stats}
 
 
+register_metrics("user_profiles", user_profiles_stats)
@@ -0,0 +1,26 @@
+import json
+
+from db import execute, fetchone
+
+
+## Get stored user state (dict) or None
+async def load_user_state(user_id):
+    row = await fetchone("SELECT state FROM user_states WHERE user_id=%s", (user_id,))
+    if not row or not row.get("state"):
+        return None
+    return json.loads(row["state"])
+
+
+## Store states of several users in one statement: rows are (user_id, state JSON)
+async def save_user_states(rows):
+    if not rows:
+        return
+    placeholders = ",".join(["(%s, %s)"] * len(rows))
+    params = [value for row in rows for value in row]
+    await execute(
+        f"""
+        INSERT INTO user_states (user_id, state) VALUES {placeholders}
+        ON DUPLICATE KEY UPDATE state = VALUES(state)
+        """,
+        params
+    )
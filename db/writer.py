@@ -0,0 +1,140 @@
+import asyncio
+import logging
+import time
+
+from config import DB_WRITE_INTERVAL_MS, DB_WRITE_BATCH_ROWS, DB_WRITE_QUEUE_SIZE
+from utils.metrics import register_metrics
+
+
+## Write-behind of audit data (responses, hit counters, delivery statuses).
+## DB modules register a batch function per kind: `register_batch_writer("book_hits", func)`,
+## func(items) writes a list of queued items with multi-row statements.
+## Writes that need an id back (or must be consistent at once, like credits) stay synchronous.
+_writers = {}
+_queue = None
+_task = None
+_stats = {"written": 0, "batches": 0, "failed": 0, "waited_full": 0}
+
+## Attempts of one batch before its rows are dropped (and logged)
+_MAX_ATTEMPTS = 3
+
+
+def register_batch_writer(kind, func):
+    _writers[kind] = func
+
+
+def _get_queue():
+    global _queue
+    if _queue is None:
+        _queue = asyncio.Queue(maxsize=DB_WRITE_QUEUE_SIZE)
+    return _queue
+
+
+async def enqueue(kind, item):
+    """
+    Queue a row for background writing. When the queue is full the caller waits (backpressure).
+    Without running writer (tools, scripts) the row is written at once.
+    """
+    if _task is None or _task.done():
+        await _write(kind, [item])
+        return
+    queue = _get_queue()
+    if queue.full():
+        _stats["waited_full"] += 1
+    await queue.put((kind, item))
+
+
+async def _write(kind, items):
+    for attempt in range(1, _MAX_ATTEMPTS + 1):
+        try:
+            await _writers[kind](items)
+            _stats["written"] += len(items)
+            _stats["batches"] += 1
+            return
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            if attempt == _MAX_ATTEMPTS:
+                _stats["failed"] += len(items)
+                logging.exception("DB writer: dropping %s %s rows after %s attempts", len(items), kind, attempt)
+                return
+            logging.warning("DB writer: batch of %s %s rows failed, retry %s", len(items), kind, attempt, exc_info=True)
+            await asyncio.sleep(0.5 * attempt)
+
+
+async def _write_batch(batch):
+    by_kind = {}
+    for kind, item in batch:
+        by_kind.setdefault(kind, []).append(item)
+    for kind, items in by_kind.items():
+        await _write(kind, items)
+
+
+async def _run(interval, batch_rows):
+    queue = _get_queue()
+    stop = False
+    while not stop:
+        batch = [await queue.get()]
+        ## Collect more rows for up to `interval` seconds or `batch_rows` rows
+        deadline = time.monotonic() + interval
+        while len(batch) < batch_rows and batch[-1] is not None:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        if batch[-1] is None:
+            ## Stop mark from stop_db_writer()
+            stop = True
+            batch.pop()
+        try:
+            await _write_batch(batch)
+        finally:
+            for _ in range(len(batch) + stop):
+                queue.task_done()
+
+
+def start_db_writer():
+    global _task
+    if _task is None or _task.done():
+        _task = asyncio.create_task(_run(DB_WRITE_INTERVAL_MS / 1000, DB_WRITE_BATCH_ROWS))
+    return _task
+
+
+async def stop_db_writer():
+    """
+    Stop background writer and write everything still queued (on shutdown).
+    """
+    global _task
+    ## Rows queued from now on are written directly by enqueue()
+    task, _task = _task, None
+    if task is None or task.done():
+        return
+    queue = _get_queue()
+    await queue.put(None)
+    try:
+        await task
+    except Exception:
+        logging.exception("DB writer failed on shutdown")
+    ## Producers that were blocked on the full queue put their rows after the stop mark: write them directly.
+    ## Every taken row wakes one blocked producer, so repeat until a loop pass adds nothing.
+    while True:
+        batch = []
+        while not queue.empty():
+            batch.append(queue.get_nowait())
+            queue.task_done()
+        if not batch:
+            await asyncio.sleep(0)
+            if queue.empty():
+                break
+            continue
+        await _write_batch([row for row in batch if row is not None])
+
+
+def db_writer_stats():
+    return {"queued": _queue.qsize() if _queue else 0, **_stats}
+
+
+register_metrics("db_writer", db_writer_stats)
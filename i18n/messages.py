@@ -1,3 +1,5 @@
+from string import Formatter
+
 from utils.userstate import get_user_state
 
 MESSAGES = {
@@ -134,6 +136,8 @@ MESSAGES = {
             "query_format_error": "Неверный формат запроса. Пример: бытие 1 1-3,5",
             "book_not_found": "Книга «{book}» не найдена в базе. Проверьте правильность названия.",
             "handle_korneslov_query_exception": "Произошла ошибка генерации. Повторите запрос позже.",
+            "queued": "Ваш запрос в очереди: позиция {position}, ожидание около {wait} мин.",
+            "overloaded": "Сервис сейчас перегружен. Запрос не принят, средства не списаны. Повторите попытку через несколько минут.",
         },
         "korneslov_py": {
             "dummy_openai_response_return": "Корнеслов: {book} {chapter} {verse}\n<br>{dummy_text}",
@@ -141,6 +145,20 @@ MESSAGES = {
             "ask_openai_return": "Корнеслов", ## inserted into f-string
             "ask_openai_exception_logging": "Ошибка при обращении к OpenAI",
             "ask_openai_exception_return": "Корнеслов: {book} {chapter} {verse}\n(Ошибка обращения к ChatGPT. Попробуйте позже.)",
+            "continue_prompt": "Ответ оборвался. Продолжи ровно с того места, где остановился, не повторяя уже написанное и сохраняя тот же формат.",
+            "markdown_format_prompt": "\n\nФормат ответа: не используй HTML. Оформляй только так: **жирный**, *курсив*, __подчёркнутый__, ~~зачёркнутый~~, `код`, блоки ```код```, строки цитат с \"> \", заголовки с \"# \", пункты списков с \"- \".",
+        },
+        "statistics": {
+            "user_title": "📊 <b>Ваша статистика</b>",
+            "global_title": "🌐 <b>Статистика бота</b>",
+            "empty": "Запросов пока нет.",
+            "requests": "Запросов: {requests}, успешных: {ok} ({ok_rate}%)",
+            "delay": "Время ответа: медиана {p50} с, 95% запросов - до {p95} с",
+            "credits": "Потрачено корешков: {credits}",
+            "levels": "По уровням: {levels}",
+            "books": "Книги: {books}",
+            "unknown": "другое",
+            "footer": "<i>Данные обновляются раз в несколько минут.</i>",
         },
         "errors": {
             "db_unavailable": "Временные проблемы с базой данных. Пожалуйста, повторите попытку позже.",
@@ -281,6 +299,8 @@ Example:
             "query_format_error": "Query format error. Example: genesis 1 1-3,5",
             "book_not_found": "The book «{book}» not found in DB. Please check book name.",
             "handle_korneslov_query_exception": "A generation error occurred. Please try again later.",
+            "queued": "Your request is queued: position {position}, wait about {wait} min.",
+            "overloaded": "The service is overloaded right now. The request was not accepted and nothing was charged. Please try again in a few minutes.",
         },
         "korneslov_py": {
             "dummy_openai_response_return": "Korneslov: {book} {chapter} {verse}\n{dummy_text}",
@@ -288,6 +308,20 @@ Example:
             "ask_openai_return": "Korneslov", ## inserted into f-string
             "ask_openai_exception_logging": "OpenAI request failed",
             "ask_openai_exception_return": "Korneslov: {book} {chapter} {verse}\n(Error during request to ChatGPT. Try later.)",
+            "continue_prompt": "Your answer was cut off. Continue exactly from where you stopped, without repeating what is already written and keeping the same format.",
+            "markdown_format_prompt": "\n\nAnswer format: do not use HTML. Use only: **bold**, *italic*, __underline__, ~~strikethrough~~, `code`, ```code blocks```, quote lines starting with \"> \", headings starting with \"# \", list items starting with \"- \".",
+        },
+        "statistics": {
+            "user_title": "📊 <b>Your statistics</b>",
+            "global_title": "🌐 <b>Bot statistics</b>",
+            "empty": "No requests yet.",
+            "requests": "Requests: {requests}, successful: {ok} ({ok_rate}%)",
+            "delay": "Response time: median {p50} s, 95% of requests within {p95} s",
+            "credits": "Koreshoks spent: {credits}",
+            "levels": "By level: {levels}",
+            "books": "Books: {books}",
+            "unknown": "other",
+            "footer": "<i>Data is updated every few minutes.</i>",
         },
         "errors": {
             "db_unavailable": "There are temporary problems with the database. Please try again later..",
@@ -298,21 +332,83 @@ Example:
 }
 
 
-##def tr(key, msg=None, user_id=None, default_lang="ru", **kwargs):
-def tr(key, caller=None, msg=None, user_id=None, lang="ru", **kwargs):
-    ## Define user_id from msg (if sent), of from param, else fallback
-    ##print(f"DBG: tr() called with key={key}, caller={caller}, kwargs={kwargs}")
+## MESSAGES compiled at import: lang -> {"section.key": (template, parts)}. `parts` is preparsed template
+## (literal, field, spec, conversion) for _render(); None for templates without fields - returned as is.
+_CATALOG = {}
+## Reverse index of button texts: lang -> {text: frozenset of keys}
+_BUTTONS = {}
+
+
+def _flatten(tree, prefix=""):
+    for name, value in tree.items():
+        key = f"{prefix}{name}"
+        if isinstance(value, dict):
+            yield from _flatten(value, f"{key}.")
+        else:
+            yield key, value
+
+
+_CONVERSIONS = {"s": str, "r": repr, "a": ascii}
+
+
+def _render(parts, kwargs):
+    """Same as template.format(**kwargs) for named fields, without parsing the template again."""
+    out = []
+    for literal, field, spec, conversion in parts:
+        out.append(literal)
+        if field is not None:
+            value = kwargs[field]
+            if conversion:
+                value = _CONVERSIONS[conversion](value)
+            out.append(format(value, spec))
+    return "".join(out)
+
+
+def _compile_messages():
+    formatter = Formatter()
+    for lang, tree in MESSAGES.items():
+        catalog = {}
+        buttons = {}
+        for key, text in _flatten(tree):
+            parts = tuple(formatter.parse(text))
+            if all(field is None for _, field, _, _ in parts):
+                parts = None
+            catalog[key] = (text, parts)
+            ## Button texts are short constant strings
+            if parts is None:
+                buttons.setdefault(text, set()).add(key)
+        _CATALOG[lang] = catalog
+        _BUTTONS[lang] = {text: frozenset(keys) for text, keys in buttons.items()}
+
+
+_compile_messages()
+
+
+def _user_lang(msg, user_id, lang):
     if msg is not None:
         user_id = msg.from_user.id
     if user_id is not None:
         lang = get_user_state(user_id).get("lang", lang)
-    ## Get message
-    parts = key.split(".")
-    d = MESSAGES.get(lang, MESSAGES.get(lang))
-    for part in parts:
-        d = d.get(part, {})
-    if isinstance(d, str):
-        return d.format(**kwargs)
-    ## Return something nonempty to satisfy telegram.
-    return "PUSTO"
+    return lang
+
+
+##def tr(key, msg=None, user_id=None, default_lang="ru", **kwargs):
+def tr(key, caller=None, msg=None, user_id=None, lang="ru", **kwargs):
+    ## Define user_id from msg (if sent), of from param, else fallback
+    ##print(f"DBG: tr() called with key={key}, caller={caller}, kwargs={kwargs}")
+    lang = _user_lang(msg, user_id, lang)
+    entry = _CATALOG.get(lang, _CATALOG["ru"]).get(key)
+    if entry is None:
+        ## Return something nonempty to satisfy telegram.
+        return "PUSTO"
+    text, parts = entry
+    return _render(parts, kwargs) if parts else text
+
 
+def button_keys(text, msg=None, user_id=None, lang="ru"):
+    """
+    Keys of all messages of user's language equal to `text` (usually a pressed button).
+    One dict lookup instead of tr() call per candidate button.
+    """
+    lang = _user_lang(msg, user_id, lang)
+    return _BUTTONS.get(lang, _BUTTONS["ru"]).get(text, frozenset())
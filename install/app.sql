@@ -15,17 +15,28 @@ CREATE TABLE IF NOT EXISTS books (
     hits INT NOT NULL DEFAULT 0
 );
 
--- Users' requests
+-- Users' requests. Partitioned by month (`tools/archive_requests.py` adds partitions and archives old ones),
+-- so other tables refer to it without foreign keys
 CREATE TABLE IF NOT EXISTS requests (
-    id INT AUTO_INCREMENT PRIMARY KEY,
+    id INT AUTO_INCREMENT,
     user_id BIGINT NOT NULL,
     user_state TEXT,
-    datetime_request DATETIME,
+    datetime_request DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
     datetime_response DATETIME,
     delay FLOAT,
     request TEXT,
     status_oai BOOLEAN,
-    status_tg BOOLEAN
+    status_tg BOOLEAN,
+    cached_response_id INT,
+    -- Credits reserved (then charged) for the request; refunded ones are subtracted
+    credits INT NOT NULL DEFAULT 0,
+    book_id INT,
+    PRIMARY KEY (id, datetime_request),
+    KEY idx_user_time (user_id, datetime_request),
+    KEY idx_cached_response (cached_response_id)
+)
+PARTITION BY RANGE COLUMNS (datetime_request) (
+    PARTITION pmax VALUES LESS THAN (MAXVALUE)
 );
 
 -- Info about bot's users
@@ -43,15 +54,67 @@ CREATE TABLE IF NOT EXISTS users (
     last_seen DATETIME,
     amount INT DEFAULT 0,
     external_id VARCHAR(64),
-    FOREIGN KEY (request_id) REFERENCES requests(id) ON DELETE SET NULL
+    KEY idx_request_id (request_id)
+);
+
+-- Texts of AI responses: one compressed copy per content (see `db/responses.py`)
+CREATE TABLE IF NOT EXISTS response_blobs (
+    hash CHAR(64) PRIMARY KEY,
+    codec VARCHAR(8) NOT NULL,
+    size INT NOT NULL,
+    data LONGBLOB NOT NULL,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
 );
 
--- OpenAI responses
+-- OpenAI responses. `data` is kept only in rows written before response_blobs.
+-- Fan-out requests (several verse groups) have one row per `section`, others only section 0
 CREATE TABLE IF NOT EXISTS responses (
     id INT AUTO_INCREMENT PRIMARY KEY,
     request_id INT NOT NULL,
+    section SMALLINT NOT NULL DEFAULT 0,
     data LONGTEXT,
-    FOREIGN KEY (request_id) REFERENCES requests(id) ON DELETE CASCADE
+    data_hash CHAR(64),
+    UNIQUE KEY uniq_request_section (request_id, section),
+    FOREIGN KEY (data_hash) REFERENCES response_blobs(hash)
+);
+
+-- Cache of Korneslov analyses: canonical request key -> stored response
+CREATE TABLE IF NOT EXISTS response_cache (
+    cache_key CHAR(64) PRIMARY KEY,
+    response_id INT NOT NULL,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    last_hit DATETIME,
+    hits INT NOT NULL DEFAULT 0,
+    FOREIGN KEY (response_id) REFERENCES responses(id) ON DELETE CASCADE
+);
+
+-- Users' state (language, level, payment flow...) shared by bot worker processes
+CREATE TABLE IF NOT EXISTS user_states (
+    user_id BIGINT PRIMARY KEY,
+    state TEXT NOT NULL,
+    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+);
+
+-- Statistics rollups of `requests` (JSON, see `db/stats.py`): all users per hour / day,
+-- per user all time (user_id 0 - whole bot); `stats_state.last_id` - last folded request
+CREATE TABLE IF NOT EXISTS stats_hourly (
+    hour DATETIME PRIMARY KEY,
+    stats TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS stats_daily (
+    day DATE PRIMARY KEY,
+    stats TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS stats_users (
+    user_id BIGINT PRIMARY KEY,
+    stats TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS stats_state (
+    name VARCHAR(32) PRIMARY KEY,
+    last_id INT NOT NULL DEFAULT 0
 );
 
 -- Telegram Bot Payment
@@ -0,0 +1,13 @@
+-- Response cache for Korneslov analyses (see `utils/methods/korneslov_cache.py`)
+USE korneslov;
+
+ALTER TABLE requests ADD COLUMN cached_response_id INT;
+
+CREATE TABLE IF NOT EXISTS response_cache (
+    cache_key CHAR(64) PRIMARY KEY,
+    response_id INT NOT NULL,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    last_hit DATETIME,
+    hits INT NOT NULL DEFAULT 0,
+    FOREIGN KEY (response_id) REFERENCES responses(id) ON DELETE CASCADE
+);
@@ -0,0 +1,8 @@
+-- Users' state shared by bot worker processes (see `utils/userstate.py`)
+USE korneslov;
+
+CREATE TABLE IF NOT EXISTS user_states (
+    user_id BIGINT PRIMARY KEY,
+    state TEXT NOT NULL,
+    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP
+);
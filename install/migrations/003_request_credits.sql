@@ -0,0 +1,4 @@
+-- Credits reserved for a request at its start and settled at its end (see `db/requests.py`)
+USE korneslov;
+
+ALTER TABLE requests ADD COLUMN credits INT NOT NULL DEFAULT 0;
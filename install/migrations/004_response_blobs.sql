@@ -0,0 +1,15 @@
+-- Compressed, deduplicated response texts (see `db/responses.py`).
+-- Move existing texts after applying: python -m tools.migrate_response_blobs
+USE korneslov;
+
+CREATE TABLE IF NOT EXISTS response_blobs (
+    hash CHAR(64) PRIMARY KEY,
+    codec VARCHAR(8) NOT NULL,
+    size INT NOT NULL,
+    data LONGBLOB NOT NULL,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+
+ALTER TABLE responses
+    ADD COLUMN data_hash CHAR(64),
+    ADD FOREIGN KEY (data_hash) REFERENCES response_blobs(hash);
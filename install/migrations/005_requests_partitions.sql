@@ -0,0 +1,30 @@
+-- Indexes for lookups by user / time and monthly partitions of `requests` (see `tools/archive_requests.py`).
+-- Partitioned InnoDB tables can't be referenced by foreign keys: responses/users keep request ids without FK,
+-- old rows are removed together by the archival tool. FK names below are the ones MySQL generates
+-- for `app.sql` + migrations; check with `SHOW CREATE TABLE` if they differ.
+-- After applying split the single partition into months: python -m tools.archive_requests --ensure-only
+USE korneslov;
+
+ALTER TABLE users DROP FOREIGN KEY users_ibfk_1;
+
+ALTER TABLE responses DROP FOREIGN KEY responses_ibfk_1;
+-- Sections of fan-out requests: existing rows of one request are numbered in id order
+ALTER TABLE responses ADD COLUMN section SMALLINT NOT NULL DEFAULT 0 AFTER request_id;
+UPDATE responses r
+JOIN (SELECT id, ROW_NUMBER() OVER (PARTITION BY request_id ORDER BY id) - 1 AS n FROM responses) x ON x.id = r.id
+SET r.section = x.n
+WHERE x.n > 0;
+ALTER TABLE responses DROP INDEX request_id, ADD UNIQUE KEY uniq_request_section (request_id, section);
+
+-- Partitioning column must be in every unique key, so it joins the primary key
+UPDATE requests SET datetime_request = COALESCE(datetime_response, NOW()) WHERE datetime_request IS NULL;
+ALTER TABLE requests
+    MODIFY datetime_request DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    DROP PRIMARY KEY,
+    ADD PRIMARY KEY (id, datetime_request),
+    ADD KEY idx_user_time (user_id, datetime_request),
+    ADD KEY idx_cached_response (cached_response_id);
+
+ALTER TABLE requests PARTITION BY RANGE COLUMNS (datetime_request) (
+    PARTITION pmax VALUES LESS THAN (MAXVALUE)
+);
@@ -0,0 +1,25 @@
+-- Statistics rollups kept by the background aggregator (see `db/stats.py`).
+-- Existing requests are folded in by the bot after start (in batches, oldest first).
+USE korneslov;
+
+ALTER TABLE requests ADD COLUMN book_id INT;
+
+CREATE TABLE IF NOT EXISTS stats_hourly (
+    hour DATETIME PRIMARY KEY,
+    stats TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS stats_daily (
+    day DATE PRIMARY KEY,
+    stats TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS stats_users (
+    user_id BIGINT PRIMARY KEY,
+    stats TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS stats_state (
+    name VARCHAR(32) PRIMARY KEY,
+    last_id INT NOT NULL DEFAULT 0
+);
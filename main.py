@@ -1,12 +1,30 @@
 import asyncio
+import json
+import logging
+import multiprocessing
+import os
 
 from aiogram import Bot, Dispatcher
 
-from aiohttp import ClientTimeout
+from aiohttp import ClientTimeout, web
 from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from config import TG_POLLING_TIMEOUT, TG_SOCK_CONNECT_TIMEOUT, TG_SOCK_READ_TIMEOUT
 
-from config import TELEGRAM_BOT_TOKEN
+from config import TELEGRAM_BOT_TOKEN, BOOKS_CATALOG_POLL_INTERVAL, METRICS_LOG_INTERVAL, OUTBOX_DRAIN_TIMEOUT
+from config import BOT_MODE, TELEGRAM_API_URL, WEBHOOK_BASE_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBAPP_HOST, WEBAPP_PORT, WEBHOOK_WORKERS
+
+from db.books import load_books_catalog, watch_books_catalog
+from utils.metrics import log_metrics_periodically, collect_metrics
+from utils.outbox import drain_outbox
+from db import close_pool
+from db.users import flush_last_seen, flush_last_seen_periodically
+from db.stats import aggregate_stats_periodically
+from db.requests import settle_stale_requests_periodically
+from db.writer import start_db_writer, stop_db_writer
+from utils.userstate import UserStateMiddleware, flush_user_states, flush_user_states_periodically
+from utils.filters import ButtonMiddleware
 
 from routes.errors import router as errors_router
 
@@ -33,9 +51,18 @@ timeout = ClientTimeout(total=None, sock_connect=TG_SOCK_CONNECT_TIMEOUT, sock_r
 session = AiohttpSession(timeout=timeout)
 
 
-bot = Bot(token=TELEGRAM_BOT_TOKEN, parse_mode="HTML")
+## Custom Bot API server (local Bot API server or tools/fake_telegram.py for load tests)
+if TELEGRAM_API_URL:
+    bot = Bot(token=TELEGRAM_BOT_TOKEN, parse_mode="HTML", session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)))
+else:
+    bot = Bot(token=TELEGRAM_BOT_TOKEN, parse_mode="HTML")
 dp = Dispatcher()
 
+## User state is preloaded from DB before filters run; several worker processes share it through DB
+dp.update.outer_middleware(UserStateMiddleware(shared=BOT_MODE == "webhook" and WEBHOOK_WORKERS > 1))
+## Pressed menu button is resolved once per message (user's language is known by now), routers match its keys
+dp.message.outer_middleware(ButtonMiddleware())
+
 ## IMPORTANT:
 ## 0. Global error-router must be connected first - before any other routes!!
 dp.include_router(errors_router)
@@ -63,10 +90,112 @@ dp.include_router(menu_stats_router)
 dp.include_router(menu_echo_router)
 
 
+## Background tasks started on startup and cancelled on shutdown
+_background_tasks = []
+
+## Bot-wide jobs (stats rollups, settling of stale requests) run in one process only: the first webhook worker
+## (see run_webhook_worker()) or the polling process. Other tasks keep per-process state and run everywhere.
+_singleton_jobs = True
+
+
+async def on_startup():
+    ## Books catalog must be ready before the first reference is parsed
+    await load_books_catalog(force=True)
+    start_db_writer()
+    _background_tasks.append(asyncio.create_task(watch_books_catalog(BOOKS_CATALOG_POLL_INTERVAL)))
+    _background_tasks.append(asyncio.create_task(flush_user_states_periodically()))
+    _background_tasks.append(asyncio.create_task(flush_last_seen_periodically()))
+    if _singleton_jobs:
+        _background_tasks.append(asyncio.create_task(aggregate_stats_periodically()))
+        _background_tasks.append(asyncio.create_task(settle_stale_requests_periodically()))
+    if METRICS_LOG_INTERVAL > 0:
+        _background_tasks.append(asyncio.create_task(log_metrics_periodically(METRICS_LOG_INTERVAL)))
+
+
+async def on_shutdown():
+    ## Let queued answers go out before the bot session is closed
+    await drain_outbox(OUTBOX_DRAIN_TIMEOUT)
+    for task in _background_tasks:
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    _background_tasks.clear()
+    await flush_user_states()
+    await flush_last_seen()
+    ## Write queued audit rows (delivery statuses of the drained outbox included)
+    await stop_db_writer()
+    await close_pool()
+
+
+dp.startup.register(on_startup)
+dp.shutdown.register(on_shutdown)
+
+
 async def main():
 ##    await dp.start_polling(bot)
     await dp.start_polling(bot, polling_timeout=TG_POLLING_TIMEOUT)
 
 
+async def handle_metrics(request):
+    metrics = {"pid": os.getpid(), **collect_metrics()}
+    return web.json_response(text=json.dumps(metrics, ensure_ascii=False, default=str))
+
+
+def build_webhook_app():
+    """
+    aiohttp app of one webhook worker: Telegram updates on WEBHOOK_PATH, metrics on /metrics.
+    Updates are handled in background tasks, so Telegram gets its 200 OK at once.
+    """
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET or None).register(app, path=WEBHOOK_PATH)
+    app.router.add_get("/metrics", handle_metrics)
+    ## Runs dp.startup / dp.shutdown hooks with the app
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+def run_webhook_worker(singleton_jobs=True):
+    global _singleton_jobs
+    _singleton_jobs = singleton_jobs
+    ## All workers listen on the same port, kernel spreads connections among them (SO_REUSEPORT)
+    web.run_app(build_webhook_app(), host=WEBAPP_HOST, port=WEBAPP_PORT, reuse_port=WEBHOOK_WORKERS > 1, print=None)
+
+
+async def set_webhook():
+    url = WEBHOOK_BASE_URL.rstrip("/") + WEBHOOK_PATH
+    await bot.set_webhook(url, secret_token=WEBHOOK_SECRET or None, allowed_updates=dp.resolve_used_update_types())
+    await bot.session.close()
+    logging.warning(f"Webhook is set to {url}")
+
+
+def run_webhook():
+    """
+    Register webhook once, then serve it by WEBHOOK_WORKERS processes (or behind a local reverse proxy).
+    """
+    if WEBHOOK_BASE_URL:
+        asyncio.run(set_webhook())
+    if WEBHOOK_WORKERS <= 1:
+        run_webhook_worker()
+        return
+    ## "spawn": every worker imports the app from scratch (own loop, bot session and DB pool)
+    ctx = multiprocessing.get_context("spawn")
+    workers = [
+        ctx.Process(target=run_webhook_worker, args=(i == 0,), name=f"korneslov-worker-{i}")
+        for i in range(WEBHOOK_WORKERS)
+    ]
+    for w in workers:
+        w.start()
+    try:
+        for w in workers:
+            w.join()
+    except KeyboardInterrupt:
+        for w in workers:
+            w.terminate()
+        for w in workers:
+            w.join()
+
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    if BOT_MODE == "webhook":
+        run_webhook()
+    else:
+        asyncio.run(main())
@@ -12,5 +12,5 @@ router = Router()
 @router.message()
 async def echo(msg: types.Message):
     state = get_user_state(msg.from_user.id)
-    await msg.answer(f"{tr('handle_korneslov_query.query_format_error', msg=msg)}\n\n<code>{json.dumps(state, ensure_ascii=False)}</code>")
+    await msg.answer(f"{tr('handle_korneslov_query.query_format_error', msg=msg)}\n\n<code>{json.dumps(dict(state), ensure_ascii=False)}</code>")
 
@@ -3,6 +3,7 @@ import json
 from aiogram import Router, types
 
 from i18n.messages import tr
+from utils.filters import Button
 from utils.userstate import get_user_state
 from menus.main_menu import main_reply_keyboard
 
@@ -10,7 +11,7 @@ from menus.main_menu import main_reply_keyboard
 router = Router()
 
 
-@router.message(lambda m: m.text == tr("main_menu.language", msg=m))
+@router.message(Button("main_menu.language"))
 async def handle_language_menu(msg: types.Message):
     state = get_user_state(msg.from_user.id)
     current_lang = state.get("lang", "ru")
@@ -26,7 +27,7 @@ async def handle_language_menu(msg: types.Message):
 
 
 ## Now this button probably lost.. No need??
-@router.message(lambda m: m.text == tr("language_menu.english", msg=m))
+@router.message(Button("language_menu.english"))
 async def handle_language_english(msg: types.Message):
     state = get_user_state(msg.from_user.id)
     state["lang"] = "en"
@@ -3,21 +3,23 @@ import json
 from aiogram import Router, types
 
 from i18n.messages import tr
+from utils.filters import Button
 from utils.userstate import get_user_state
 
 
 router = Router()
 
+LEVELS = {
+    "masoret_menu.light": "light",
+    "masoret_menu.smart": "smart",
+    "masoret_menu.hard": "hard",
+}
 
-@router.message(lambda m: m.text in [tr("masoret_menu.light", msg=m), tr("masoret_menu.smart", msg=m), tr("masoret_menu.hard", msg=m)])
-async def handle_level_choice(msg: types.Message):
+
+@router.message(Button(*LEVELS))
+async def handle_level_choice(msg: types.Message, button: str):
     state = get_user_state(msg.from_user.id)
-    level_map = {
-        tr("masoret_menu.light", msg=msg): "light",
-        tr("masoret_menu.smart", msg=msg): "smart",
-        tr("masoret_menu.hard", msg=msg): "hard"
-    }
-    state["level"] = level_map.get(msg.text, "hard")
+    state["level"] = LEVELS.get(button, "hard")
     await msg.answer(
         f"{tr('masoret_menu.level_set', msg=msg)}: {msg.text}",
         parse_mode="HTML"
@@ -1,6 +1,7 @@
 from aiogram import Router, types
 
 from i18n.messages import tr
+from utils.filters import Button
 from menus.main_menu import main_reply_keyboard
 from menus.directions_menu import korneslov_menu
 
@@ -8,12 +9,12 @@ from menus.directions_menu import korneslov_menu
 router = Router()
 
 
-@router.message(lambda m: m.text == tr("korneslov_menu.back_to_main", msg=m))
+@router.message(Button("korneslov_menu.back_to_main"))
 async def handle_back_to_main(msg: types.Message):
     await msg.answer(tr("main_menu.title", msg=msg), reply_markup=main_reply_keyboard(msg=msg))
 
 
-@router.message(lambda m: m.text == tr("masoret_menu.back_to_korneslov", msg=m) or m.text == tr("rishi_menu.back_to_korneslov", msg=m))
+@router.message(Button("masoret_menu.back_to_korneslov", "rishi_menu.back_to_korneslov"))
 async def handle_back_to_korneslov(msg: types.Message):
     await msg.answer(tr("korneslov_menu.title", msg=msg), reply_markup=korneslov_menu(msg=msg))
 
@@ -3,6 +3,7 @@ import json
 from aiogram import Router, types
 
 from i18n.messages import tr
+from utils.filters import Button
 from utils.userstate import get_user_state
 from menus.masoret_menu import masoret_menu
 
@@ -10,7 +11,7 @@ from menus.masoret_menu import masoret_menu
 router = Router()
 
 
-@router.message(lambda m: m.text == tr("korneslov_menu.masoret", msg=m))
+@router.message(Button("korneslov_menu.masoret"))
 async def handle_masoret(msg: types.Message):
     state = get_user_state(msg.from_user.id)
     state["direction"] = "masoret"
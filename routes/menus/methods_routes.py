@@ -3,6 +3,7 @@ import json
 from aiogram import Router, types
 
 from i18n.messages import tr
+from utils.filters import Button
 from utils.userstate import get_user_state
 from menus.directions_menu import korneslov_menu
 
@@ -10,7 +11,7 @@ from menus.directions_menu import korneslov_menu
 router = Router()
 
 
-@router.message(lambda m: m.text == tr("main_menu.korneslov", msg=m))
+@router.message(Button("main_menu.korneslov"))
 async def handle_korneslov(msg: types.Message):
     state = get_user_state(msg.from_user.id)
     state["method"] = "korneslov"
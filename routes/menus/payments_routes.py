@@ -1,6 +1,7 @@
 from aiogram import Router, types
 
 from i18n.messages import tr
+from utils.filters import Button
 from menus.tgpayment_menu import oplata_menu
 from menus.main_menu import main_reply_keyboard
 
@@ -8,12 +9,12 @@ from menus.main_menu import main_reply_keyboard
 router = Router()
 
 
-@router.message(lambda m: m.text == tr("main_menu.payment", msg=m))
+@router.message(Button("main_menu.payment"))
 async def handle_oplata(msg: types.Message):
     await msg.answer(tr("oplata_menu.prompt", msg=msg), reply_markup=oplata_menu(msg=msg))
 
 
-@router.message(lambda m: m.text == tr("oplata_menu.back_to_main", msg=m))
+@router.message(Button("oplata_menu.back_to_main"))
 async def handle_back_to_main_from_oplata(msg: types.Message):
     await msg.answer(tr("main_menu.title", msg=msg), reply_markup=main_reply_keyboard(msg=msg))
 
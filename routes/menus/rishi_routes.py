@@ -3,6 +3,7 @@ import json
 from aiogram import Router, types
 
 from i18n.messages import tr
+from utils.filters import Button
 from utils.userstate import get_user_state
 from menus.rishi_menu import rishi_menu
 
@@ -10,7 +11,7 @@ from menus.rishi_menu import rishi_menu
 router = Router()
 
 
-@router.message(lambda m: m.text == tr("korneslov_menu.rishi", msg=m))
+@router.message(Button("korneslov_menu.rishi"))
 async def handle_rishi(msg: types.Message):
     state = get_user_state(msg.from_user.id)
     state["direction"] = "rishi"
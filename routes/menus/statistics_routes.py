@@ -1,13 +1,14 @@
 from aiogram import Router, types
+from db.stats import get_user_stats
+from utils.filters import Button
 from utils.utils import get_statistics_text
 from utils.userstate import get_user_state
 
 router = Router()
 
 
-## Will be filtered upstream by exact text in the aggregator
-@router.message(lambda m: m.text == "Statistics" or True)  
+@router.message(Button("main_menu.stats"))
 async def handle_statistika(msg: types.Message):
     state = get_user_state(msg.from_user.id)
-    await msg.answer(get_statistics_text(state, msg.from_user.id), parse_mode="HTML")
-
+    user_stats, global_stats = await get_user_stats(msg.from_user.id)
+    await msg.answer(get_statistics_text(user_stats, global_stats, lang=state.get("lang", "ru")), parse_mode="HTML")
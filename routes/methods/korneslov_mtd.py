@@ -1,24 +1,25 @@
 import asyncio
-import re
 import logging
-from itertools import groupby
 
 from aiogram import Router, types
 import aiogram.exceptions as aiogram_exceptions
 
-from config import TGPAYMENT_REQUEST_PRICES
-from utils.safe_send import answer_safe_message
+from config import TGPAYMENT_REQUEST_PRICES, TG_STREAM_OUTPUT, TG_STREAM_EDIT_INTERVAL, TG_STREAM_MESSAGE_LIMIT
+from config import KORNESLOV_FANOUT_ENABLED, KORNESLOV_FANOUT_MIN_VERSES, KORNESLOV_FANOUT_GROUP_SIZE, AI_OUTPUT_FORMAT
+from utils.safe_send import answer_safe_message, StreamingAnswer
 from i18n.messages import tr
-from utils.methods.korneslov_ut import is_valid_korneslov_query, fetch_full_korneslov_response
+from utils.methods.korneslov_ut import is_valid_korneslov_query, fetch_full_korneslov_response, format_verses, split_verse_groups
+from utils.methods.korneslov_cache import build_cache_key, get_cached_answer, record_cache_hit, put_cached_answer, is_cacheable_answer, cached_price, fanout_price
 from utils.utils import split_message
+from utils.tgentities import render_markdown_parts
+from utils.singleflight import singleflight
+from utils.outbox import send_parts
+from services.scheduler import llm_scheduler
 from utils.userstate import get_user_state
 
-from db import get_conn
 from db.books import find_book_entry
-from db.users import upsert_user
-from db.requests import add_request, update_request_response
-from db.responses import add_response
-from db.tgpayments import get_user_amount, set_user_amount
+from db.requests import begin_request, finish_request, update_request_delivery
+from db.responses import add_response, add_response_later
 
 ## Bugfix - kb didnt recover after response.
 from menus.main_menu import main_reply_keyboard
@@ -26,6 +27,90 @@ from menus.main_menu import main_reply_keyboard
 router = Router()
 
 
+async def _generate(book, chapter, verses_str, uid, level, lane, on_delta=None):
+    """
+    One Korneslov generation; returns (answer, meta) so single-flight followers get the meta too.
+    """
+    gen_meta = {}
+    answer = await fetch_full_korneslov_response(
+        book, chapter, verses_str, uid, level=level,
+        on_delta=on_delta, lane=lane, meta=gen_meta
+    )
+    return answer, gen_meta
+
+
+async def _send_answer(message, answer, req_id, req_at, streamer=None):
+    """
+    Hand the answer over to outbox (ordered background delivery with retries, reports `status_tg`).
+    Streamed answer is finalized in place: its preview messages are edited into the final parts.
+    """
+    if AI_OUTPUT_FORMAT == "markdown":
+        ## Rendered locally to text + entities - nothing for Telegram to parse or reject
+        parts = render_markdown_parts(answer)
+    else:
+        ## One pass: <br> normalization, unsupported tags stripping and splitting by visible length
+        parts = split_message(answer)
+    if streamer:
+        ## Replace plain-text preview with final formatted parts
+        try:
+            delivered = await streamer.finish(parts)
+        except Exception:
+            logging.exception(f"Failed to finalize streamed answer of request {req_id}")
+            delivered = False
+        await update_request_delivery(req_id, delivered, req_at)
+    else:
+        ## Safe send: try as HTML, if unsuccessfuly - escaped text. Pace is set by the send rate limiter.
+        send_parts(message, parts, parse_mode="HTML", request_id=req_id, requested_at=req_at)
+
+
+async def _answer_sections(message, req_id, req_at, uid, book_row, book, chapter, groups, level, lang, direction, lane):
+    """
+    Fan-out mode: every verse group is a separate sub-request (cache -> single-flight -> LLM scheduler slot),
+    all of them run concurrently under the global concurrency limit. Sections are sent in verse order:
+    each one as soon as it and all earlier ones are done.
+    Returns (answered, cached): numbers of sections answered (not failed) and of them served from cache.
+    """
+    async def section(group):
+        verses_str = format_verses(group)
+        cache_key = build_cache_key(book_row["id"], chapter, group, level, lang, direction)
+        cached = await get_cached_answer(cache_key)
+        if cached:
+            return cache_key, verses_str, cached["data"], None
+        answer, gen_meta = await singleflight(cache_key, lambda: _generate(book, chapter, verses_str, uid, level, lane))
+        return cache_key, verses_str, answer, gen_meta
+
+    tasks = [asyncio.ensure_future(section(group)) for group in groups]
+    answered = 0
+    cached = 0
+    try:
+        for n, task in enumerate(tasks):
+            try:
+                cache_key, verses_str, answer, gen_meta = await task
+            except Exception:
+                logging.exception(f"Korneslov section of request {req_id} failed")
+                send_parts(message, [tr("handle_korneslov_query.handle_korneslov_query_exception", lang=lang)], request_id=req_id, requested_at=req_at)
+                continue
+            await _send_answer(message, answer, req_id, req_at)
+            if gen_meta is None:
+                await record_cache_hit(cache_key)
+                answered += 1
+                cached += 1
+                continue
+            section_failed = bool(gen_meta.get("error"))
+            answered += not section_failed
+            if not section_failed and is_cacheable_answer(answer, book, chapter, verses_str, lang=lang, meta=gen_meta):
+                ## Cache refers to the response row - its id is needed now
+                response_id = await add_response(req_id, answer, section=n)
+                await put_cached_answer(cache_key, response_id, req_id, answer)
+            else:
+                await add_response_later(req_id, answer, section=n)
+    finally:
+        ## Interrupted - don't leave orphan sections (shared generations keep running for other waiters)
+        for task in tasks:
+            task.cancel()
+    return answered, cached
+
+
 @router.message(is_valid_korneslov_query)
 async def handle_korneslov_query(message: types.Message, refs=None):
     text = message.text or ""
@@ -34,102 +119,134 @@ async def handle_korneslov_query(message: types.Message, refs=None):
     level = state.get("level", "hard")
     lang = state.get("lang", "ru")
 
-    ## Check balance before request generation
-    requests_left = await get_user_amount(uid)
+    ref = refs[0]
+    book = ref["book"]
+    chapter = ref["chapter"]
+    verses = ref["verses"]
+
+    ## Check is book exists in the books catalog
+    row = await find_book_entry(book)
+
+    ## Lookup ready answer in response cache
+    cache_key = None
+    cached = None
+    if row:
+        cache_key = build_cache_key(row["id"], chapter, verses, level, lang, state.get("direction"))
+        cached = await get_cached_answer(cache_key)
+
     price = TGPAYMENT_REQUEST_PRICES.get(level, 1)
-    ## check for unlim
-    if requests_left != -1 and requests_left < price:
-        await message.answer(tr("tgpayment.low_amount", lang=state['lang']))
+    if cached:
+        price = cached_price(price)
+
+    ## Load shedding: reject new generations while the queue is full (nothing is charged)
+    if not cached and llm_scheduler.is_overloaded():
+        logging.warning(f"LLM queue is full ({llm_scheduler.stats()}), rejecting request of user {uid}")
+        await message.answer(tr("handle_korneslov_query.overloaded", lang=lang))
         return
 
-    ## Logging user to DB (upsert)
+    ## Upsert user, reserve credits and save the request - one transaction.
+    ## Reservation is settled by finish_request(): kept on success, refunded on failure. Unknown book costs nothing.
     user = message.from_user
-    await upsert_user(
+    started = await begin_request(
         user_id=user.id,
         firstname=user.first_name,
         lastname=user.last_name,
         username=user.username,
         lang=lang,
-        is_bot=user.is_bot
+        is_bot=user.is_bot,
+        user_state=state.to_dict(),
+        request=text,
+        price=price if row else 0,
+        book_id=row["id"] if row else None
     )
+    if started is None:
+        await message.answer(tr("tgpayment.low_amount", lang=state['lang']))
+        return
+    req_id = started["request_id"]
+    req_at = started["requested_at"]
+    lane = "unlimited" if started["amount"] == -1 else "paid"
 
-    ## Save user request to DB
-    req_id = await add_request(
-        user_id=uid,
-        user_state=state,
-        request=text
-    )
-
-    ref = refs[0]
-    book = ref["book"]
-    chapter = ref["chapter"]
-    verses = ref["verses"]
-
-    ## Check is book exists in the DB
-    async with await get_conn() as conn:
-        row = await find_book_entry(book, conn)
     if not row:
         await message.answer(tr("handle_korneslov_query.book_not_found", book=book, lang=state['lang']))
         ## Refresh status as unsuccessful
-        await update_request_response(req_id, status_oai=False, status_tg=False)
+        await finish_request(req_id, status_oai=False, status_tg=False, requested_at=req_at)
         return
 
     ## Format verses list (ex.: 1-3,5)
-    def group_ranges(lst):
-        ranges = []
-        for k, g in groupby(enumerate(lst), lambda x: x[0] - x[1]):
-            group = list(map(lambda x: x[1], g))
-            if len(group) == 1:
-                ranges.append(str(group[0]))
-            else:
-                ranges.append(f"{group[0]}-{group[-1]}")
-        return ",".join(ranges)
-
     if len(verses) == 1:
         verses_str = str(verses[0])
     else:
-        verses_str = group_ranges(verses)
+        verses_str = format_verses(verses)
+
+    ## Large verse sets are split into small concurrent sub-requests
+    groups = None
+    if KORNESLOV_FANOUT_ENABLED and not cached and len(verses) >= KORNESLOV_FANOUT_MIN_VERSES:
+        groups = split_verse_groups(verses, KORNESLOV_FANOUT_GROUP_SIZE)
+        if len(groups) < 2:
+            groups = None
+
+    ## Show output while it is generated (edits of posted messages)
+    streamer = None
+    if TG_STREAM_OUTPUT and not cached and not groups:
+        streamer = StreamingAnswer(message, edit_interval=TG_STREAM_EDIT_INTERVAL, max_length=TG_STREAM_MESSAGE_LIMIT)
+
+    ## Tell user about queue position and estimated wait
+    if not cached and llm_scheduler.is_busy():
+        position = llm_scheduler.position(uid, lane)
+        wait_min = max(1, round(llm_scheduler.estimated_wait(position) / 60))
+        await answer_safe_message(message, tr("handle_korneslov_query.queued", position=position, wait=wait_min, lang=lang))
 
     try:
-        ## Response generation via Korneslov
-        answer = await fetch_full_korneslov_response(
-            book, chapter, verses_str, uid, level=level
-        )
-
-        for part in split_message(answer):
-            part = re.sub(r'<br.*?>', '', part)
-            ## Safe send: try as HTML, if unsuccessfuly - escaped text
-            await answer_safe_message(message, part, parse_mode="HTML")
-            await asyncio.sleep(2)
-
-        ## Save response in `responses`
-        await add_response(req_id, answer)
-        ## Refresh status as successful
-        await update_request_response(req_id, status_oai=True, status_tg=True)
-
-        ## Decrement credits if not unlim and if success
-        requests_left = await get_user_amount(uid)
-        if requests_left != -1 and requests_left >= price:
-            updated = await set_user_amount(uid, -price, str(req_id))
-            logging.info(f"New user balance for user {uid} — {requests_left - price}")
-
-        ## Bugfix - kb didnt recover after response.
-        try:
-            await message.answer(
-                tr("main_menu.welcome", lang=lang),
-                reply_markup=main_reply_keyboard(msg=message)
+        if groups:
+            ## Sections are sent and stored as they complete
+            answered, cached_sections = await _answer_sections(
+                message, req_id, req_at, uid, row, book, chapter, groups, level, lang, state.get("direction"), lane
             )
-        except Exception:
-            logging.exception("Failed to send main menu keyboard after AI response")
+            ## Answered sections are charged (see fanout_price), failed ones are refunded.
+            ## Request is successful if any section was answered.
+            charged = fanout_price(price, len(groups), answered, cached_sections)
+            await finish_request(req_id, status_oai=answered > 0, price=charged, requested_at=req_at)
+        elif cached:
+            failed = False
+            answer = cached["data"]
+            logging.info(f"Response cache hit for request {req_id}: response {cached['response_id']} of request {cached['request_id']}")
+            await _send_answer(message, answer, req_id, req_at)
+            await record_cache_hit(cache_key)
+            ## Answer is already stored - just refer to it
+            await finish_request(req_id, status_oai=True, cached_response_id=cached["response_id"], requested_at=req_at)
+        else:
+            ## Response generation via Korneslov. Identical concurrent requests share one generation.
+            answer, gen_meta = await singleflight(
+                cache_key,
+                lambda: _generate(book, chapter, verses_str, uid, level, lane, on_delta=streamer.feed if streamer else None)
+            )
+            ## Provider error text: show it, but don't charge and don't cache
+            failed = bool(gen_meta.get("error"))
+            await _send_answer(message, answer, req_id, req_at, streamer)
+            ## Save response in `responses`: at once if the cache will refer to it, else in background
+            if not failed and is_cacheable_answer(answer, book, chapter, verses_str, lang=lang, meta=gen_meta):
+                response_id = await add_response(req_id, answer)
+                await put_cached_answer(cache_key, response_id, req_id, answer)
+            else:
+                await add_response_later(req_id, answer)
+            ## Refresh status (successful unless provider failed) and settle credits; `status_tg` is reported by delivery
+            await finish_request(req_id, status_oai=not failed, requested_at=req_at)
+
+        ## Bugfix - kb didnt recover after response. Queued after the answer parts to keep the order.
+        send_parts(message, [tr("main_menu.welcome", lang=lang)], reply_markup=main_reply_keyboard(msg=message))
 
     except aiogram_exceptions.TelegramBadRequest as e:
         ## If we have troubles with HTML parsing during parts send - log and send fallback
         logging.exception("TelegramBadRequest while sending Korneslov response: %s", e)
-        await update_request_response(req_id, status_oai=False, status_tg=False)
+        await finish_request(req_id, status_oai=False, status_tg=False, requested_at=req_at)
         await answer_safe_message(message, tr("handle_korneslov_query.handle_korneslov_query_exception", lang=state['lang']))
     except Exception as e:
         logging.exception("Error while processing Korneslov query: %s", e)
         ## Refresh status as error
-        await update_request_response(req_id, status_oai=False, status_tg=False)
+        await finish_request(req_id, status_oai=False, status_tg=False, requested_at=req_at)
         ## Error msg send safe also!!
         await answer_safe_message(message, tr("handle_korneslov_query.handle_korneslov_query_exception", lang=state['lang']))
+    finally:
+        if streamer:
+            ## Stops the preview flush task also when finish() wasn't reached
+            await streamer.close()
@@ -1,7 +1,180 @@
+import asyncio
 import logging
+import time
+from collections import deque
 from typing import Optional
 
-from config import AI_PROVIDER
+from config import (
+    AI_PROVIDER,
+    OPENAI_MODEL,
+    GEMINI_MODEL,
+    OPENAI_API_KEY,
+    GEMINI_API_KEY,
+    AI_HEDGE_ENABLED,
+    AI_HEDGE_PERCENTILE,
+    AI_HEDGE_MIN_DELAY,
+    AI_HEDGE_MIN_SAMPLES,
+    AI_HEDGE_MAX_PER_MINUTE,
+    AI_HEDGE_MAX_RATIO,
+    AI_CB_WINDOW_SECONDS,
+    AI_CB_MIN_CALLS,
+    AI_CB_ERROR_RATE,
+    AI_CB_COOLDOWN_SECONDS,
+    AI_CB_SLOW_CALL_SECONDS,
+)
+from i18n.messages import tr
+from utils.userstate import get_user_state
+from utils.metrics import register_metrics
+from services.provider_health import ProviderHealth, percentile
+
+
+PROVIDERS = ("openai", "gemini")
+
+## Recent latencies per provider, seconds: full result and time to first streamed piece
+_latencies = {p: deque(maxlen=100) for p in PROVIDERS}
+_first_piece_latencies = {p: deque(maxlen=100) for p in PROVIDERS}
+
+## Timestamps of calls and of hedged (duplicate) calls per provider - hedging budget over last minute
+_calls = {p: deque() for p in PROVIDERS}
+_hedges = {p: deque() for p in PROVIDERS}
+
+
+_health = {
+    p: ProviderHealth(
+        p,
+        window=AI_CB_WINDOW_SECONDS,
+        min_calls=AI_CB_MIN_CALLS,
+        error_rate=AI_CB_ERROR_RATE,
+        cooldown=AI_CB_COOLDOWN_SECONDS,
+        slow_call=AI_CB_SLOW_CALL_SECONDS,
+    )
+    for p in PROVIDERS
+}
+
+
+def get_providers_health():
+    """
+    Metrics surface: circuit state, error rate and latency percentiles per provider.
+    """
+    return {p: h.snapshot() for p, h in _health.items()}
+
+
+register_metrics("ai_providers", get_providers_health)
+
+
+def get_provider_model():
+    """
+    Return (provider, model) pair that ask_ai() currently uses.
+    """
+    provider = (AI_PROVIDER or "openai").lower()
+    if provider == "gemini":
+        return provider, GEMINI_MODEL
+    return "openai", OPENAI_MODEL
+
+
+def _route():
+    """
+    Return (primary, secondary) providers. Secondary is None if it is not configured.
+    Providers with open circuit are skipped: secondary takes the lead, or primary is None if none is available.
+    """
+    primary, _ = get_provider_model()
+    secondary = "openai" if primary == "gemini" else "gemini"
+    keys = {"openai": OPENAI_API_KEY, "gemini": GEMINI_API_KEY}
+    if not keys.get(secondary):
+        secondary = None
+    available = [p for p in (primary, secondary) if p and _health[p].available()]
+    if not available:
+        return None, None
+    return available[0], (available[1] if len(available) > 1 else None)
+
+
+def _hedge_delay(provider, first_piece=False):
+    """
+    Seconds to wait for primary provider before firing the secondary one, or None if hedging is off
+    (disabled in config or not enough latency samples yet).
+    """
+    if not AI_HEDGE_ENABLED:
+        return None
+    samples = (_first_piece_latencies if first_piece else _latencies)[provider]
+    if len(samples) < AI_HEDGE_MIN_SAMPLES:
+        return None
+    return max(AI_HEDGE_MIN_DELAY, percentile(samples, AI_HEDGE_PERCENTILE))
+
+
+def _prune(stamps, now, window=60.0):
+    while stamps and now - stamps[0] > window:
+        stamps.popleft()
+
+
+def _record_call(provider):
+    ## Pruned on every call too - budget is checked only when hedging is enabled, the deque must not grow anyway
+    now = time.monotonic()
+    _calls[provider].append(now)
+    _prune(_calls[provider], now)
+
+
+def _take_hedge_budget(primary, secondary):
+    """
+    Per-provider hedging budget over last minute: at most AI_HEDGE_MAX_PER_MINUTE hedged calls
+    to `secondary`, and not more than AI_HEDGE_MAX_RATIO of calls made to `primary`.
+    """
+    now = time.monotonic()
+    calls, hedges = _calls[primary], _hedges[secondary]
+    _prune(calls, now)
+    _prune(hedges, now)
+    if len(hedges) >= AI_HEDGE_MAX_PER_MINUTE:
+        return False
+    if len(hedges) + 1 > AI_HEDGE_MAX_RATIO * len(calls):
+        return False
+    hedges.append(now)
+    return True
+
+
+def _error_text(uid, book, chapter, verse, test_banner=""):
+    lang = get_user_state(uid).get("lang", "ru")
+    return (
+        tr("korneslov_py.ask_openai_exception_return", book=book, chapter=chapter, verse=verse, lang=lang)
+        + (f"\n{test_banner}" if test_banner else "")
+    )
+
+
+async def _ask_provider(provider, uid, book, chapter, verse, system_prompt=None, followup=None, test_banner="", history=None):
+    """
+    Call one provider; raises on failure. Records latency (also of cancelled calls - as lower bound)
+    and outcome for the circuit breaker. Returns (text, meta) - meta of this call only, so a hedged loser
+    can't overwrite the winner's one.
+    """
+    meta = {"provider": provider}
+    health = _health[provider]
+    if not health.acquire():
+        raise RuntimeError(f"AI provider {provider}: circuit is open")
+    _record_call(provider)
+    t0 = time.monotonic()
+    try:
+        if provider == "gemini":
+            from services.gemini_srv import ask_gemini
+            result = await ask_gemini(uid, book, chapter, verse, system_prompt=system_prompt, test_banner=test_banner, followup=followup, raise_errors=True, history=history, meta=meta)
+        else:
+            from services.openai_srv import ask_openai
+            result = await ask_openai(uid, book, chapter, verse, system_prompt=system_prompt, test_banner=test_banner, followup=followup, raise_errors=True, history=history, meta=meta)
+    except asyncio.CancelledError:
+        ## Hedging loser: elapsed time is a lower bound of its latency
+        _latencies[provider].append(time.monotonic() - t0)
+        health.release()
+        raise
+    except Exception:
+        health.record(False)
+        raise
+    latency = time.monotonic() - t0
+    _latencies[provider].append(latency)
+    health.record(True, latency)
+    return result, meta
+
+
+async def _cancel(tasks):
+    for t in tasks:
+        t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
 
 
 async def ask_ai(
@@ -12,21 +185,178 @@ async def ask_ai(
     system_prompt: Optional[str] = None,
     followup: Optional[str] = None,
     test_banner: str = "",
+    history: Optional[list] = None,
+    meta: Optional[dict] = None,
 ) -> str:
     """
-    Provider dispatcher: routes to OpenAI or Gemini service based on AI_PROVIDER.
+    Provider dispatcher: routes to OpenAI or Gemini service based on AI_PROVIDER,
+    falling back to the other provider (if configured) when the primary one fails.
+    With AI_HEDGE_ENABLED the secondary provider is also fired when the primary one is slower than
+    AI_HEDGE_PERCENTILE of its recent latency; first result wins, the other call is cancelled.
+    `history` is passed to the provider (continuation turns); `meta` dict gets the winner's "provider",
+    raw "text" and "finish_reason", or "error": True if error text is returned.
     Returns formatted string suitable for sending to Telegram.
     """
-    provider = (AI_PROVIDER or "openai").lower()
+    if meta is None:
+        meta = {}
+    primary, secondary = _route()
+    if primary is None:
+        ## Every circuit is open - fail fast instead of waiting for another timeout
+        logging.error(f"No AI provider available: {get_providers_health()}")
+        meta["error"] = True
+        return _error_text(uid, book, chapter, verse, test_banner)
+    args = (uid, book, chapter, verse)
+    kwargs = dict(system_prompt=system_prompt, followup=followup, test_banner=test_banner, history=history)
+
+    tasks = {asyncio.ensure_future(_ask_provider(primary, *args, **kwargs)): primary}
+    started = {primary}
+    delay = _hedge_delay(primary) if secondary else None
+    try:
+        while tasks:
+            hedge_pending = delay is not None and secondary not in started
+            done, _ = await asyncio.wait(tasks.keys(), timeout=delay if hedge_pending else None, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                ## Primary is slow - hedge with secondary if budget allows
+                delay = None
+                if _health[secondary].available() and _take_hedge_budget(primary, secondary):
+                    logging.info(f"Hedging {primary} request with {secondary}")
+                    tasks[asyncio.ensure_future(_ask_provider(secondary, *args, **kwargs))] = secondary
+                    started.add(secondary)
+                continue
+            for t in done:
+                provider = tasks.pop(t)
+                if t.exception() is None:
+                    result, call_meta = t.result()
+                    meta.update(call_meta)
+                    return result
+                logging.error(f"{provider} provider failed: {t.exception()!r}")
+                if secondary and secondary not in started:
+                    logging.warning(f"Falling back from {provider} to {secondary}")
+                    tasks[asyncio.ensure_future(_ask_provider(secondary, *args, **kwargs))] = secondary
+                    started.add(secondary)
+        meta["error"] = True
+        return _error_text(uid, book, chapter, verse, test_banner)
+    finally:
+        await _cancel(list(tasks))
 
+
+def _stream_provider(provider, uid, book, chapter, verse, system_prompt=None, followup=None, history=None, meta=None):
     if provider == "gemini":
-        try:
-            from services.gemini_srv import ask_gemini
-            return await ask_gemini(uid, book, chapter, verse, system_prompt=system_prompt, test_banner=test_banner, followup=followup)
-        except Exception:
-            logging.exception("Gemini provider failed, falling back to OpenAI")
-            ## fall through to OpenAI
-
-    ## default / fallback: OpenAI
-    from services.openai_srv import ask_openai
-    return await ask_openai(uid, book, chapter, verse, system_prompt=system_prompt, test_banner=test_banner, followup=followup)
+        from services.gemini_srv import stream_gemini
+        return stream_gemini(uid, book, chapter, verse, system_prompt=system_prompt, followup=followup, history=history, meta=meta)
+    from services.openai_srv import stream_openai
+    return stream_openai(uid, book, chapter, verse, system_prompt=system_prompt, followup=followup, raise_errors=True, history=history, meta=meta)
+
+
+async def ask_ai_stream(
+    uid: int,
+    book: str,
+    chapter: int,
+    verse: str,
+    system_prompt: Optional[str] = None,
+    followup: Optional[str] = None,
+    history: Optional[list] = None,
+    meta: Optional[dict] = None,
+):
+    """
+    Streaming provider dispatcher: async generator of text pieces as they are generated.
+    Concatenated pieces are the same formatted string as ask_ai() returns.
+    Fallback and hedging work like in ask_ai(), but are decided by the first streamed piece.
+    `meta` is filled like in ask_ai() when the stream is exhausted.
+    """
+    if meta is None:
+        meta = {}
+    primary, secondary = _route()
+    if primary is None:
+        logging.error(f"No AI provider available: {get_providers_health()}")
+        meta["error"] = True
+        yield _error_text(uid, book, chapter, verse)
+        return
+    args = (uid, book, chapter, verse)
+    kwargs = dict(system_prompt=system_prompt, followup=followup, history=history)
+
+    gens = {}
+    metas = {}
+    tasks = {}
+    t0 = {}
+
+    def start(provider):
+        gens[provider] = None
+        if not _health[provider].acquire():
+            return
+        _record_call(provider)
+        metas[provider] = {"provider": provider}
+        gen = _stream_provider(provider, *args, meta=metas[provider], **kwargs)
+        gens[provider] = gen
+        t0[provider] = time.monotonic()
+        tasks[asyncio.ensure_future(gen.__anext__())] = provider
+
+    start(primary)
+    if not tasks and secondary:
+        ## Primary half-open probe was taken by a concurrent call
+        start(secondary)
+    delay = _hedge_delay(primary, first_piece=True) if secondary else None
+    winner = None
+    first_piece = None
+    try:
+        while tasks and winner is None:
+            hedge_pending = delay is not None and secondary not in gens
+            done, _ = await asyncio.wait(tasks.keys(), timeout=delay if hedge_pending else None, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                ## No first piece from primary yet - hedge with secondary if budget allows
+                delay = None
+                if _health[secondary].available() and _take_hedge_budget(primary, secondary):
+                    logging.info(f"Hedging {primary} stream with {secondary}")
+                    start(secondary)
+                continue
+            for t in done:
+                provider = tasks.pop(t)
+                if t.exception() is None:
+                    winner, first_piece = provider, t.result()
+                    _first_piece_latencies[provider].append(time.monotonic() - t0[provider])
+                    break
+                _health[provider].record(False)
+                logging.error(f"{provider} stream failed: {t.exception()!r}")
+                if secondary and secondary not in gens:
+                    logging.warning(f"Falling back from {provider} to {secondary}")
+                    start(secondary)
+    finally:
+        ## Cancel the loser(s)
+        for t, provider in tasks.items():
+            _health[provider].release()
+        await _cancel(list(tasks))
+        for provider, gen in gens.items():
+            if gen is not None and provider != winner:
+                try:
+                    await gen.aclose()
+                except Exception:
+                    pass
+
+    if winner is None:
+        meta["error"] = True
+        yield _error_text(uid, book, chapter, verse)
+        return
+
+    ## Outcome is recorded once, when the stream ends: providers report a stream broken after the first
+    ## piece only as finish_reason "error". Recorded before the caller sees the end of the stream,
+    ## so a continuation is already routed by the updated health.
+    health = _health[winner]
+    ok = None
+    try:
+        yield first_piece
+        async for piece in gens[winner]:
+            yield piece
+        ok = metas[winner].get("finish_reason") != "error"
+    except Exception:
+        ok = False
+        raise
+    finally:
+        latency = time.monotonic() - t0[winner]
+        if ok is None:
+            ## Reader stopped (cancelled) - no outcome
+            health.release()
+        else:
+            health.record(ok, latency)
+            if ok:
+                _latencies[winner].append(latency)
+    meta.update(metas[winner])
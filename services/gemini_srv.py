@@ -10,13 +10,16 @@ from config import (
     GEMINI_MODEL,
     GEMINI_TEMPERATURE,
     GEMINI_MAX_OUTPUT_TOKENS_CAP,
+    AI_OUTPUT_FORMAT,
 )
 from i18n.messages import tr
 from texts.prompts import KORNESLOV_USER_PROMPT
 from utils.userstate import get_user_state
 from utils.gemini_ut import (
     extract_text_from_gemini_response,
+    extract_finish_reason_from_gemini_response,
     build_gemini_config,
+    build_gemini_contents,
     sanitize_for_telegram_html,
 )
 
@@ -44,6 +47,9 @@ async def ask_gemini(
     system_prompt: Optional[str] = None,
     test_banner: str = "",
     followup: Optional[str] = None,
+    raise_errors: bool = False,
+    history: Optional[list] = None,
+    meta: Optional[dict] = None,
 ) -> str:
     """
     Perform Gemini chat generation and return formatted text:
@@ -52,12 +58,19 @@ async def ask_gemini(
     NOTE:
     - system_prompt should be provided by caller (already built upstream).
     - followup replaces user content if provided.
+    - history: prior turns ({"role", "content"}) sent between the user request and followup (continuation).
+    - meta: optional dict, filled with raw "text" and normalized "finish_reason" ("stop", "length", ...).
     - Single-attempt strategy; streaming can be enabled via GEMINI_USE_STREAMING.
+    - raise_errors=True propagates failures instead of returning error text (used by ai_provider routing).
     """
     state = get_user_state(uid)
     lang = state.get("lang", "ru")
 
     if not GEMINI_API_KEY:
+        if raise_errors:
+            raise RuntimeError("GEMINI_API_KEY is not set")
+        if meta is not None:
+            meta["error"] = True
         return tr(
             "korneslov_py.ask_openai_no_OPENAI_API_KEY",
             book=book,
@@ -70,11 +83,11 @@ async def ask_gemini(
     if not system_prompt:
         logging.warning("gemini_srv.ask_gemini called without system_prompt; behavior may differ.")
 
-    if followup:
-        user_content = followup
-    else:
-        user_prompt_template = KORNESLOV_USER_PROMPT.get(lang, KORNESLOV_USER_PROMPT["ru"])
-        user_content = user_prompt_template.format(book=book, chapter=chapter, verse=verse)
+    user_prompt_template = KORNESLOV_USER_PROMPT.get(lang, KORNESLOV_USER_PROMPT["ru"])
+    user_content = user_prompt_template.format(book=book, chapter=chapter, verse=verse)
+    contents = build_gemini_contents(user_content, history=history, followup=followup)
+    ## Last user turn - for request logging below
+    user_content = followup or user_content
 
     client = _get_client()
 
@@ -125,12 +138,13 @@ async def ask_gemini(
         text = ""
         prompt_tokens = None
         total_tokens = None
+        finish_reason = ""
 
         if GEMINI_USE_STREAMING:
-            print("GEMINI STREAMING: enabled — using generate_content_stream()")
+            print("GEMINI STREAMING: enabled — using aio generate_content_stream()")
             t0 = time.time()
-            text, prompt_tokens, total_tokens = _stream_and_collect(
-                client, model=GEMINI_MODEL, config=config, contents=user_content
+            text, prompt_tokens, total_tokens, finish_reason = await _stream_and_collect(
+                client, model=GEMINI_MODEL, config=config, contents=contents
             )
             t1 = time.time()
             print(
@@ -141,17 +155,25 @@ async def ask_gemini(
                 print("GEMINI STREAM: empty accumulated text — falling back to non-stream call")
 
         if not text:
-            print("GEMINI NON-STREAM: calling generate_content()")
-            response = client.models.generate_content(
-                model=GEMINI_MODEL, config=config, contents=user_content
+            print("GEMINI NON-STREAM: calling aio generate_content()")
+            ## Async client - generation must not block the event loop (dispatcher, other users)
+            response = await client.aio.models.generate_content(
+                model=GEMINI_MODEL, config=config, contents=contents
             )
             text = extract_text_from_gemini_response(response)
+            finish_reason = extract_finish_reason_from_gemini_response(response)
             usage = getattr(response, "usage_metadata", None)
             prompt_tokens = getattr(usage, "prompt_token_count", None) if usage else None
             total_tokens = getattr(usage, "total_token_count", None) if usage else None
 
-        ## Sanitize unsupported Telegram-HTML tags to reduce parse errors
-        text = sanitize_for_telegram_html(text or "")
+        ## Sanitize unsupported Telegram-HTML tags to reduce parse errors. Markdown answers are rendered
+        ## to plain text + entities, escaping would show up as literal "&amp;" / "&lt;"
+        text = text or ""
+        if AI_OUTPUT_FORMAT != "markdown":
+            text = sanitize_for_telegram_html(text)
+        if meta is not None:
+            meta["text"] = text
+            meta["finish_reason"] = finish_reason
 
         try:
             completion_tokens = (
@@ -175,36 +197,45 @@ async def ask_gemini(
         return f"""{tr("korneslov_py.ask_openai_return", lang=lang)}: {book} {chapter} {verse}\n<br><br>{text}{f'\n{test_banner}' if test_banner else ''}"""
     except Exception:
         logging.exception("Gemini request failed")
+        if raise_errors:
+            raise
+        if meta is not None:
+            meta["error"] = True
         return (
             tr("korneslov_py.ask_openai_exception_return", book=book, chapter=chapter, verse=verse, lang=lang)
             + (f"\n{test_banner}" if test_banner else "")
         )
 
 
-def _stream_and_collect(
+async def _stream_and_collect(
     client: genai.Client,
     model: str,
     config: Optional[genai_types.GenerateContentConfig],
-    contents: str,
+    contents,
 ):
     """
-    Streaming path: generate_content_stream and collect chunk.text.
-    Returns (text, prompt_tokens, total_tokens).
+    Streaming path: async generate_content_stream and collect chunk.text.
+    Returns (text, prompt_tokens, total_tokens, finish_reason).
     """
     acc: List[str] = []
     prompt_tokens = None
     total_tokens = None
+    finish_reason = ""
 
     try:
         print("GEMINI STREAM: start")
-        stream = client.models.generate_content_stream(
+        stream = await client.aio.models.generate_content_stream(
             model=model, config=config, contents=contents
         )
         chunks = 0
         acc_len = 0
+        usage = None
         t0 = time.time()
-        for chunk in stream:
+        async for chunk in stream:
             chunks += 1
+            ## usage metadata comes with the chunks (final one has the totals)
+            usage = getattr(chunk, "usage_metadata", None) or usage
+            finish_reason = extract_finish_reason_from_gemini_response(chunk) or finish_reason
             try:
                 if hasattr(chunk, "text") and isinstance(chunk.text, str) and chunk.text:
                     acc.append(chunk.text)
@@ -218,9 +249,8 @@ def _stream_and_collect(
                 ## ignore malformed chunks
                 pass
 
-        ## usage from final stream response if available
+        ## usage from final stream chunk if available
         try:
-            usage = getattr(stream, "usage_metadata", None)
             prompt_tokens = getattr(usage, "prompt_token_count", None) if usage else None
             total_tokens = getattr(usage, "total_token_count", None) if usage else None
         except Exception:
@@ -232,6 +262,73 @@ def _stream_and_collect(
         )
     except Exception:
         logging.exception("Gemini stream failed")
+        finish_reason = "error"
 
     text = "".join(acc).strip()
-    return text, prompt_tokens, total_tokens
+    return text, prompt_tokens, total_tokens, finish_reason
+
+
+async def stream_gemini(
+    uid: int,
+    book: str,
+    chapter: int,
+    verse: str,
+    system_prompt: Optional[str] = None,
+    followup: Optional[str] = None,
+    history: Optional[list] = None,
+    meta: Optional[dict] = None,
+):
+    """
+    Streaming variant of ask_gemini(): async generator of text pieces.
+    Concatenation of all pieces gives the same formatted text as ask_gemini() returns (before sanitizing).
+    Raises if request failed before anything was streamed, so the caller may fall back to another provider.
+    `meta` is filled like in ask_gemini(); a stream broken after the first piece gets finish_reason "error".
+    """
+    state = get_user_state(uid)
+    lang = state.get("lang", "ru")
+
+    if not GEMINI_API_KEY:
+        raise RuntimeError("GEMINI_API_KEY is not set")
+
+    user_prompt_template = KORNESLOV_USER_PROMPT.get(lang, KORNESLOV_USER_PROMPT["ru"])
+    user_content = user_prompt_template.format(book=book, chapter=chapter, verse=verse)
+    contents = build_gemini_contents(user_content, history=history, followup=followup)
+    user_content = followup or user_content
+
+    config = build_gemini_config(
+        max_output_tokens=GEMINI_MAX_OUTPUT_TOKENS_CAP,
+        temperature=GEMINI_TEMPERATURE,
+        system_instruction=system_prompt or "",
+    )
+
+    client = _get_client()
+    header_sent = False
+    acc = []
+    acc_len = 0
+    finish_reason = ""
+    try:
+        print("GEMINI STREAM REQUEST:", {"model": GEMINI_MODEL, "user_content_preview": (user_content[:100] + "...") if len(user_content) > 100 else user_content})
+        stream = await client.aio.models.generate_content_stream(
+            model=GEMINI_MODEL, config=config, contents=contents
+        )
+        async for chunk in stream:
+            finish_reason = extract_finish_reason_from_gemini_response(chunk) or finish_reason
+            delta = getattr(chunk, "text", None)
+            if not isinstance(delta, str) or not delta:
+                continue
+            if not header_sent:
+                header_sent = True
+                yield f"{tr('korneslov_py.ask_openai_return', lang=lang)}: {book} {chapter} {verse}\n<br><br>"
+            acc.append(delta)
+            acc_len += len(delta)
+            yield delta
+        print(f"GEMINI STREAM: done, acc_len={acc_len}, finish_reason={finish_reason}")
+    except Exception:
+        logging.exception("Gemini stream failed")
+        finish_reason = "error"
+        if not header_sent:
+            raise
+    finally:
+        if meta is not None:
+            meta["text"] = "".join(acc)
+            meta["finish_reason"] = finish_reason
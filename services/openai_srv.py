@@ -7,7 +7,7 @@ from config import get_model_and_params, OPENAI_API_KEY
 from i18n.messages import tr
 from texts.prompts import KORNESLOV_USER_PROMPT
 from utils.userstate import get_user_state
-from utils.openai_ut import extract_text_from_openai_response
+from utils.openai_ut import extract_text_from_openai_response, extract_finish_reason_from_openai_response
 
 
 ## DUMMY then `DUMMY_TEXT = True`
@@ -28,6 +28,22 @@ def dummy_openai_response_2DEL(book, chapter, verse, test_banner="", followup=No
 _client = None
 
 
+def _build_messages(system_prompt, user_prompt, followup=None, history=None):
+    """
+    Chat messages: system + user prompt, or (for continuations) system + user prompt + prior turns + followup.
+    Without history the followup replaces the user prompt.
+    """
+    messages = [{"role": "system", "content": system_prompt or ""}]
+    if history:
+        messages.append({"role": "user", "content": user_prompt})
+        messages += [{"role": m["role"], "content": m["content"]} for m in history]
+        if followup:
+            messages.append({"role": "user", "content": followup})
+    else:
+        messages.append({"role": "user", "content": followup or user_prompt})
+    return messages
+
+
 def _get_client():
     global _client
     if _client is None:
@@ -35,7 +51,7 @@ def _get_client():
     return _client
 
 
-async def ask_openai(uid, book, chapter, verse, system_prompt=None, test_banner="", followup=None):
+async def ask_openai(uid, book, chapter, verse, system_prompt=None, test_banner="", followup=None, raise_errors=False, history=None, meta=None):
     """
     Perform OpenAI Chat Completion and return formatted text:
     'Korneslov: {book} {chapter} {verse}\\n<br><br>{text}{optional test banner}'.
@@ -43,6 +59,9 @@ async def ask_openai(uid, book, chapter, verse, system_prompt=None, test_banner=
     NOTE:
     - system_prompt must be provided by caller (kept universal; building is outside).
     - followup replaces the user request if provided.
+    - history: prior turns ({"role", "content"}) sent between the user request and followup (continuation).
+    - meta: optional dict, filled with raw "text" and normalized "finish_reason" ("stop", "length", ...).
+    - raise_errors=True propagates failures instead of returning error text (used by ai_provider routing).
     """
     state = get_user_state(uid)
     lang = state.get("lang", "ru")
@@ -52,6 +71,10 @@ async def ask_openai(uid, book, chapter, verse, system_prompt=None, test_banner=
         return dummy_openai_response_2DEL(book, chapter, verse, test_banner, followup, dummy_text[lang])
 
     if not OPENAI_API_KEY:
+        if raise_errors:
+            raise RuntimeError("OPENAI_API_KEY is not set")
+        if meta is not None:
+            meta["error"] = True
         return tr(
             "korneslov_py.ask_openai_no_OPENAI_API_KEY",
             book=book,
@@ -65,21 +88,17 @@ async def ask_openai(uid, book, chapter, verse, system_prompt=None, test_banner=
         ## Caller should build system_prompt upstream (utils/methods/korneslov_ut.py)
         logging.warning("openai_srv.ask_openai called without system_prompt; behavior may differ.")
 
-    if followup:
-        user_prompt = followup
-    else:
-        user_prompt_template = KORNESLOV_USER_PROMPT.get(lang, KORNESLOV_USER_PROMPT["ru"])
-        user_prompt = user_prompt_template.format(book=book, chapter=chapter, verse=verse)
+    user_prompt_template = KORNESLOV_USER_PROMPT.get(lang, KORNESLOV_USER_PROMPT["ru"])
+    user_prompt = user_prompt_template.format(book=book, chapter=chapter, verse=verse)
 
     model, extra_params = get_model_and_params()
     params = dict(
         model=model,
-        messages=[
-            {"role": "system", "content": system_prompt or ""},
-            {"role": "user", "content": user_prompt}
-        ],
+        messages=_build_messages(system_prompt, user_prompt, followup=followup, history=history),
         n=1,
     )
+    ## Last user turn - for request logging below
+    user_prompt = followup or user_prompt
     params.update(extra_params or {})
 
     client = _get_client()
@@ -91,6 +110,9 @@ async def ask_openai(uid, book, chapter, verse, system_prompt=None, test_banner=
 
         ## Extract text robustly
         text = extract_text_from_openai_response(response)
+        if meta is not None:
+            meta["text"] = text
+            meta["finish_reason"] = extract_finish_reason_from_openai_response(response)
 
         ## Debug usage logging
         try:
@@ -116,7 +138,78 @@ async def ask_openai(uid, book, chapter, verse, system_prompt=None, test_banner=
         return f"""{tr("korneslov_py.ask_openai_return", lang=lang)}: {book} {chapter} {verse}\n<br><br>{text}{f'\n{test_banner}' if test_banner else ''}"""
     except Exception:
         logging.exception(tr("korneslov_py.ask_openai_exception_logging", lang=lang))
+        if raise_errors:
+            raise
+        if meta is not None:
+            meta["error"] = True
         return (
             tr("korneslov_py.ask_openai_exception_return", book=book, chapter=chapter, verse=verse, lang=lang) +
             (f"\n{test_banner}" if test_banner else "")
         )
+
+
+async def stream_openai(uid, book, chapter, verse, system_prompt=None, followup=None, raise_errors=False, history=None, meta=None):
+    """
+    Streaming variant of ask_openai(): async generator of text pieces.
+    Concatenation of all pieces gives the same formatted text as ask_openai() returns.
+    With raise_errors=True a failure before the first piece is raised instead of yielding error text.
+    `meta` is filled like in ask_openai(); a stream broken after the first piece gets finish_reason "error".
+    """
+    state = get_user_state(uid)
+    lang = state.get("lang", "ru")
+
+    if DUMMY_TEXT or not OPENAI_API_KEY:
+        yield await ask_openai(uid, book, chapter, verse, system_prompt=system_prompt, followup=followup, raise_errors=raise_errors, history=history, meta=meta)
+        return
+
+    user_prompt_template = KORNESLOV_USER_PROMPT.get(lang, KORNESLOV_USER_PROMPT["ru"])
+    user_prompt = user_prompt_template.format(book=book, chapter=chapter, verse=verse)
+
+    model, extra_params = get_model_and_params()
+    params = dict(
+        model=model,
+        messages=_build_messages(system_prompt, user_prompt, followup=followup, history=history),
+        n=1,
+        stream=True,
+    )
+    params.update(extra_params or {})
+    ## Last user turn - for request logging below
+    user_prompt = followup or user_prompt
+
+    client = _get_client()
+    header_sent = False
+    acc = []
+    acc_len = 0
+    finish_reason = ""
+    try:
+        print("OPENAI STREAM REQUEST:", {"model": model, "user_content_preview": (user_prompt[:100] + "...") if len(user_prompt) > 100 else user_prompt})
+        stream = await client.chat.completions.create(**params)
+        async for chunk in stream:
+            choices = getattr(chunk, "choices", None)
+            if not choices:
+                continue
+            finish_reason = getattr(choices[0], "finish_reason", None) or finish_reason
+            delta = getattr(choices[0].delta, "content", None)
+            if not delta:
+                continue
+            if not header_sent:
+                header_sent = True
+                yield f"{tr('korneslov_py.ask_openai_return', lang=lang)}: {book} {chapter} {verse}\n<br><br>"
+            acc.append(delta)
+            acc_len += len(delta)
+            yield delta
+        print(f"OPENAI STREAM: done, acc_len={acc_len}, finish_reason={finish_reason}")
+    except Exception:
+        logging.exception(tr("korneslov_py.ask_openai_exception_logging", lang=lang))
+        finish_reason = "error"
+        ## Nothing was streamed yet - report error like ask_openai() does; otherwise keep the partial answer
+        if not header_sent:
+            if raise_errors:
+                raise
+            yield tr("korneslov_py.ask_openai_exception_return", book=book, chapter=chapter, verse=verse, lang=lang)
+            if meta is not None:
+                meta["error"] = True
+    finally:
+        if meta is not None:
+            meta["text"] = "".join(acc)
+            meta["finish_reason"] = str(finish_reason or "").lower()
@@ -0,0 +1,105 @@
+import logging
+import time
+from collections import deque
+
+
+def percentile(values, q):
+    """Nearest-rank `q` quantile (0..1) of non-empty `values`."""
+    data = sorted(values)
+    idx = min(len(data) - 1, max(0, int(round(q * (len(data) - 1)))))
+    return data[idx]
+
+
+class ProviderHealth:
+    """
+    Rolling error-rate/latency window of one provider with circuit breaker:
+    - closed: calls pass; opens when error rate over the window reaches `error_rate` (after `min_calls`);
+    - open: calls are skipped until `cooldown` seconds passed;
+    - half-open: a single probe call passes; success closes the circuit, failure opens it again.
+    Calls slower than `slow_call` seconds (if set) count as failures.
+    """
+
+    def __init__(self, name, window=300.0, min_calls=5, error_rate=0.5, cooldown=60.0, slow_call=0.0):
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.cooldown = cooldown
+        self.slow_call = slow_call
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        ## (timestamp, ok, latency)
+        self.records = deque()
+
+    def _prune(self, now):
+        while self.records and now - self.records[0][0] > self.window:
+            self.records.popleft()
+
+    def available(self):
+        """
+        Can the provider be routed to (without taking the half-open probe)?
+        """
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.cooldown:
+            self.state = "half-open"
+            self.probe_in_flight = False
+        if self.state == "half-open":
+            return not self.probe_in_flight
+        return self.state == "closed"
+
+    def acquire(self):
+        """
+        Take permission for one call. In half-open state only one probe is allowed at a time.
+        """
+        if not self.available():
+            return False
+        if self.state == "half-open":
+            self.probe_in_flight = True
+        return True
+
+    def record(self, ok, latency=None):
+        now = time.monotonic()
+        if ok and self.slow_call and latency is not None and latency > self.slow_call:
+            ok = False
+        self.records.append((now, ok, latency))
+        self._prune(now)
+        if self.state == "half-open":
+            self.probe_in_flight = False
+            if ok:
+                logging.warning(f"AI provider {self.name}: circuit closed")
+                self.state = "closed"
+                self.records.clear()
+            else:
+                self._open(now)
+            return
+        if self.state == "closed" and not ok:
+            total = len(self.records)
+            errors = sum(1 for r in self.records if not r[1])
+            if total >= self.min_calls and errors / total >= self.error_rate:
+                self._open(now)
+
+    def release(self):
+        """
+        Call finished without outcome (cancelled) - free the half-open probe.
+        """
+        if self.state == "half-open":
+            self.probe_in_flight = False
+
+    def _open(self, now):
+        logging.warning(f"AI provider {self.name}: circuit open for {self.cooldown}s")
+        self.state = "open"
+        self.opened_at = now
+
+    def snapshot(self):
+        self._prune(time.monotonic())
+        total = len(self.records)
+        errors = sum(1 for r in self.records if not r[1])
+        latencies = [r[2] for r in self.records if r[1] and r[2] is not None]
+        return {
+            "state": self.state,
+            "calls": total,
+            "errors": errors,
+            "error_rate": round(errors / total, 3) if total else 0.0,
+            "latency_p50": round(percentile(latencies, 0.5), 2) if latencies else None,
+            "latency_p95": round(percentile(latencies, 0.95), 2) if latencies else None,
+        }
@@ -0,0 +1,142 @@
+import asyncio
+import math
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+from config import LLM_MAX_CONCURRENT, LLM_MAX_QUEUE, LLM_AVG_GENERATION_SECONDS
+from utils.metrics import register_metrics
+from utils.workers import per_process
+
+
+## Priority lanes, highest first. Unlimited (-1 balance) accounts go before paid ones.
+LANES = ("unlimited", "paid")
+
+
+class LLMScheduler:
+    """
+    Fair bounded scheduler for LLM generations:
+    - global concurrency limit (`max_concurrent` generations at once);
+    - priority lanes: waiter from a higher lane always goes first;
+    - inside a lane users are served round-robin, so a burst from one user can't starve others;
+    - load shedding: is_overloaded() tells the caller to reject new work while queue is full.
+    """
+
+    def __init__(self, max_concurrent, max_queue, avg_duration=120.0):
+        self.max_concurrent = max(1, int(max_concurrent))
+        self.max_queue = int(max_queue)
+        self.running = 0
+        ## lane -> OrderedDict(uid -> deque of futures); order of uids is the round-robin order
+        self.lanes = {lane: OrderedDict() for lane in LANES}
+        ## EWMA of generation duration, seconds - for wait estimation
+        self.avg_duration = float(avg_duration)
+
+    def queued(self):
+        return sum(len(q) for lane in self.lanes.values() for q in lane.values())
+
+    def is_busy(self):
+        return self.running >= self.max_concurrent or self.queued() > 0
+
+    def is_overloaded(self):
+        return self.max_queue >= 0 and self.queued() >= self.max_queue
+
+    def position(self, uid=None, lane="paid"):
+        """
+        Approximate position (1-based) a new request of `uid` would get in the queue.
+        """
+        lane = lane if lane in self.lanes else LANES[-1]
+        pos = 1
+        for name in LANES:
+            users = self.lanes[name]
+            if name != lane:
+                pos += sum(len(q) for q in users.values())
+                continue
+            ## Round-robin: one request of every other user goes before each request of this user
+            own = len(users.get(uid, ()))
+            for other, q in users.items():
+                pos += len(q) if other == uid else min(len(q), own + 1)
+            break
+        return pos
+
+    def estimated_wait(self, position):
+        """
+        Estimated wait in seconds for given queue position.
+        """
+        return math.ceil(position / self.max_concurrent) * self.avg_duration
+
+    def stats(self):
+        return {
+            "running": self.running,
+            "queued": self.queued(),
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "avg_duration": round(self.avg_duration, 2),
+        }
+
+    @asynccontextmanager
+    async def slot(self, uid, lane="paid"):
+        """
+        Wait for a generation slot: `async with llm_scheduler.slot(uid, lane): ...`
+        """
+        lane = lane if lane in self.lanes else LANES[-1]
+        if self.running < self.max_concurrent and not self.queued():
+            self.running += 1
+        else:
+            fut = asyncio.get_running_loop().create_future()
+            self.lanes[lane].setdefault(uid, deque()).append(fut)
+            try:
+                await fut
+            except asyncio.CancelledError:
+                if fut.done() and not fut.cancelled():
+                    ## Slot was granted right before cancellation - pass it on
+                    self._release()
+                else:
+                    self._remove(lane, uid, fut)
+                raise
+        t0 = time.monotonic()
+        try:
+            yield
+        finally:
+            self.avg_duration = 0.8 * self.avg_duration + 0.2 * (time.monotonic() - t0)
+            self._release()
+
+    def _remove(self, lane, uid, fut):
+        q = self.lanes[lane].get(uid)
+        if q is None:
+            return
+        try:
+            q.remove(fut)
+        except ValueError:
+            pass
+        if not q:
+            del self.lanes[lane][uid]
+
+    def _release(self):
+        self.running -= 1
+        self._wake_next()
+
+    def _wake_next(self):
+        while self.running < self.max_concurrent:
+            fut = self._pop_next()
+            if fut is None:
+                return
+            self.running += 1
+            fut.set_result(None)
+
+    def _pop_next(self):
+        for lane in LANES:
+            users = self.lanes[lane]
+            while users:
+                uid, q = users.popitem(last=False)
+                fut = q.popleft() if q else None
+                if q:
+                    ## User still has waiters - move to the end of the round
+                    users[uid] = q
+                if fut is not None and not fut.done():
+                    return fut
+        return None
+
+
+## Limits are bot-wide, every webhook worker process gets its share
+llm_scheduler = LLMScheduler(per_process(LLM_MAX_CONCURRENT), per_process(LLM_MAX_QUEUE), LLM_AVG_GENERATION_SECONDS)
+register_metrics("llm_scheduler", llm_scheduler.stats)
@@ -0,0 +1,20 @@
+import importlib.machinery
+import importlib.util
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+## Tests import bot modules (`db`, `services`, ...) from the repo root, `config.py` must be there as for the bot
+sys.path.insert(0, ROOT)
+
+## DB tests work in a scratch database: it must be set before `config` is imported
+if os.getenv("TEST_DB_NAME"):
+    os.environ["DB_NAME"] = os.environ["TEST_DB_NAME"]
+
+## Plain checkout without the bot's config.py: defaults of install/config.py-sample (and the environment)
+if not os.path.exists(os.path.join(ROOT, "config.py")):
+    _loader = importlib.machinery.SourceFileLoader("config", os.path.join(ROOT, "install", "config.py-sample"))
+    _config = importlib.util.module_from_spec(importlib.util.spec_from_loader("config", _loader))
+    _loader.exec_module(_config)
+    sys.modules["config"] = _config
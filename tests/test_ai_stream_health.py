@@ -0,0 +1,109 @@
+"""
+Streaming dispatcher reports the outcome of the whole stream (not of its first piece) to the circuit breaker.
+Providers are replaced by fake async generators.
+"""
+import asyncio
+
+import pytest
+
+pytest.importorskip("aiogram")
+pytest.importorskip("aiomysql")
+
+import services.ai_provider as ai_provider
+from services.ai_provider import ProviderHealth
+
+
+def fake_provider(pieces, finish_reason="stop", delay=0.0, error=None):
+    def stream(provider, uid, book, chapter, verse, meta=None, **kwargs):
+        async def gen():
+            for piece in pieces:
+                await asyncio.sleep(delay)
+                yield piece
+            if error is not None:
+                raise error
+            meta["finish_reason"] = finish_reason
+            meta["text"] = "".join(pieces)
+        return gen()
+    return stream
+
+
+@pytest.fixture
+def health(monkeypatch):
+    health = ProviderHealth("openai", min_calls=1, error_rate=0.5, slow_call=0.0)
+    monkeypatch.setitem(ai_provider._health, "openai", health)
+    monkeypatch.setattr(ai_provider, "_route", lambda: ("openai", None))
+    return health
+
+
+async def consume(limit=None):
+    meta = {}
+    pieces = []
+    stream = ai_provider.ask_ai_stream(1, "genesis", 1, "1", meta=meta)
+    async for piece in stream:
+        pieces.append(piece)
+        if limit is not None and len(pieces) >= limit:
+            await stream.aclose()
+            break
+    return pieces, meta
+
+
+def test_successful_stream_is_recorded_with_latency(health, monkeypatch):
+    monkeypatch.setattr(ai_provider, "_stream_provider", fake_provider(["a", "b", "c"], delay=0.01))
+    pieces, meta = asyncio.run(consume())
+    assert pieces == ["a", "b", "c"] and meta["finish_reason"] == "stop"
+    [(_, ok, latency)] = health.records
+    assert ok and latency >= 0.03
+
+
+def test_stream_broken_after_first_piece_opens_circuit(health, monkeypatch):
+    monkeypatch.setattr(ai_provider, "_stream_provider", fake_provider(["a", "b"], finish_reason="error"))
+    pieces, meta = asyncio.run(consume())
+    assert pieces == ["a", "b"] and meta["finish_reason"] == "error"
+    assert [ok for _, ok, _ in health.records] == [False]
+    assert health.state == "open"
+
+
+def test_stream_exception_is_recorded(health, monkeypatch):
+    monkeypatch.setattr(ai_provider, "_stream_provider", fake_provider(["a"], error=RuntimeError("connection reset")))
+    with pytest.raises(RuntimeError):
+        asyncio.run(consume())
+    assert [ok for _, ok, _ in health.records] == [False]
+
+
+def test_slow_stream_counts_as_failure(health, monkeypatch):
+    health.slow_call = 0.02
+    monkeypatch.setattr(ai_provider, "_stream_provider", fake_provider(["a", "b", "c"], delay=0.01))
+    asyncio.run(consume())
+    assert [ok for _, ok, _ in health.records] == [False]
+
+
+def test_abandoned_stream_frees_probe_without_outcome(health, monkeypatch):
+    health.state = "half-open"
+    monkeypatch.setattr(ai_provider, "_stream_provider", fake_provider(["a", "b", "c"]))
+    pieces, _ = asyncio.run(consume(limit=1))
+    assert pieces == ["a"]
+    assert not health.records and not health.probe_in_flight
+
+
+def test_continuation_after_broken_stream_goes_to_other_provider(monkeypatch):
+    for name in ai_provider.PROVIDERS:
+        monkeypatch.setitem(ai_provider._health, name, ProviderHealth(name, min_calls=1, error_rate=0.5))
+    monkeypatch.setattr(ai_provider, "AI_PROVIDER", "openai")
+    monkeypatch.setattr(ai_provider, "GEMINI_API_KEY", "test-key")
+    monkeypatch.setattr(ai_provider, "_stream_provider", fake_provider(["a", "b"], finish_reason="error"))
+    called = []
+
+    async def ask_provider(provider, *args, **kwargs):
+        called.append(provider)
+        return "continued", {"provider": provider, "text": "continued", "finish_reason": "stop"}
+
+    monkeypatch.setattr(ai_provider, "_ask_provider", ask_provider)
+
+    async def stream_then_continue():
+        await consume()
+        meta = {}
+        await ai_provider.ask_ai(1, "genesis", 1, "1", followup="continue", meta=meta)
+        return meta
+
+    meta = asyncio.run(stream_then_continue())
+    assert called == ["gemini"] and meta["provider"] == "gemini"
@@ -0,0 +1,52 @@
+"""
+Continuation of truncated answers: when to continue, and stitching without the text the model repeated.
+"""
+from utils.continuation import stitch_continuation, is_answer_truncated, is_truncated
+
+
+START = "The root of the word is three letters long and it means "
+
+
+def test_repeated_tail_is_dropped():
+    assert stitch_continuation(START, "three letters long and it means to give.") == START + "to give."
+
+
+def test_repeated_tail_after_leading_whitespace():
+    assert stitch_continuation(START, "\n three letters long and it means to give.") == START + "to give."
+
+
+def test_tail_found_after_preamble():
+    assert stitch_continuation(START, "Continuing: letters long and it means to give.") == START + " to give."
+
+
+def test_short_overlap_is_not_dropped():
+    assert stitch_continuation("abc means", "means more") == "abc meansmeans more"
+
+
+def test_no_overlap_is_appended():
+    assert stitch_continuation(START, "to give.") == START + "to give."
+
+
+def test_empty_sides():
+    assert stitch_continuation("", "x") == "x"
+    assert stitch_continuation("x", "") == "x"
+
+
+def test_finish_reason_decides():
+    long_unfinished = "x" * 4000
+    assert is_answer_truncated("Short.", {"finish_reason": "length"})
+    assert is_answer_truncated("Short.", {"finish_reason": "error"})
+    assert not is_answer_truncated(long_unfinished, {"finish_reason": "stop"})
+
+
+def test_heuristic_without_finish_reason():
+    assert is_answer_truncated("x" * 4000, {})
+    assert not is_answer_truncated("x" * 4000 + ".", {})
+    assert not is_answer_truncated("Short", {})
+    ## Answer marked as complete by the model
+    assert not is_truncated("x" * 4000 + "<b>\u200b\u200b\u200b\u200b</b>")
+
+
+def test_empty_answer_is_truncated():
+    assert is_answer_truncated("", {"finish_reason": "stop"})
+    assert is_answer_truncated("answer", {"text": "  ", "finish_reason": "stop"})
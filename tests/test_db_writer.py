@@ -0,0 +1,36 @@
+"""
+Write-behind queue: nothing queued is lost on shutdown, also rows of producers that were
+waiting on the full queue when the writer was stopped.
+"""
+import asyncio
+
+import pytest
+
+pytest.importorskip("aiomysql")
+
+import db.writer as writer
+
+
+@pytest.mark.parametrize("ticks", range(0, 40, 3))
+def test_stop_writes_rows_of_blocked_producers(monkeypatch, ticks):
+    written = []
+
+    async def write(items):
+        written.extend(items)
+
+    monkeypatch.setitem(writer._writers, "test", write)
+
+    async def run():
+        monkeypatch.setattr(writer, "_queue", asyncio.Queue(maxsize=2))
+        monkeypatch.setattr(writer, "_task", None)
+        writer.start_db_writer()
+        producers = [asyncio.create_task(writer.enqueue("test", i)) for i in range(50)]
+        ## Stop at different points of the writer's work
+        for _ in range(ticks):
+            await asyncio.sleep(0)
+        await writer.stop_db_writer()
+        ## A producer left waiting on the queue would never return
+        await asyncio.wait_for(asyncio.gather(*producers), 5)
+
+    asyncio.run(run())
+    assert sorted(written) == list(range(50))
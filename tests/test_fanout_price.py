@@ -0,0 +1,44 @@
+"""
+Charge of a fan-out request: answered share of the price, rounded up, never above the price.
+"""
+import pytest
+
+pytest.importorskip("aiogram")
+pytest.importorskip("aiomysql")
+## Prompts are not part of the repo (texts/ is filled on deploy)
+pytest.importorskip("texts.prompts")
+
+import utils.methods.korneslov_cache as korneslov_cache
+from utils.methods.korneslov_cache import fanout_price
+
+
+def test_nothing_answered_is_free():
+    assert fanout_price(3, 3, 0) == 0
+
+
+def test_free_request_stays_free():
+    assert fanout_price(0, 3, 3) == 0
+
+
+def test_all_answered_costs_full_price():
+    assert fanout_price(1, 3, 3) == 1
+    assert fanout_price(5, 4, 4) == 5
+
+
+def test_partial_answer_is_rounded_up():
+    assert fanout_price(1, 3, 1) == 1
+    assert fanout_price(5, 4, 1) == 2
+    assert fanout_price(6, 3, 2) == 4
+
+
+def test_cached_sections_cost_cache_price(monkeypatch):
+    monkeypatch.setattr(korneslov_cache, "RESPONSE_CACHE_PRICE_FACTOR", 0.5)
+    assert fanout_price(4, 4, 4, cached=4) == 2
+    assert fanout_price(4, 4, 4, cached=2) == 3
+    monkeypatch.setattr(korneslov_cache, "RESPONSE_CACHE_PRICE_FACTOR", 0.0)
+    assert fanout_price(4, 4, 2, cached=2) == 0
+
+
+def test_never_above_price(monkeypatch):
+    monkeypatch.setattr(korneslov_cache, "RESPONSE_CACHE_PRICE_FACTOR", 2.0)
+    assert fanout_price(3, 3, 3, cached=3) == 3
@@ -0,0 +1,88 @@
+"""
+Fan-out request (one request, several verse sections) stored under the schema of install/app.sql.
+Needs a scratch MySQL database, all its tables are recreated:
+
+    TEST_DB_NAME=korneslov_test python -m pytest tests
+"""
+import asyncio
+import os
+import re
+
+import pytest
+
+
+pytestmark = pytest.mark.skipif(not os.getenv("TEST_DB_NAME"), reason="TEST_DB_NAME is not set")
+
+APP_SQL = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "install", "app.sql")
+
+
+async def create_schema():
+    from db import acquire
+    with open(APP_SQL, encoding="utf-8") as f:
+        sql = "\n".join(line for line in f.read().splitlines() if not line.lstrip().startswith("--"))
+    statements = [s.strip() for s in sql.split(";") if s.strip()]
+    statements = [s for s in statements if not re.match(r"(CREATE DATABASE|USE)\b", s, re.IGNORECASE)]
+    tables = re.findall(r"CREATE TABLE IF NOT EXISTS (\w+)", sql)
+    async with acquire() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("SET FOREIGN_KEY_CHECKS = 0")
+            for table in tables:
+                await cur.execute(f"DROP TABLE IF EXISTS {table}")
+            await cur.execute("SET FOREIGN_KEY_CHECKS = 1")
+            for statement in statements:
+                await cur.execute(statement)
+
+
+async def run_fanout(monkeypatch, writer_running):
+    from db import fetchall, close_pool
+    from db.requests import begin_request
+    from db.writer import start_db_writer, stop_db_writer, db_writer_stats
+    import routes.methods.korneslov_mtd as mtd
+
+    async def generate(book, chapter, verses_str, uid, level, lane, on_delta=None):
+        await asyncio.sleep(0.01)
+        return f"Korneslov: {book} {chapter} {verses_str}", {}
+
+    async def get_cached_answer(cache_key):
+        return None
+
+    sent = []
+
+    async def send_answer(message, answer, req_id, req_at, streamer=None):
+        sent.append(answer)
+
+    ## First section is cached (stored at once), the others go through add_response_later()
+    monkeypatch.setattr(mtd, "_generate", generate)
+    monkeypatch.setattr(mtd, "get_cached_answer", get_cached_answer)
+    monkeypatch.setattr(mtd, "_send_answer", send_answer)
+    monkeypatch.setattr(mtd, "is_cacheable_answer", lambda answer, *args, **kwargs: answer.endswith(" 1-2"))
+
+    try:
+        await create_schema()
+        if writer_running:
+            start_db_writer()
+        started = await begin_request(1, "Test", None, None, "ru", False, {}, "genesis 1 1-6", price=0, book_id=1)
+        req_id = started["request_id"]
+        answered, cached = await mtd._answer_sections(
+            None, req_id, started["requested_at"], 1, {"id": 1}, "genesis", 1, [[1, 2], [3, 4], [5, 6]], "hard", "ru", None, "paid"
+        )
+        ## Row of another request in the same write batch must not be lost with the sections
+        other = await begin_request(2, "Other", None, None, "ru", False, {}, "genesis 1 1", price=0, book_id=1)
+        await mtd.add_response_later(other["request_id"], "other answer")
+        await stop_db_writer()
+
+        assert (answered, cached) == (3, 0)
+        assert len(sent) == 3
+        rows = await fetchall("SELECT request_id, section FROM responses ORDER BY request_id, section")
+        assert [(r["request_id"], r["section"]) for r in rows] == [
+            (req_id, 0), (req_id, 1), (req_id, 2), (other["request_id"], 0)
+        ]
+        assert db_writer_stats()["failed"] == 0
+    finally:
+        await stop_db_writer()
+        await close_pool()
+
+
+@pytest.mark.parametrize("writer_running", [False, True], ids=["direct", "write-behind"])
+def test_fanout_sections_are_stored(monkeypatch, writer_running):
+    asyncio.run(run_fanout(monkeypatch, writer_running))
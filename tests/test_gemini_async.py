@@ -0,0 +1,130 @@
+"""
+Gemini calls must not block the event loop: while a (slow) generation is in flight other coroutines
+(dispatcher, other users' requests) keep running. The client is replaced by a fake whose async methods
+are slow coroutines and whose sync methods block - a regression to the sync client stalls the ticker.
+"""
+import asyncio
+import sys
+import time
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("google.genai")
+pytest.importorskip("aiogram")
+
+import services.gemini_srv as gemini_srv
+
+
+DELAY = 0.3
+CHUNKS = 6
+## Ticker period; a blocked loop gets ~1 tick per generation instead of DELAY / TICK
+TICK = 0.01
+
+
+ANSWER = "full answer"
+
+
+def _chunk(text, last=False):
+    return SimpleNamespace(
+        text=text,
+        candidates=[SimpleNamespace(finish_reason="STOP" if last else None)],
+        usage_metadata=SimpleNamespace(prompt_token_count=10, total_token_count=20) if last else None,
+    )
+
+
+async def _slow_stream():
+    for n in range(CHUNKS):
+        await asyncio.sleep(DELAY / CHUNKS)
+        yield _chunk(f"part{n} ", last=n == CHUNKS - 1)
+
+
+class _AsyncModels:
+    async def generate_content(self, model, config, contents):
+        await asyncio.sleep(DELAY)
+        return _chunk(ANSWER, last=True)
+
+    async def generate_content_stream(self, model, config, contents):
+        return _slow_stream()
+
+
+class _SyncModels:
+    def generate_content(self, model, config, contents):
+        time.sleep(DELAY)
+        return _chunk("full answer", last=True)
+
+    def generate_content_stream(self, model, config, contents):
+        time.sleep(DELAY)
+        return iter([_chunk("full answer", last=True)])
+
+
+@pytest.fixture
+def fake_client(monkeypatch):
+    client = SimpleNamespace(models=_SyncModels(), aio=SimpleNamespace(models=_AsyncModels()))
+    monkeypatch.setattr(gemini_srv, "_client", client)
+    monkeypatch.setattr(gemini_srv, "GEMINI_API_KEY", "test-key")
+    return client
+
+
+async def _with_ticker(coro):
+    """Run `coro` next to a ticker coroutine; returns (result, ticks done meanwhile)."""
+    ticks = 0
+    done = asyncio.Event()
+
+    async def ticker():
+        nonlocal ticks
+        while not done.is_set():
+            await asyncio.sleep(TICK)
+            ticks += 1
+
+    task = asyncio.create_task(ticker())
+    try:
+        result = await coro
+    finally:
+        done.set()
+        await task
+    return result, ticks
+
+
+def _assert_responsive(ticks):
+    ## Half of the ideal number leaves room for slow CI machines
+    assert ticks >= DELAY / TICK / 2, f"event loop was blocked: {ticks} ticks during {DELAY}s generation"
+
+
+def test_ask_gemini_non_streaming(fake_client, monkeypatch):
+    monkeypatch.setattr(gemini_srv, "GEMINI_USE_STREAMING", False)
+    meta = {}
+    answer, ticks = asyncio.run(_with_ticker(gemini_srv.ask_gemini(1, "genesis", 1, "1", "system", meta=meta)))
+    _assert_responsive(ticks)
+    assert "full answer" in answer
+    assert meta["finish_reason"] == "stop"
+
+
+def test_ask_gemini_streaming(fake_client, monkeypatch):
+    monkeypatch.setattr(gemini_srv, "GEMINI_USE_STREAMING", True)
+    meta = {}
+    answer, ticks = asyncio.run(_with_ticker(gemini_srv.ask_gemini(1, "genesis", 1, "1", "system", meta=meta)))
+    _assert_responsive(ticks)
+    assert "part0" in answer and f"part{CHUNKS - 1}" in answer
+    assert meta["finish_reason"] == "stop"
+
+
+def test_stream_gemini(fake_client):
+    async def collect():
+        return [piece async for piece in gemini_srv.stream_gemini(1, "genesis", 1, "1", "system")]
+
+    pieces, ticks = asyncio.run(_with_ticker(collect()))
+    _assert_responsive(ticks)
+    assert "".join(pieces[1:]) == "".join(f"part{n} " for n in range(CHUNKS))
+
+
+def test_ask_gemini_markdown_is_not_html_escaped(fake_client, monkeypatch):
+    from utils.tgentities import render_markdown_parts
+
+    monkeypatch.setattr(gemini_srv, "GEMINI_USE_STREAMING", False)
+    monkeypatch.setattr(gemini_srv, "AI_OUTPUT_FORMAT", "markdown")
+    monkeypatch.setattr(sys.modules[__name__], "ANSWER", "**Root** a < b & c > d")
+    answer = asyncio.run(gemini_srv.ask_gemini(1, "genesis", 1, "1", "system"))
+    text = "".join(part for part, _ in render_markdown_parts(answer))
+    assert "Root a < b & c > d" in text
+    assert "&amp;" not in text and "&lt;" not in text and "&gt;" not in text
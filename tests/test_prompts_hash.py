@@ -0,0 +1,46 @@
+"""
+Cache keys follow the prompt templates an answer is generated with: changing a template used for the
+request invalidates its cached answers, unrelated ones don't.
+"""
+import pytest
+
+pytest.importorskip("aiogram")
+pytest.importorskip("aiomysql")
+## Prompts are not part of the repo (texts/ is filled on deploy)
+pytest.importorskip("texts.prompts")
+
+import utils.methods.korneslov_cache as korneslov_cache
+from i18n.messages import tr
+
+
+@pytest.fixture
+def prompts_hash(monkeypatch):
+    def prompts_hash(lang="ru", level="hard", output_format="html", texts=None):
+        monkeypatch.setattr(korneslov_cache, "_prompts_hashes", {})
+        monkeypatch.setattr(korneslov_cache, "AI_OUTPUT_FORMAT", output_format)
+        monkeypatch.setattr(korneslov_cache, "tr", lambda key, **kwargs: (texts or {}).get(key) or tr(key, **kwargs))
+        return korneslov_cache._prompts_hash(lang, level)
+    return prompts_hash
+
+
+def test_hash_is_stable(prompts_hash):
+    assert prompts_hash() == prompts_hash()
+
+
+def test_continue_prompt_is_hashed(prompts_hash):
+    assert prompts_hash() != prompts_hash(texts={"korneslov_py.continue_prompt": "go on"})
+
+
+def test_markdown_prompt_is_hashed_in_markdown_mode_only(prompts_hash):
+    changed = {"korneslov_py.markdown_format_prompt": "use markdown"}
+    assert prompts_hash() == prompts_hash(texts=changed)
+    assert prompts_hash(output_format="markdown") != prompts_hash(output_format="markdown", texts=changed)
+
+
+def test_other_level_template_is_not_hashed(prompts_hash, monkeypatch):
+    levels = {lang: dict(d) for lang, d in korneslov_cache.LEVELS.items()}
+    before = prompts_hash(level="hard")
+    levels["ru"]["easy"] = "changed"
+    monkeypatch.setattr(korneslov_cache, "LEVELS", levels)
+    assert prompts_hash(level="hard") == before
+    assert prompts_hash(level="easy") != prompts_hash(level="hard")
@@ -0,0 +1,109 @@
+"""
+Per-provider circuit breaker: closed -> open on error rate, open -> half-open after cooldown,
+single half-open probe decides. Time is faked.
+"""
+import pytest
+
+import services.provider_health as provider_health
+from services.provider_health import ProviderHealth, percentile
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(provider_health.time, "monotonic", clock.monotonic)
+    return clock
+
+
+def test_opens_on_error_rate_after_min_calls(clock):
+    health = ProviderHealth("p", min_calls=4, error_rate=0.5)
+    for ok in (True, False, False):
+        health.record(ok)
+    ## 2 of 3 failed, but less than min_calls
+    assert health.state == "closed" and health.acquire()
+    health.record(False)
+    assert health.state == "open"
+    assert not health.available() and not health.acquire()
+
+
+def test_old_records_leave_window(clock):
+    health = ProviderHealth("p", window=10, min_calls=2, error_rate=0.5)
+    health.record(False)
+    clock.now += 11
+    health.record(True)
+    health.record(False)
+    ## The first failure is out of the window: 1 of 2
+    assert health.state == "open"
+    health = ProviderHealth("p", window=10, min_calls=3, error_rate=0.5)
+    health.record(False)
+    clock.now += 11
+    health.record(True)
+    health.record(True)
+    health.record(False)
+    assert health.state == "closed"
+
+
+def test_half_open_single_probe(clock):
+    health = ProviderHealth("p", min_calls=1, cooldown=60)
+    health.record(False)
+    clock.now += 59
+    assert not health.available()
+    clock.now += 1
+    assert health.available()
+    assert health.acquire() and health.state == "half-open"
+    ## Only one probe at a time
+    assert not health.acquire()
+    health.record(True)
+    assert health.state == "closed" and not health.records
+    assert health.acquire()
+
+
+def test_failed_probe_opens_again(clock):
+    health = ProviderHealth("p", min_calls=1, cooldown=60)
+    health.record(False)
+    clock.now += 60
+    assert health.acquire()
+    health.record(False)
+    assert health.state == "open" and health.opened_at == clock.now
+
+
+def test_released_probe_can_be_retaken(clock):
+    health = ProviderHealth("p", min_calls=1, cooldown=60)
+    health.record(False)
+    clock.now += 60
+    assert health.acquire() and not health.acquire()
+    health.release()
+    assert health.acquire()
+
+
+def test_slow_call_counts_as_failure(clock):
+    health = ProviderHealth("p", min_calls=1, slow_call=5)
+    health.record(True, latency=4)
+    assert health.state == "closed"
+    health.record(True, latency=6)
+    assert health.records[-1][1] is False
+
+
+def test_snapshot(clock):
+    health = ProviderHealth("p", min_calls=10)
+    for latency in (1, 2, 3):
+        health.record(True, latency)
+    health.record(False)
+    snapshot = health.snapshot()
+    assert snapshot["state"] == "closed"
+    assert (snapshot["calls"], snapshot["errors"], snapshot["error_rate"]) == (4, 1, 0.25)
+    assert snapshot["latency_p50"] == 2
+
+
+def test_percentile():
+    assert percentile([5], 0.95) == 5
+    assert percentile([4, 1, 3, 2], 0.5) == 3
+    assert percentile(range(1, 101), 0.95) == 95
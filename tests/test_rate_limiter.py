@@ -0,0 +1,92 @@
+"""
+Telegram send rate limiting: token buckets (rate + burst, pause on RetryAfter) and the limiter
+combining the bot-wide bucket with per-chat ones. Time is faked.
+"""
+import asyncio
+
+import pytest
+
+import utils.ratelimit as ratelimit
+from utils.ratelimit import TokenBucket, TelegramRateLimiter
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit.time, "monotonic", clock.monotonic)
+    return clock
+
+
+def test_burst_then_rate(clock):
+    bucket = TokenBucket(rate=2, burst=3)
+    assert [bucket.reserve() for _ in range(3)] == [0, 0, 0]
+    assert bucket.reserve() == pytest.approx(0.5)
+    assert bucket.reserve() == pytest.approx(1.0)
+
+
+def test_bucket_refills_while_idle(clock):
+    bucket = TokenBucket(rate=1, burst=2)
+    bucket.reserve(), bucket.reserve()
+    assert not bucket.idle()
+    clock.now += 2
+    assert bucket.idle()
+    assert [bucket.reserve() for _ in range(2)] == [0, 0]
+
+
+def test_pause(clock):
+    bucket = TokenBucket(rate=10, burst=5)
+    bucket.pause(3)
+    assert bucket.reserve() == pytest.approx(3)
+    assert not bucket.idle()
+
+
+def test_zero_rate_is_unlimited(clock):
+    bucket = TokenBucket(rate=0, burst=1)
+    assert all(bucket.reserve() == 0 for _ in range(100))
+
+
+def test_limiter_waits_for_chat_and_global_buckets(clock, monkeypatch):
+    slept = []
+
+    async def sleep(seconds):
+        slept.append(seconds)
+
+    monkeypatch.setattr(ratelimit.asyncio, "sleep", sleep)
+    limiter = TelegramRateLimiter(global_rate=100, global_burst=100, chat_rate=1, chat_burst=1)
+
+    async def run():
+        await limiter.acquire(1)
+        await limiter.acquire(2)
+        await limiter.acquire(1)
+
+    asyncio.run(run())
+    ## Only the second message to chat 1 waits, for its chat bucket
+    assert slept == [pytest.approx(1.0)]
+    assert limiter.stats() == {"chats": 2, "waited_seconds": 1.0, "retry_after": 0}
+
+
+def test_retry_after_pauses_only_that_chat(clock):
+    limiter = TelegramRateLimiter(100, 100, 10, 10)
+    limiter.pause(1, 5)
+    assert limiter._chat_bucket(1).reserve() == pytest.approx(5)
+    assert limiter._chat_bucket(2).reserve() == 0
+    limiter.pause(None, 2)
+    assert limiter.global_bucket.reserve() == pytest.approx(2)
+    assert limiter.stats()["retry_after"] == 2
+
+
+def test_idle_chat_buckets_are_dropped(clock):
+    limiter = TelegramRateLimiter(100, 100, 1, 1, max_chats=2)
+    limiter._chat_bucket(1).reserve()
+    limiter._chat_bucket(2).reserve()
+    clock.now += 10
+    limiter._chat_bucket(3).reserve()
+    assert set(limiter.chats) == {3}
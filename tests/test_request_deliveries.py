@@ -0,0 +1,30 @@
+"""
+Delivery reports are written in batches; rows with known `datetime_request` are updated with it
+(partition pruning on the partitioned `requests` table).
+"""
+import asyncio
+from datetime import datetime
+
+import pytest
+
+pytest.importorskip("aiomysql")
+
+import db.requests as requests_db
+
+
+def test_deliveries_are_grouped_and_keyed_by_request_time(monkeypatch):
+    executed = []
+
+    async def execute(sql, params):
+        executed.append((sql, list(params)))
+
+    monkeypatch.setattr(requests_db, "execute", execute)
+    t1, t2 = datetime(2026, 1, 1, 10), datetime(2026, 2, 1, 10)
+    asyncio.run(requests_db._write_request_deliveries([
+        (1, t1, True), (1, t1, False), (2, t2, True), (3, None, True),
+    ]))
+    assert executed == [
+        ("UPDATE requests SET status_tg = FALSE WHERE id IN (%s) AND datetime_request IN (%s)", [1, t1]),
+        ("UPDATE requests SET status_tg = IFNULL(status_tg, TRUE) WHERE id IN (%s) AND datetime_request IN (%s)", [2, t2]),
+        ("UPDATE requests SET status_tg = IFNULL(status_tg, TRUE) WHERE id IN (%s)", [3]),
+    ]
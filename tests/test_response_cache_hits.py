@@ -0,0 +1,45 @@
+"""
+Cache lookup has no side effects: a hit is counted only when the cached answer is served
+(a rejected request - e.g. low balance - must not count).
+"""
+import asyncio
+
+import pytest
+
+pytest.importorskip("aiogram")
+pytest.importorskip("aiomysql")
+## Prompts are not part of the repo (texts/ is filled on deploy)
+pytest.importorskip("texts.prompts")
+
+import utils.methods.korneslov_cache as korneslov_cache
+
+
+@pytest.fixture
+def touched(monkeypatch):
+    touched = []
+
+    async def get_cached_response(cache_key):
+        return {"response_id": 1, "request_id": 2, "data": "answer"}
+
+    async def touch_cached_response(cache_key):
+        touched.append(cache_key)
+
+    monkeypatch.setattr(korneslov_cache, "RESPONSE_CACHE_ENABLED", True)
+    monkeypatch.setattr(korneslov_cache, "_lru", type(korneslov_cache._lru)())
+    monkeypatch.setattr(korneslov_cache, "get_cached_response", get_cached_response)
+    monkeypatch.setattr(korneslov_cache, "touch_cached_response", touch_cached_response)
+    return touched
+
+
+def test_lookup_does_not_count_hit(touched):
+    async def lookup_twice():
+        return [await korneslov_cache.get_cached_answer("key") for _ in range(2)]
+
+    entries = asyncio.run(lookup_twice())
+    assert [e["data"] for e in entries] == ["answer", "answer"]
+    assert touched == []
+
+
+def test_served_answer_counts_hit(touched):
+    asyncio.run(korneslov_cache.record_cache_hit("key"))
+    assert touched == ["key"]
@@ -0,0 +1,52 @@
+"""
+Plain-text fallback of answer_safe_message(): HTML Telegram rejected is sent escaped and without
+parse mode, where tags and entities count as visible chars - it must be re-split to fit the limit.
+"""
+import asyncio
+import html
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("aiogram")
+
+import aiogram.exceptions as aiogram_exceptions
+
+import utils.safe_send as safe_send
+from utils.safe_send import answer_safe_message, TelegramRateLimiter
+from utils.tghtml import TELEGRAM_MAX_LENGTH, telegram_html_parts, utf16_len
+
+
+class RejectingHtmlMessage:
+    def __init__(self):
+        self.chat = SimpleNamespace(id=1)
+        self.sent = []
+
+    async def answer(self, text, parse_mode=None, **kwargs):
+        if parse_mode:
+            raise aiogram_exceptions.TelegramBadRequest(None, "Bad Request: can't parse entities")
+        if utf16_len(text) > TELEGRAM_MAX_LENGTH:
+            raise aiogram_exceptions.TelegramBadRequest(None, "Bad Request: message is too long")
+        self.sent.append(text)
+        return self
+
+
+@pytest.fixture(autouse=True)
+def no_rate_limit(monkeypatch):
+    monkeypatch.setattr(safe_send, "rate_limiter", TelegramRateLimiter(1000, 1000, 1000, 1000))
+
+
+def test_fallback_of_part_at_limit_is_split():
+    ## Exactly TELEGRAM_MAX_LENGTH visible chars: one part for HTML, far longer as escaped plain text
+    part = "<b>" + "&lt;a&gt;&amp;" * (TELEGRAM_MAX_LENGTH // 4) + "</b>"
+    assert telegram_html_parts(part) == [part]
+    target = RejectingHtmlMessage()
+    assert asyncio.run(answer_safe_message(target, part)) is target
+    assert len(target.sent) > 1
+    assert "".join(target.sent) == html.escape(part)
+
+
+def test_short_fallback_is_one_message():
+    target = RejectingHtmlMessage()
+    asyncio.run(answer_safe_message(target, "<b>a & b</b>"))
+    assert target.sent == ["&lt;b&gt;a &amp; b&lt;/b&gt;"]
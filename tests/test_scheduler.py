@@ -0,0 +1,113 @@
+"""
+LLM scheduler: concurrency limit, priority lanes, per-user round-robin, queue position estimate and load shedding.
+"""
+import asyncio
+
+from services.scheduler import LLMScheduler
+
+
+async def _served_order(scheduler, requests):
+    """Queue (uid, lane) requests behind a running one; returns the order they got their slots."""
+    order = []
+    gate = asyncio.Event()
+
+    async def request(uid, lane):
+        async with scheduler.slot(uid, lane):
+            order.append(uid)
+            await gate.wait()
+
+    holder = asyncio.create_task(request("holder", "paid"))
+    await asyncio.sleep(0)
+    tasks = []
+    for uid, lane in requests:
+        tasks.append(asyncio.create_task(request(uid, lane)))
+        await asyncio.sleep(0)
+    gate.set()
+    await asyncio.gather(holder, *tasks)
+    return order[1:]
+
+
+def test_users_are_served_round_robin():
+    scheduler = LLMScheduler(1, 10)
+    order = asyncio.run(_served_order(scheduler, [("a", "paid")] * 3 + [("b", "paid"), ("c", "paid")]))
+    assert order == ["a", "b", "c", "a", "a"]
+    assert scheduler.running == 0 and scheduler.queued() == 0
+
+
+def test_higher_lane_goes_first():
+    scheduler = LLMScheduler(1, 10)
+    order = asyncio.run(_served_order(scheduler, [("a", "paid"), ("b", "paid"), ("vip", "unlimited")]))
+    assert order == ["vip", "a", "b"]
+
+
+def test_unknown_lane_is_lowest():
+    scheduler = LLMScheduler(1, 10)
+    order = asyncio.run(_served_order(scheduler, [("x", "free"), ("a", "paid")]))
+    assert order == ["x", "a"]
+
+
+def test_concurrency_limit():
+    scheduler = LLMScheduler(2, 10)
+    peak = 0
+
+    async def request():
+        nonlocal peak
+        async with scheduler.slot("u"):
+            peak = max(peak, scheduler.running)
+            await asyncio.sleep(0.01)
+
+    async def run():
+        await asyncio.gather(*(request() for _ in range(6)))
+
+    asyncio.run(run())
+    assert peak == 2 and scheduler.running == 0
+
+
+def test_position_and_estimated_wait():
+    scheduler = LLMScheduler(2, 10, avg_duration=10)
+    ## Queued: paid a, a, b and unlimited vip
+    scheduler.lanes["paid"]["a"] = [object(), object()]
+    scheduler.lanes["paid"]["b"] = [object()]
+    scheduler.lanes["unlimited"]["vip"] = [object()]
+    ## Round: vip, a, b, a - then the second request of b
+    assert scheduler.position("b") == 5
+    ## new user: after vip and one request of every queued user
+    assert scheduler.position("c") == 4
+    assert scheduler.position("vip2", lane="unlimited") == 2
+    assert scheduler.estimated_wait(1) == 10
+    assert scheduler.estimated_wait(3) == 20
+
+
+def test_overload():
+    scheduler = LLMScheduler(1, 2)
+    assert not scheduler.is_busy() and not scheduler.is_overloaded()
+    scheduler.running = 1
+    assert scheduler.is_busy()
+    scheduler.lanes["paid"]["a"] = [object(), object()]
+    assert scheduler.is_overloaded()
+    assert not LLMScheduler(1, -1).is_overloaded()
+
+
+def test_cancelled_waiter_leaves_queue():
+    scheduler = LLMScheduler(1, 10)
+
+    async def run():
+        gate = asyncio.Event()
+
+        async def request(uid):
+            async with scheduler.slot(uid):
+                await gate.wait()
+
+        holder = asyncio.create_task(request("a"))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(request("b"))
+        await asyncio.sleep(0)
+        assert scheduler.queued() == 1
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        assert scheduler.queued() == 0
+        gate.set()
+        await holder
+
+    asyncio.run(run())
+    assert scheduler.running == 0
@@ -0,0 +1,72 @@
+"""
+Single-flight: concurrent calls with the same key share one execution (result or exception);
+a cancelled waiter does not cancel it, a finished call is not reused.
+"""
+import asyncio
+
+import pytest
+
+from utils.singleflight import singleflight, inflight_count
+
+
+def test_same_key_runs_once():
+    calls = []
+
+    async def work(name):
+        calls.append(name)
+        await asyncio.sleep(0.01)
+        return name
+
+    async def run():
+        return await asyncio.gather(
+            singleflight("a", lambda: work("first")),
+            singleflight("a", lambda: work("second")),
+            singleflight("b", lambda: work("other")),
+        )
+
+    assert asyncio.run(run()) == ["first", "first", "other"]
+    assert calls == ["first", "other"]
+    assert inflight_count() == 0
+
+
+def test_exception_is_shared():
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise ValueError("boom")
+
+    async def run():
+        return await asyncio.gather(singleflight("k", fail), singleflight("k", fail), return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert all(isinstance(r, ValueError) for r in results)
+    assert results[0] is results[1]
+
+
+def test_cancelled_waiter_does_not_cancel_call():
+    async def work():
+        await asyncio.sleep(0.02)
+        return "done"
+
+    async def run():
+        first = asyncio.create_task(singleflight("k", work))
+        second = asyncio.create_task(singleflight("k", work))
+        await asyncio.sleep(0.005)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(run()) == "done"
+
+
+def test_finished_call_is_not_reused():
+    calls = []
+
+    async def work():
+        calls.append(1)
+        return len(calls)
+
+    async def run():
+        return [await singleflight("k", work), await singleflight("k", work)]
+
+    assert asyncio.run(run()) == [1, 2]
@@ -0,0 +1,68 @@
+"""
+StreamingAnswer.finish() reports whether the whole final answer reached the chat.
+Telegram is replaced by a fake message whose answer()/edit_text() succeed or fail on demand.
+"""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("aiogram")
+
+import utils.safe_send as safe_send
+from utils.safe_send import StreamingAnswer, TelegramRateLimiter
+
+
+@pytest.fixture(autouse=True)
+def no_rate_limit(monkeypatch):
+    monkeypatch.setattr(safe_send, "rate_limiter", TelegramRateLimiter(1000, 1000, 1000, 1000))
+
+
+class FakeMessage:
+    def __init__(self, fail_answer=False, fail_edit=False):
+        self.chat = SimpleNamespace(id=1)
+        self.fail_answer = fail_answer
+        self.fail_edit = fail_edit
+        self.sent = []
+        self.edited = []
+
+    async def answer(self, text, **kwargs):
+        if self.fail_answer:
+            raise RuntimeError("network is down")
+        self.sent.append(text)
+        return FakeMessage(fail_edit=self.fail_edit)
+
+    async def edit_text(self, text, **kwargs):
+        if self.fail_edit:
+            raise RuntimeError("network is down")
+        self.edited.append(text)
+
+    async def delete(self):
+        pass
+
+
+def finish(target, preview, parts):
+    async def run():
+        streamer = StreamingAnswer(target, edit_interval=0)
+        if preview:
+            streamer.feed(preview)
+            await asyncio.sleep(0.01)
+        return await streamer.finish(parts)
+    return asyncio.run(run())
+
+
+def test_all_parts_sent():
+    target = FakeMessage()
+    assert finish(target, "preview", ["<b>one</b>", "two"]) is True
+    assert target.sent == ["preview", "two"]
+
+
+def test_failed_new_part_is_reported():
+    target = FakeMessage(fail_answer=True)
+    assert finish(target, None, ["one", "two"]) is False
+
+
+def test_failed_edit_is_reported_and_rest_still_sent():
+    target = FakeMessage(fail_edit=True)
+    assert finish(target, "preview", ["one", "two"]) is False
+    assert target.sent == ["preview", "two"]
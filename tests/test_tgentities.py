@@ -0,0 +1,70 @@
+"""
+Restricted Markdown -> Telegram (text, entities): inline markers, blocks, UTF-16 offsets and splitting into parts.
+"""
+from utils.tgentities import render_markdown, render_markdown_parts
+from utils.tghtml import utf16_len
+
+
+def entities(md):
+    text, ents = render_markdown(md)
+    return text, [(e["type"], text[e["offset"]:e["offset"] + e["length"]]) for e in ents]
+
+
+def test_inline_markers():
+    assert entities("**bold** *it* __u__ ~~s~~ ||sp|| `c*o*de`") == (
+        "bold it u s sp c*o*de",
+        [("bold", "bold"), ("italic", "it"), ("underline", "u"), ("strikethrough", "s"), ("spoiler", "sp"), ("code", "c*o*de")],
+    )
+
+
+def test_nested_and_link():
+    text, ents = render_markdown("**a [link *x*](https://e.org) b**")
+    assert text == "a link x b"
+    assert {e["type"] for e in ents} == {"bold", "text_link", "italic"}
+    link = next(e for e in ents if e["type"] == "text_link")
+    assert link["url"] == "https://e.org" and text[link["offset"]:link["offset"] + link["length"]] == "link x"
+
+
+def test_unmatched_and_inner_word_markers_stay_text():
+    assert entities("2*3*4 snake_case_name ** x ** \\*esc\\*") == ("2*3*4 snake_case_name ** x ** *esc*", [])
+
+
+def test_blocks():
+    text, ents = entities("# Title\n> quoted\n> more\n- item\n```py\nx = 1\n```\nend")
+    assert text == "Title\nquoted\nmore\n• item\nx = 1\nend"
+    assert ents == [("bold", "Title"), ("blockquote", "quoted\nmore"), ("pre", "x = 1")]
+
+
+def test_br_tags_become_newlines():
+    assert render_markdown("a<br>b<br/>\nc")[0] == "a\nb\nc"
+
+
+def test_offsets_are_utf16():
+    text, ents = render_markdown("😀 **b**")
+    assert ents == [{"type": "bold", "offset": 3, "length": 1}]
+
+
+def test_parts_fit_and_keep_entities():
+    md = "\n".join(f"line {i} **bold {i}** 😀" for i in range(300))
+    parts = render_markdown_parts(md, max_length=200)
+    assert len(parts) > 1
+    for text, ents in parts:
+        assert utf16_len(text) <= 200
+        assert not text.startswith("\n") and not text.endswith("\n")
+        for e in ents:
+            assert e["offset"] + e["length"] <= utf16_len(text)
+    assert sum(len(ents) for _, ents in parts) == 300
+
+
+def test_code_is_not_cut_between_parts():
+    md = "x " * 40 + "`" + "y" * 30 + "`"
+    parts = render_markdown_parts(md, max_length=100)
+    code = [(text, e) for text, ents in parts for e in ents if e["type"] == "code"]
+    assert len(code) == 1
+    text, e = code[0]
+    assert text[e["offset"]:e["offset"] + e["length"]] == "y" * 30
+
+
+def test_empty():
+    assert render_markdown_parts("") == []
+    assert render_markdown(None) == ("", [])
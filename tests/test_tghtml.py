@@ -0,0 +1,66 @@
+"""
+LLM HTML -> Telegram-HTML parts: sanitizing, visible UTF-16 length limit and tags re-opened across parts.
+"""
+import html
+import re
+
+from utils.tghtml import (
+    TELEGRAM_MAX_LENGTH, telegram_html_parts, telegram_text_parts, sanitize_telegram_html, utf16_len,
+)
+
+
+def visible(part):
+    return utf16_len(html.unescape(re.sub(r"<[^<>]*>", "", part)))
+
+
+def test_utf16_len():
+    assert utf16_len("abc") == 3
+    assert utf16_len("😀") == 2
+    assert utf16_len("ё😀") == 3
+
+
+def test_sanitize():
+    assert sanitize_telegram_html("<p>a<br>b</p> 1 < 2 & <b>x</b> &nbsp;&lt;") == "a\nb 1 &lt; 2 &amp; <b>x</b> \xa0&lt;"
+    assert sanitize_telegram_html("a<br>\nb") == "a\nb"
+    assert sanitize_telegram_html("<b>a</i></b>") == "<b>a</b>"
+
+
+def test_short_text_is_one_part():
+    assert telegram_html_parts("<b>hi</b>") == ["<b>hi</b>"]
+    assert telegram_html_parts("") == []
+
+
+def test_limit_counts_visible_utf16_units():
+    ## Markup and entities don't count, astral chars count twice
+    text = "<b>" + "&amp;" * 10 + "😀" * 5 + "</b>"
+    assert telegram_html_parts(text, max_length=20) == [text]
+    assert len(telegram_html_parts(text, max_length=19)) == 2
+
+
+def test_parts_fit_and_tags_are_reopened():
+    text = '<b><a href="https://e.org">' + "\n".join(f"line {i} 😀 &lt;x&gt;" for i in range(200)) + "</a></b>"
+    parts = telegram_html_parts(text, max_length=300)
+    assert len(parts) > 1
+    for part in parts:
+        assert visible(part) <= 300
+        assert part.startswith('<b><a href="https://e.org">') and part.endswith("</a></b>")
+    assert "".join(html.unescape(re.sub(r"<[^<>]*>", "", p)) for p in parts).count("line") == 200
+
+
+def test_long_line_is_cut_at_sentence_end():
+    text = "First sentence. " * 10 + "x" * 50
+    parts = telegram_html_parts(text, max_length=100)
+    assert parts[0].endswith(".")
+    assert all(visible(p) <= 100 for p in parts)
+
+
+def test_entity_is_not_cut():
+    parts = telegram_html_parts("&amp;" * 30, max_length=7)
+    assert all(p == "&amp;" * len(p.split("&amp;")[:-1]) for p in parts)
+
+
+def test_text_parts_for_plain_sending():
+    text = "<b>" * 2000 + " a&b"
+    parts = telegram_text_parts(text)
+    assert all(utf16_len(p) <= TELEGRAM_MAX_LENGTH for p in parts)
+    assert "".join(parts) == text
@@ -0,0 +1,184 @@
+"""
+Monthly partitions of `requests` (migration 005): add partitions for the coming months and move
+partitions older than --keep-months into gzipped JSON lines files (request + its answers per line),
+then drop them from DB. Run monthly, e.g. from cron:
+
+    python -m tools.archive_requests --keep-months 12 --dir /var/backups/korneslov
+    python -m tools.archive_requests --ensure-only
+    python -m tools.archive_requests --dry-run
+
+Answers still used by `response_cache` stay in `responses` (cache hits of newer requests refer to them).
+"""
+import argparse
+import asyncio
+import datetime
+import gzip
+import json
+import os
+import re
+
+from db import execute, fetchone, fetchall, close_pool
+from db.responses import decode_response_row
+
+
+_PART_RE = re.compile(r"^p(\d{4})(\d{2})$")
+
+
+def _add_months(day, n):
+    months = day.year * 12 + day.month - 1 + n
+    return datetime.date(months // 12, months % 12 + 1, 1)
+
+
+def _name(month):
+    return f"p{month:%Y%m}"
+
+
+async def monthly_partitions():
+    """Month (1st day) -> partition name, sorted; raises if `requests` is not partitioned yet."""
+    rows = await fetchall(
+        """
+        SELECT PARTITION_NAME AS name FROM information_schema.PARTITIONS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'requests'
+        ORDER BY PARTITION_ORDINAL_POSITION
+        """
+    )
+    if not rows or rows[0]["name"] is None:
+        raise SystemExit("Table `requests` is not partitioned, apply install/migrations/005_requests_partitions.sql")
+    months = {}
+    for row in rows:
+        m = _PART_RE.match(row["name"])
+        if m:
+            months[datetime.date(int(m.group(1)), int(m.group(2)), 1)] = row["name"]
+    return dict(sorted(months.items()))
+
+
+async def ensure_partitions(ahead, dry_run=False):
+    """
+    Split `pmax` into monthly partitions up to `ahead` months from now. First run after the migration
+    also spreads existing rows into their months (copies them once).
+    """
+    months = await monthly_partitions()
+    this_month = datetime.date.today().replace(day=1)
+    if months:
+        first = _add_months(max(months), 1)
+    else:
+        row = await fetchone("SELECT MIN(datetime_request) AS first FROM requests")
+        first = row["first"].date().replace(day=1) if row["first"] else this_month
+    last = _add_months(this_month, ahead)
+    new = []
+    while first <= last:
+        new.append(first)
+        first = _add_months(first, 1)
+    if not new:
+        print("Partitions are up to date")
+        return []
+    defs = ", ".join(f"PARTITION {_name(m)} VALUES LESS THAN ('{_add_months(m, 1)}')" for m in new)
+    print(f"Adding partitions {_name(new[0])} .. {_name(new[-1])}")
+    if not dry_run:
+        await execute(f"ALTER TABLE requests REORGANIZE PARTITION pmax INTO ({defs}, PARTITION pmax VALUES LESS THAN (MAXVALUE))")
+    return new
+
+
+async def export_partition(name, path, batch):
+    """
+    Write requests of partition to gzipped JSON lines, one line per request with its answers
+    (`responses`: one item per section); returns number of requests.
+    """
+    tmp = path + ".part"
+    count = 0
+    last_id = 0
+    with gzip.open(tmp, "wt", encoding="utf-8") as f:
+        while True:
+            rows = await fetchall(
+                f"SELECT r.* FROM requests PARTITION ({name}) r WHERE r.id > %s ORDER BY r.id LIMIT %s",
+                (last_id, batch)
+            )
+            if not rows:
+                break
+            answers = {}
+            for answer in await fetchall(
+                f"""
+                SELECT s.request_id, s.id, s.section, s.data, b.codec, b.data AS blob
+                FROM responses s
+                LEFT JOIN response_blobs b ON b.hash = s.data_hash
+                WHERE s.request_id IN ({','.join(['%s'] * len(rows))})
+                ORDER BY s.request_id, s.section
+                """,
+                [row["id"] for row in rows]
+            ):
+                answer = decode_response_row(answer)
+                answers.setdefault(answer.pop("request_id"), []).append(answer)
+            for row in rows:
+                row["responses"] = answers.get(row["id"], [])
+                f.write(json.dumps(row, ensure_ascii=False, default=str) + "\n")
+            count += len(rows)
+            last_id = rows[-1]["id"]
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return count
+
+
+async def drop_partition(name):
+    ## Answers referenced by the cache are kept, see module doc
+    await execute(
+        f"""
+        DELETE s FROM responses s
+        JOIN requests PARTITION ({name}) r ON r.id = s.request_id
+        LEFT JOIN response_cache c ON c.response_id = s.id
+        WHERE c.response_id IS NULL
+        """
+    )
+    await execute(f"UPDATE users u JOIN requests PARTITION ({name}) r ON r.id = u.request_id SET u.request_id = NULL")
+    await execute(f"ALTER TABLE requests DROP PARTITION {name}")
+
+
+async def archive(keep_months, out_dir, batch, dry_run=False):
+    cutoff = _add_months(datetime.date.today().replace(day=1), -keep_months)
+    old = {m: name for m, name in (await monthly_partitions()).items() if _add_months(m, 1) <= cutoff}
+    if not old:
+        print(f"Nothing to archive before {cutoff}")
+        return
+    os.makedirs(out_dir, exist_ok=True)
+    for month, name in old.items():
+        path = os.path.join(out_dir, f"requests_{month:%Y_%m}.jsonl.gz")
+        if dry_run:
+            row = await fetchone(f"SELECT COUNT(*) AS n FROM requests PARTITION ({name})")
+            print(f"{name}: {row['n']} requests -> {path}")
+            continue
+        written = await export_partition(name, path, batch)
+        row = await fetchone(f"SELECT COUNT(*) AS n FROM requests PARTITION ({name})")
+        if row["n"] != written:
+            raise SystemExit(f"{name}: {written} rows written but {row['n']} in DB (new rows arrived?), partition kept")
+        await drop_partition(name)
+        print(f"{name}: {written} requests -> {path} ({os.path.getsize(path) / 1024 / 1024:.1f} MB), partition dropped")
+    if not dry_run:
+        ## Texts no more referenced by any answer
+        await execute(
+            """
+            DELETE b FROM response_blobs b
+            LEFT JOIN responses s ON s.data_hash = b.hash
+            WHERE s.id IS NULL AND b.created_at < NOW() - INTERVAL 1 HOUR
+            """
+        )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--keep-months", type=int, default=12, help="full months kept in DB besides the current one")
+    parser.add_argument("--ahead", type=int, default=3, help="months to create partitions for in advance")
+    parser.add_argument("--dir", default="archive", help="directory for archive files")
+    parser.add_argument("--batch", type=int, default=5000, help="rows per export query")
+    parser.add_argument("--ensure-only", action="store_true", help="only add partitions")
+    parser.add_argument("--dry-run", action="store_true", help="only show what would be done")
+    args = parser.parse_args()
+    try:
+        await ensure_partitions(args.ahead, args.dry_run)
+        if not args.ensure_only:
+            await archive(args.keep_months, args.dir, args.batch, args.dry_run)
+    finally:
+        await close_pool()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,150 @@
+"""
+Benchmark of `requests` lookups before and after migration 005 on a generated dataset.
+Creates two scratch tables in the bot DB: `bench_requests_old` (schema before 005: primary key only)
+and `bench_requests_new` (indexes + monthly partitions), fills both with the same rows and times
+typical queries. Tables are dropped at the end unless --keep.
+
+    python -m tools.bench_requests --rows 1000000 --runs 200
+"""
+import argparse
+import asyncio
+import datetime
+import random
+import statistics
+import time
+
+from db import execute, fetchall, close_pool
+from tools.archive_requests import _add_months, _name
+
+
+_COLUMNS = """
+    id INT AUTO_INCREMENT,
+    user_id BIGINT NOT NULL,
+    user_state TEXT,
+    datetime_request DATETIME NOT NULL,
+    datetime_response DATETIME,
+    delay FLOAT,
+    request TEXT,
+    status_oai BOOLEAN,
+    status_tg BOOLEAN,
+    cached_response_id INT,
+    credits INT NOT NULL DEFAULT 0
+"""
+
+## name -> (SQL, params generator)
+_QUERIES = {
+    "user history (last 20)": (
+        "SELECT id, datetime_request, request FROM {t} WHERE user_id=%s ORDER BY datetime_request DESC LIMIT 20",
+        lambda rnd, a: (rnd.randint(1, a.users),)
+    ),
+    "user requests in month": (
+        "SELECT COUNT(*) AS n FROM {t} WHERE user_id=%s AND datetime_request >= %s AND datetime_request < %s",
+        lambda rnd, a: (rnd.randint(1, a.users), *_random_range(rnd, a, 30))
+    ),
+    "day stats": (
+        "SELECT COUNT(*) AS n, AVG(delay) AS delay FROM {t} WHERE datetime_request >= %s AND datetime_request < %s",
+        lambda rnd, a: _random_range(rnd, a, 1)
+    ),
+    "request by id": (
+        "SELECT * FROM {t} WHERE id=%s",
+        lambda rnd, a: (rnd.randint(1, a.rows),)
+    ),
+}
+
+
+def _start(months):
+    return _add_months(datetime.date.today().replace(day=1), -months + 1)
+
+
+def _random_range(rnd, args, days):
+    start = datetime.datetime.combine(_start(args.months), datetime.time()) + datetime.timedelta(days=rnd.randint(0, args.months * 30 - days))
+    return start, start + datetime.timedelta(days=days)
+
+
+async def create_tables(months):
+    await execute("DROP TABLE IF EXISTS bench_requests_old, bench_requests_new")
+    await execute(f"CREATE TABLE bench_requests_old ({_COLUMNS}, PRIMARY KEY (id))")
+    first = _start(months)
+    parts = ", ".join(
+        f"PARTITION {_name(_add_months(first, n))} VALUES LESS THAN ('{_add_months(first, n + 1)}')" for n in range(months + 1)
+    )
+    await execute(
+        f"""
+        CREATE TABLE bench_requests_new ({_COLUMNS},
+            PRIMARY KEY (id, datetime_request),
+            KEY idx_user_time (user_id, datetime_request),
+            KEY idx_cached_response (cached_response_id)
+        )
+        PARTITION BY RANGE COLUMNS (datetime_request) ({parts}, PARTITION pmax VALUES LESS THAN (MAXVALUE))
+        """
+    )
+
+
+async def fill(args):
+    """Same rows into both tables: requests of `users` users spread over `months`."""
+    rnd = random.Random(1)
+    start = datetime.datetime.combine(_start(args.months), datetime.time())
+    span = int((datetime.datetime.now() - start).total_seconds())
+    times = sorted(start + datetime.timedelta(seconds=rnd.randint(0, span)) for _ in range(args.rows))
+    t0 = time.monotonic()
+    for i in range(0, args.rows, args.batch):
+        values = []
+        for at in times[i:i + args.batch]:
+            delay = round(rnd.uniform(2, 60), 2)
+            values += [
+                rnd.randint(1, args.users), '{"lang": "ru"}', at, at + datetime.timedelta(seconds=delay), delay,
+                f"genesis {rnd.randint(1, 50)} {rnd.randint(1, 30)}", True, True, 0
+            ]
+        await execute(
+            f"""
+            INSERT INTO bench_requests_old
+                (user_id, user_state, datetime_request, datetime_response, delay, request, status_oai, status_tg, credits)
+            VALUES {','.join(['(%s,%s,%s,%s,%s,%s,%s,%s,%s)'] * (len(values) // 9))}
+            """,
+            values
+        )
+        print(f"\r  {min(i + args.batch, args.rows)} rows ({time.monotonic() - t0:.0f} s)", end="", flush=True)
+    print()
+    await execute("INSERT INTO bench_requests_new SELECT * FROM bench_requests_old")
+    await execute("ANALYZE TABLE bench_requests_old, bench_requests_new")
+
+
+async def run_query(table, sql, params_of, args):
+    rnd = random.Random(2)
+    times = []
+    for _ in range(args.runs):
+        params = params_of(rnd, args)
+        t0 = time.perf_counter()
+        await fetchall(sql.format(t=table), params)
+        times.append((time.perf_counter() - t0) * 1000)
+    times.sort()
+    return statistics.median(times), times[int(len(times) * 0.95) - 1]
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--months", type=int, default=24, help="requests are spread over this many months")
+    parser.add_argument("--runs", type=int, default=200, help="runs of every query")
+    parser.add_argument("--batch", type=int, default=5000, help="rows per INSERT")
+    parser.add_argument("--keep", action="store_true", help="don't drop bench tables (reuse with --no-fill)")
+    parser.add_argument("--no-fill", action="store_true", help="use tables left by --keep")
+    args = parser.parse_args()
+    try:
+        if not args.no_fill:
+            await create_tables(args.months)
+            await fill(args)
+        print(f"{'query':<26}{'before p50/p95, ms':>22}{'after p50/p95, ms':>22}")
+        for name, (sql, params_of) in _QUERIES.items():
+            before = await run_query("bench_requests_old", sql, params_of, args)
+            after = await run_query("bench_requests_new", sql, params_of, args)
+            print(f"{name:<26}{before[0]:>13.2f} /{before[1]:>7.2f}{after[0]:>13.2f} /{after[1]:>7.2f}")
+        if not args.keep:
+            await execute("DROP TABLE IF EXISTS bench_requests_old, bench_requests_new")
+    finally:
+        await close_pool()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,80 @@
+"""
+Benchmark of answer post-processing (utils.tghtml): sanitize + split of large synthetic LLM answers.
+Also checks every part: visible UTF-16 length within the limit and balanced tags.
+
+    python -m tools.bench_split --size 200000 --runs 20
+"""
+import argparse
+import html
+import random
+import re
+import time
+
+from utils.tghtml import telegram_html_parts, utf16_len, TELEGRAM_MAX_LENGTH, TELEGRAM_TAGS
+
+
+_WORDS = ["בְּרֵאשִׁית", "корень", "root", "слово", "ברא", "אֱלֹהִים", "значение", "🙂", "x²", "a<b", "&", "R&amp;D"]
+_TAG_RE = re.compile(r"<(/?)([a-zA-Z][a-zA-Z0-9-]*)[^<>]*>")
+
+
+def make_answer(size, seed=1):
+    """Synthetic answer like LLM output: nested tags with attributes, <br>, unsupported tags, entities, emoji."""
+    rnd = random.Random(seed)
+    out = ["Korneslov: genesis 1 1\n<br><br>"]
+    total = 0
+    while total < size:
+        line = " ".join(rnd.choice(_WORDS) for _ in range(rnd.randint(5, 60)))
+        kind = rnd.random()
+        if kind < 0.2:
+            line = f"<b>{line[:20]}</b> <i>{line[20:]}</i>"
+        elif kind < 0.3:
+            line = f"<h3>{line}</h3>"
+        elif kind < 0.4:
+            line = f'<a href="https://example.com/{total}"><b>{line}</b></a> x<sup>2</sup>'
+        elif kind < 0.5:
+            line = f"<blockquote><i>{line}<br>{line}</i></blockquote>"
+        elif kind < 0.55:
+            ## One very long line without line breaks
+            line = "<code>" + " ".join([line] * 20) + "</code>"
+        out.append(line + rnd.choice(["<br>", "\n", "<br/>\n", "\n\n"]))
+        total += len(out[-1])
+    return "".join(out)
+
+
+def check_parts(parts, max_length):
+    for i, part in enumerate(parts):
+        visible = utf16_len(html.unescape(_TAG_RE.sub("", part)))
+        assert visible <= max_length, f"part {i}: {visible} > {max_length}"
+        stack = []
+        for closing, tag in _TAG_RE.findall(part):
+            tag = tag.lower()
+            assert tag in TELEGRAM_TAGS, f"part {i}: unsupported tag {tag}"
+            if closing:
+                assert stack and stack.pop() == tag, f"part {i}: unbalanced </{tag}>"
+            else:
+                stack.append(tag)
+        assert not stack, f"part {i}: unclosed {stack}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=100000, help="answer size, chars")
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--max-length", type=int, default=TELEGRAM_MAX_LENGTH)
+    args = parser.parse_args()
+
+    text = make_answer(args.size)
+    parts = telegram_html_parts(text, args.max_length)
+    check_parts(parts, args.max_length)
+
+    t0 = time.perf_counter()
+    for _ in range(args.runs):
+        telegram_html_parts(text, args.max_length)
+    elapsed = (time.perf_counter() - t0) / args.runs
+    fill = sum(utf16_len(html.unescape(_TAG_RE.sub("", p))) for p in parts) / (len(parts) * args.max_length)
+    print(f"answer: {len(text)} chars, {len(parts)} parts, avg fill {fill:.1%}")
+    print(f"{elapsed * 1000:.2f} ms per answer, {len(text) / elapsed / 1e6:.1f} Mchars/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Streaming export of `requests`, `responses` (texts decompressed) or `tgpayments` to JSON lines or CSV,
+optionally gzipped. Memory use doesn't depend on table size. Interrupted export is resumed
+by --after-id (printed on stop) with --append.
+
+    python -m tools.export_data requests -o requests.jsonl.gz
+    python -m tools.export_data tgpayments --format csv -o payments.csv
+    python -m tools.export_data responses -o responses.jsonl.gz --after-id 120000 --append
+    python -m tools.export_data requests --format csv | head
+"""
+import argparse
+import asyncio
+import gzip
+import io
+import sys
+
+from db import close_pool
+from db.export import export, EXPORTS, FORMATS
+
+
+def open_output(path, append, compress):
+    if path == "-":
+        if compress:
+            return io.TextIOWrapper(gzip.GzipFile(fileobj=sys.stdout.buffer, mode="wb"), encoding="utf-8", newline="")
+        return sys.stdout
+    mode = "at" if append else "wt"
+    ## Appending to gzip adds one more member, readers see one stream
+    if compress:
+        return gzip.open(path, mode, encoding="utf-8", newline="")
+    return open(path, mode[0], encoding="utf-8", newline="")
+
+
+async def report_progress(progress, interval=5):
+    while True:
+        await asyncio.sleep(interval)
+        print(f"  {progress.get('count', 0)} rows, last id {progress.get('last_id')}", file=sys.stderr)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("table", choices=sorted(EXPORTS))
+    parser.add_argument("-o", "--output", default="-", help="output file, '-' - stdout (default)")
+    parser.add_argument("--format", choices=FORMATS, default="jsonl")
+    parser.add_argument("--gzip", action="store_true", help="compress output (default for *.gz files)")
+    parser.add_argument("--after-id", type=int, default=0, help="export rows with greater id (resume)")
+    parser.add_argument("--append", action="store_true", help="append to output (no CSV header)")
+    parser.add_argument("--chunk", type=int, default=10000, help="rows per query")
+    parser.add_argument("--fetch", type=int, default=1000, help="rows per fetch from server")
+    args = parser.parse_args()
+
+    out = open_output(args.output, args.append, args.gzip or args.output.endswith(".gz"))
+    progress = {}
+    reporter = asyncio.create_task(report_progress(progress))
+    try:
+        count, last_id = await export(
+            args.table, out, args.format, args.after_id, header=not args.append,
+            progress=progress, chunk_rows=args.chunk, fetch_size=args.fetch
+        )
+        print(f"Exported {count} {args.table} rows, last id {last_id}", file=sys.stderr)
+    except (Exception, asyncio.CancelledError):
+        print(f"Export stopped after {progress.get('count', 0)} rows, resume with: --after-id {progress.get('last_id', args.after_id)} --append", file=sys.stderr)
+        raise
+    finally:
+        reporter.cancel()
+        if out is not sys.stdout:
+            out.close()
+        await close_pool()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        sys.exit(130)
@@ -0,0 +1,143 @@
+"""
+Stand-in Telegram Bot API server for local testing of webhook mode.
+
+- Serves Bot API methods the bot calls (sendMessage, editMessageText, deleteMessage, setWebhook...) with
+  plausible results and counts them.
+- Posts synthetic updates (text messages from N users) to the bot's webhook and reports latencies
+  and peak rate of sent/edited messages (all worker processes together - compare with TG_GLOBAL_RATE).
+
+Run bot with TELEGRAM_API_URL=http://127.0.0.1:8081 BOT_MODE=webhook WEBHOOK_BASE_URL= and then:
+
+    python -m tools.fake_telegram --webhook http://127.0.0.1:8080/tg/webhook --updates 200 --users 50 --text "бытие 1 1"
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import time
+from collections import Counter
+
+from aiohttp import ClientSession, web
+
+
+_message_ids = itertools.count(1)
+_update_ids = itertools.count(1)
+calls = Counter()
+sent_at = {}
+## Sent and edited messages per second (whole bot, all workers)
+sends_per_second = Counter()
+
+
+def _message(chat_id, text, message_id=None):
+    return {
+        "message_id": message_id or next(_message_ids),
+        "date": int(time.time()),
+        "chat": {"id": int(chat_id), "type": "private"},
+        "from": {"id": 1, "is_bot": True, "first_name": "Korneslov"},
+        "text": text or "",
+    }
+
+
+async def handle_method(request):
+    method = request.match_info["method"]
+    params = dict(await request.post())
+    calls[method] += 1
+    if method in ("sendMessage", "editMessageText"):
+        sends_per_second[int(time.monotonic())] += 1
+    chat_id = params.get("chat_id", 0)
+    if method == "getMe":
+        result = {"id": 1, "is_bot": True, "first_name": "Korneslov", "username": "korneslov_fake_bot"}
+    elif method in ("sendMessage", "sendInvoice"):
+        result = _message(chat_id, params.get("text"))
+        if chat_id in sent_at:
+            calls["first_reply_latency_ms"] += int((time.monotonic() - sent_at.pop(chat_id)) * 1000)
+            calls["first_replies"] += 1
+    elif method == "editMessageText":
+        result = _message(chat_id, params.get("text"), message_id=int(params.get("message_id", 0)) or None)
+    else:
+        ## setWebhook, deleteMessage, answerCallbackQuery, ...
+        result = True
+    return web.json_response({"ok": True, "result": result})
+
+
+def make_update(user_id, text):
+    update_id = next(_update_ids)
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "language_code": "ru"},
+            "text": text,
+        },
+    }
+
+
+async def post_updates(webhook, secret, updates, users, text, concurrency):
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+    latencies = []
+    statuses = Counter()
+    sem = asyncio.Semaphore(concurrency)
+
+    async def post(session, i):
+        user_id = 100000 + i % users
+        async with sem:
+            sent_at.setdefault(str(user_id), time.monotonic())
+            t0 = time.monotonic()
+            async with session.post(webhook, json=make_update(user_id, text), headers=headers) as resp:
+                statuses[resp.status] += 1
+                await resp.read()
+            latencies.append(time.monotonic() - t0)
+
+    async with ClientSession() as session:
+        t0 = time.monotonic()
+        await asyncio.gather(*(post(session, i) for i in range(updates)))
+        elapsed = time.monotonic() - t0
+    latencies.sort()
+    print(f"Posted {updates} updates in {elapsed:.2f}s ({updates / elapsed:.0f}/s), statuses={dict(statuses)}")
+    if latencies:
+        print(f"Webhook latency p50={latencies[len(latencies) // 2] * 1000:.1f}ms p95={latencies[int(len(latencies) * 0.95) - 1] * 1000:.1f}ms")
+
+
+async def run(args):
+    app = web.Application()
+    app.router.add_route("*", "/bot{token}/{method}", handle_method)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, args.host, args.port).start()
+    print(f"Fake Telegram API on http://{args.host}:{args.port}")
+    try:
+        if args.webhook and args.updates:
+            await post_updates(args.webhook, args.secret, args.updates, args.users, args.text, args.concurrency)
+            ## Give the bot time to answer
+            await asyncio.sleep(args.wait)
+            replies = calls.get("first_replies", 0)
+            if replies:
+                print(f"First reply latency avg={calls['first_reply_latency_ms'] / replies:.0f}ms over {replies} chats")
+            if sends_per_second:
+                print(f"Peak send rate: {max(sends_per_second.values())} messages/s")
+            print("Bot API calls:", json.dumps({k: v for k, v in calls.items() if not k.startswith("first_")}, ensure_ascii=False))
+        else:
+            while True:
+                await asyncio.sleep(3600)
+    finally:
+        await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stand-in Telegram Bot API server and update generator")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--webhook", default="", help="bot webhook URL to post updates to")
+    parser.add_argument("--secret", default="", help="WEBHOOK_SECRET of the bot")
+    parser.add_argument("--updates", type=int, default=0, help="number of updates to post (0 - only serve API)")
+    parser.add_argument("--users", type=int, default=10, help="number of distinct users")
+    parser.add_argument("--text", default="/start", help="message text of updates")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--wait", type=float, default=10.0, help="seconds to wait for bot replies after posting")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
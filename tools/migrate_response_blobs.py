@@ -0,0 +1,110 @@
+"""
+Move texts of `responses.data` into compressed, deduplicated `response_blobs` (migration 004) and report
+the space saved. Safe to rerun: only rows without `data_hash` are processed.
+
+    python -m tools.migrate_response_blobs --batch 500
+    python -m tools.migrate_response_blobs --report
+
+InnoDB keeps freed pages inside the table file; run `OPTIMIZE TABLE responses` to give the space back to the OS.
+"""
+import argparse
+import asyncio
+import time
+
+from db import fetchone, fetchall, acquire, close_pool
+from db.responses import pack_response
+
+
+async def migrate_batch(rows):
+    """Store blobs of `rows` (id, data) and switch the rows to them, one transaction. Returns new blobs count."""
+    blobs = {}
+    hashes = {}
+    for row in rows:
+        packed = pack_response(row["data"])
+        blobs[packed[0]] = packed
+        hashes[row["id"]] = packed[0]
+    async with acquire() as conn:
+        await conn.begin()
+        try:
+            async with conn.cursor() as cur:
+                new_blobs = await cur.execute(
+                    f"INSERT IGNORE INTO response_blobs (hash, codec, size, data) VALUES {','.join(['(%s,%s,%s,%s)'] * len(blobs))}",
+                    [v for packed in blobs.values() for v in packed]
+                )
+                cases = " ".join(["WHEN %s THEN %s"] * len(hashes))
+                placeholders = ",".join(["%s"] * len(hashes))
+                await cur.execute(
+                    f"UPDATE responses SET data_hash = CASE id {cases} END, data = NULL WHERE id IN ({placeholders})",
+                    [v for item in hashes.items() for v in item] + list(hashes)
+                )
+            await conn.commit()
+        except BaseException:
+            await conn.rollback()
+            raise
+    return new_blobs
+
+
+async def migrate(batch):
+    last_id = 0
+    moved = new_blobs = 0
+    t0 = time.monotonic()
+    while True:
+        rows = await fetchall(
+            "SELECT id, data FROM responses WHERE id > %s AND data_hash IS NULL AND data IS NOT NULL ORDER BY id LIMIT %s",
+            (last_id, batch)
+        )
+        if not rows:
+            break
+        new_blobs += await migrate_batch(rows)
+        moved += len(rows)
+        last_id = rows[-1]["id"]
+        print(f"  {moved} responses moved, {new_blobs} new blobs, last id {last_id} ({time.monotonic() - t0:.1f} s)")
+    print(f"Done: {moved} responses moved into {new_blobs} new blobs")
+
+
+def _mb(value):
+    return f"{(value or 0) / 1024 / 1024:.1f} MB"
+
+
+async def report():
+    counts = await fetchone(
+        """
+        SELECT COUNT(*) AS responses,
+               SUM(data_hash IS NOT NULL) AS migrated,
+               SUM(data IS NOT NULL) AS legacy,
+               SUM(LENGTH(data)) AS legacy_bytes
+        FROM responses
+        """
+    )
+    logical = await fetchone(
+        "SELECT SUM(b.size) AS raw_bytes FROM responses r JOIN response_blobs b ON b.hash = r.data_hash"
+    )
+    stored = await fetchone(
+        "SELECT COUNT(*) AS blobs, SUM(size) AS raw_bytes, SUM(LENGTH(data)) AS stored_bytes FROM response_blobs"
+    )
+    legacy_bytes = int(counts["legacy_bytes"] or 0)
+    ## Size the migrated texts would take as plain LONGTEXT vs what they take now
+    before = int(logical["raw_bytes"] or 0)
+    unique = int(stored["raw_bytes"] or 0)
+    after = int(stored["stored_bytes"] or 0)
+    print(f"responses:        {counts['responses']} ({counts['migrated'] or 0} in blobs, {counts['legacy'] or 0} plain: {_mb(legacy_bytes)})")
+    print(f"blobs:            {stored['blobs']} unique texts")
+    print(f"plain size:       {_mb(before)}")
+    print(f"after dedup:      {_mb(unique)} ({before / unique:.2f}x)" if unique else "after dedup:      -")
+    print(f"after compress:   {_mb(after)} ({unique / after:.2f}x)" if after else "after compress:   -")
+    print(f"saved:            {_mb(before - after)}" + (f" ({1 - after / before:.1%})" if before else ""))
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch", type=int, default=500, help="rows per transaction")
+    parser.add_argument("--report", action="store_true", help="only show space usage")
+    args = parser.parse_args()
+    if not args.report:
+        await migrate(args.batch)
+    await report()
+    await close_pool()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,52 @@
+import re
+
+
+def is_truncated(answer: str, min_length=3500, ending_punct=('.','…','!','?', '>')):
+    """
+    Heuristics: if response length is close to max_tokens * 4 (about 3000 tokens = 4000–4500 symbols), ans response doesnt end on any sentence ending sign then the response is probably cutted.
+    """
+    answer = answer.strip()
+    ## Dirty hack - to permit false repeates and unneeded followups
+    ##if re.search(tr("utils_py.is_truncated_regexp"), answer):
+    ##Swithed to more universal marker
+    if re.search("<b>\u200b\u200b\u200b\u200b</b>", answer):
+        return False
+
+    long_enough = len(answer) >= min_length
+    truncated = long_enough and not answer.endswith(ending_punct)
+    return truncated
+
+
+def stitch_continuation(text, continuation, max_overlap=1000, min_overlap=20):
+    """
+    Append `continuation` to `text` without the part the model repeated from the end of `text`:
+    longest suffix of `text` that is a prefix of `continuation` (at least `min_overlap` chars),
+    or else the tail of `text` found near the start of `continuation`.
+    """
+    if not continuation:
+        return text
+    if not text:
+        return continuation
+    for cont in (continuation, continuation.lstrip()):
+        for k in range(min(len(text), len(cont), max_overlap), min_overlap - 1, -1):
+            if text.endswith(cont[:k]):
+                return text + cont[k:]
+    tail = text[-min_overlap:].strip()
+    if len(tail) >= min_overlap // 2:
+        idx = continuation.find(tail, 0, max_overlap)
+        if idx >= 0:
+            return text + continuation[idx + len(tail):]
+    return text + continuation
+
+
+def is_answer_truncated(answer, call_meta):
+    """
+    Provider's finish_reason decides ("length" - max tokens reached, "error" - stream broken on the way);
+    the length/punctuation heuristic is used only when provider gave no reason. Empty answer counts as truncated.
+    """
+    if not answer or ("text" in call_meta and not call_meta["text"].strip()):
+        return True
+    reason = call_meta.get("finish_reason")
+    if reason:
+        return reason in ("length", "error")
+    return is_truncated(answer)
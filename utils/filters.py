@@ -0,0 +1,34 @@
+from aiogram import BaseMiddleware
+from aiogram.filters import Filter
+from aiogram.types import Message
+
+from i18n.messages import button_keys
+
+
+class ButtonMiddleware(BaseMiddleware):
+    """
+    Outer message middleware: resolves the pressed menu button once per update. `data["button_keys"]` gets
+    i18n keys equal to message text in user's language (several if menus share a label, empty for other texts).
+    Button filters of all routers only match on them.
+    """
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        data["button_keys"] = button_keys(event.text, user_id=user.id if user else None) if event.text else frozenset()
+        return await handler(event, data)
+
+
+class Button(Filter):
+    """
+    Matches a menu button by i18n keys in user's language: `@router.message(Button("main_menu.help"))`.
+    Passes the matched key to the handler as `button` argument. Keys come from ButtonMiddleware.
+    """
+
+    def __init__(self, *keys):
+        self.keys = frozenset(keys)
+
+    async def __call__(self, message: Message, button_keys: frozenset = frozenset()):
+        matched = self.keys & button_keys
+        if not matched:
+            return False
+        return {"button": next(iter(matched))}
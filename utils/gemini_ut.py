@@ -1,9 +1,10 @@
 import logging
-import re
 from typing import Optional
 
 from google.genai import types as genai_types
 
+from utils.tghtml import sanitize_telegram_html
+
 
 def build_gemini_config(
     max_output_tokens: Optional[int],
@@ -27,6 +28,46 @@ def build_gemini_config(
         return None
 
 
+def extract_finish_reason_from_gemini_response(resp) -> str:
+    """
+    Normalized finish reason of candidates[0]: "stop", "length" (hit max_output_tokens) or provider value.
+    Works for full responses and stream chunks. Returns "" if not found.
+    """
+    try:
+        candidates = getattr(resp, "candidates", None)
+        if not candidates:
+            return ""
+        reason = getattr(candidates[0], "finish_reason", None)
+        if reason is None:
+            return ""
+        reason = str(getattr(reason, "name", reason)).upper()
+        if reason.endswith("MAX_TOKENS"):
+            return "length"
+        if reason.endswith("STOP"):
+            return "stop"
+        return reason.lower()
+    except Exception:
+        logging.exception("extract_finish_reason_from_gemini_response failed")
+        return ""
+
+
+def build_gemini_contents(user_content: str, history=None, followup: Optional[str] = None):
+    """
+    Build `contents` for generate_content: plain user text, or multi-turn conversation
+    (initial user prompt, prior turns from `history`, then `followup`) for continuations.
+    History items are {"role": "user"|"assistant", "content": str}.
+    """
+    if not history:
+        return followup or user_content
+    turns = [{"role": "user", "content": user_content}] + list(history)
+    if followup:
+        turns.append({"role": "user", "content": followup})
+    return [
+        {"role": "model" if t["role"] == "assistant" else "user", "parts": [{"text": t["content"]}]}
+        for t in turns
+    ]
+
+
 def extract_text_from_gemini_response(resp) -> str:
     """
     Extracts text from various Gemini response shapes.
@@ -116,13 +157,8 @@ def _get_candidate_content(cand):
 def sanitize_for_telegram_html(text: str) -> str:
     """
     Remove unsupported Telegram-HTML tags that cause parse errors, preserving inner text.
-    Minimal set: sup, sub, h1..h6. Extend if needed.
+    See utils.tghtml for the full set of rules.
     """
     if not isinstance(text, str) or not text:
         return text or ""
-
-    text = re.sub(r"</?sup[^>]*>", "", text, flags=re.IGNORECASE)
-    text = re.sub(r"</?sub[^>]*>", "", text, flags=re.IGNORECASE)
-    text = re.sub(r"</?h[1-6][^>]*>", "", text, flags=re.IGNORECASE)
-
-    return text
+    return sanitize_telegram_html(text)
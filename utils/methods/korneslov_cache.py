@@ -0,0 +1,160 @@
+import hashlib
+import json
+import logging
+import math
+from collections import OrderedDict
+
+from config import RESPONSE_CACHE_ENABLED, RESPONSE_CACHE_MAX_ITEMS, RESPONSE_CACHE_PRICE_FACTOR, AI_OUTPUT_FORMAT
+from i18n.messages import tr
+from texts.prompts import LEVELS, KORNESLOV_USER_PROMPT, LEVEL_SAMPLES, KORNESLOV_SYSTEM_PROMPT
+from services.ai_provider import get_provider_model
+from utils.utils import is_truncated
+from db.response_cache import get_cached_response, add_cached_response, touch_cached_response
+
+
+## In-process LRU layer: cache_key -> {"response_id", "request_id", "data"}
+_lru = OrderedDict()
+
+## (lang, level) -> hash of prompt templates
+_prompts_hashes = {}
+
+
+def _prompts_hash(lang, level):
+    """
+    Hash of the prompt templates an answer for given lang and level is generated with (same choice as
+    build_korneslov_prompt() and continuation in fetch_full_korneslov_response()) - cache is invalidated
+    when they change.
+    """
+    h = _prompts_hashes.get((lang, level))
+    if h is None:
+        levels = LEVELS.get(lang, LEVELS["ru"])
+        samples = LEVEL_SAMPLES.get(lang, LEVEL_SAMPLES["ru"])
+        templates = [
+            KORNESLOV_SYSTEM_PROMPT.get(lang, KORNESLOV_SYSTEM_PROMPT["ru"]),
+            KORNESLOV_USER_PROMPT.get(lang, KORNESLOV_USER_PROMPT["ru"]),
+            levels.get(level, levels["hard"]),
+            samples.get(level, samples["hard"]),
+            tr("korneslov_py.continue_prompt", lang=lang),
+        ]
+        if AI_OUTPUT_FORMAT == "markdown":
+            templates.append(tr("korneslov_py.markdown_format_prompt", lang=lang))
+        raw = json.dumps(templates, ensure_ascii=False, sort_keys=True, default=str)
+        h = hashlib.sha256(raw.encode("utf-8")).hexdigest()
+        _prompts_hashes[(lang, level)] = h
+    return h
+
+
+def build_cache_key(book_id, chapter, verses, level, lang, direction):
+    """
+    Canonical key of Korneslov request: book id, chapter, sorted verses set, level, lang, direction,
+    primary provider/model, prompt templates hash and answer format. Answers of other providers (fallback,
+    hedging) are not cached under this key, see is_cacheable_answer().
+    """
+    provider, model = get_provider_model()
+    parts = [
+        str(book_id),
+        str(chapter),
+        ",".join(str(v) for v in sorted(set(verses))),
+        level or "",
+        lang or "",
+        direction or "",
+        provider,
+        model or "",
+        _prompts_hash(lang, level),
+    ]
+    ## Default HTML format keeps keys of already cached answers
+    if AI_OUTPUT_FORMAT != "html":
+        parts.append(AI_OUTPUT_FORMAT)
+    return hashlib.sha256("|".join(parts).encode("utf-8")).hexdigest()
+
+
+def _lru_put(cache_key, entry):
+    _lru[cache_key] = entry
+    _lru.move_to_end(cache_key)
+    while len(_lru) > RESPONSE_CACHE_MAX_ITEMS:
+        _lru.popitem(last=False)
+
+
+async def get_cached_answer(cache_key):
+    """
+    Returns cached entry dict (response_id, request_id, data) or None.
+    Lookup only: the hit is counted by record_cache_hit() once the answer is actually served.
+    """
+    if not RESPONSE_CACHE_ENABLED:
+        return None
+    entry = _lru.get(cache_key)
+    if entry is None:
+        try:
+            entry = await get_cached_response(cache_key)
+        except Exception:
+            logging.exception("Response cache lookup failed")
+            return None
+        if not entry or not entry.get("data"):
+            return None
+        _lru_put(cache_key, entry)
+    else:
+        _lru.move_to_end(cache_key)
+    return entry
+
+
+async def record_cache_hit(cache_key):
+    """
+    Count a cache hit (`hits`, `last_hit` of the cache entry) - call when the cached answer is served.
+    """
+    try:
+        await touch_cached_response(cache_key)
+    except Exception:
+        logging.exception("Failed to count response cache hit")
+
+
+async def put_cached_answer(cache_key, response_id, request_id, answer):
+    if not RESPONSE_CACHE_ENABLED:
+        return
+    try:
+        await add_cached_response(cache_key, response_id)
+    except Exception:
+        logging.exception("Failed to store response in cache")
+        return
+    _lru_put(cache_key, {"response_id": response_id, "request_id": request_id, "data": answer})
+
+
+def is_cacheable_answer(answer, book, chapter, verses_str, lang="ru", meta=None):
+    """
+    Do not cache provider errors, truncated answers and answers not (fully) made by the primary provider
+    the cache key is built for (and nothing when cache is disabled).
+    `meta` of the generation (see fetch_full_korneslov_response) is trusted if given, else heuristics are used.
+    """
+    if not RESPONSE_CACHE_ENABLED or not answer:
+        return False
+    if meta is not None and "provider" in meta and meta["provider"] != get_provider_model()[0]:
+        return False
+    if meta is not None and "truncated" in meta:
+        if meta.get("error") or meta["truncated"]:
+            return False
+    elif is_truncated(answer):
+        return False
+    errors = (
+        tr("korneslov_py.ask_openai_exception_return", book=book, chapter=chapter, verse=verses_str, lang=lang),
+        tr("korneslov_py.ask_openai_no_OPENAI_API_KEY", book=book, chapter=chapter, verse=verses_str, test_banner="", lang=lang),
+    )
+    return answer not in errors
+
+
+def cached_price(price):
+    """
+    Price of request served from cache.
+    """
+    return max(0, int(round(price * RESPONSE_CACHE_PRICE_FACTOR)))
+
+
+def fanout_price(price, sections, answered, cached=0):
+    """
+    Price of fan-out request with `answered` of `sections` sections answered, `cached` of them from cache.
+    Every answered section costs its share of `price` (cached ones - at cache price), failed ones nothing.
+    The sum is rounded up: a paid request with any generated section costs at least 1, never more than `price`.
+    """
+    if not answered or price <= 0:
+        return 0
+    share = (answered - cached + cached * RESPONSE_CACHE_PRICE_FACTOR) * price / sections
+    ## Float noise is dropped before rounding up (3 sections * 1/3 must stay 1)
+    return min(price, math.ceil(round(share, 6)))
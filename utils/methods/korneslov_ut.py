@@ -1,13 +1,17 @@
 import re
+import asyncio
 import logging
+from itertools import groupby
 
+from config import KORNESLOV_DEADLINE, AI_OUTPUT_FORMAT
 from i18n.messages import tr
-from texts.prompts import LEVELS, FOLLOWUP_PROMPT, KORNESLOV_USER_PROMPT, LEVEL_SAMPLES, KORNESLOV_SYSTEM_PROMPT
+from texts.prompts import LEVELS, KORNESLOV_USER_PROMPT, LEVEL_SAMPLES, KORNESLOV_SYSTEM_PROMPT
 from texts.dummy_texts import *
-from utils.utils import _normalize_book, parse_references, _parse_verses, is_truncated
+from utils.utils import _normalize_book, parse_references, _parse_verses
+from utils.continuation import stitch_continuation, is_answer_truncated
 from utils.userstate import get_user_state
-from db import get_conn
-from db.books import find_book_entry, increment_book_hits
+from db.books import get_book_from_catalog
+from services.scheduler import llm_scheduler
 
 
 ## DUMMY_TEXT = True
@@ -37,9 +41,35 @@ async def is_valid_korneslov_query(message):
 
 
 async def _book_exists(book):
-    async with await get_conn() as conn:
-        result = await find_book_entry(book, conn)
-    return result is not None
+    return get_book_from_catalog(book) is not None
+
+
+def format_verses(verses):
+    """
+    Format verses list as ranges string (ex.: [1, 2, 3, 5] -> '1-3,5').
+    """
+    ranges = []
+    for k, g in groupby(enumerate(verses), lambda x: x[0] - x[1]):
+        group = list(map(lambda x: x[1], g))
+        if len(group) == 1:
+            ranges.append(str(group[0]))
+        else:
+            ranges.append(f"{group[0]}-{group[-1]}")
+    return ",".join(ranges)
+
+
+def split_verse_groups(verses, group_size=1):
+    """
+    Split verses into groups for fan-out: consecutive verses only, at most `group_size` in a group.
+    Ex.: [4, 6, 7, 8, 10], group_size=2 -> [[4], [6, 7], [8], [10]]
+    """
+    groups = []
+    for v in sorted(set(verses)):
+        if groups and v == groups[-1][-1] + 1 and len(groups[-1]) < group_size:
+            groups[-1].append(v)
+        else:
+            groups.append([v])
+    return groups
 
 
 def build_korneslov_prompt(book, chapter, verses_str, level_key, lang="ru"):
@@ -51,46 +81,104 @@ def build_korneslov_prompt(book, chapter, verses_str, level_key, lang="ru"):
     level_sample_dict = LEVEL_SAMPLES.get(lang, LEVEL_SAMPLES["ru"])
     level_sample = level_sample_dict.get(level_key, level_sample_dict["hard"])
     system_prompt_template = KORNESLOV_SYSTEM_PROMPT.get(lang, KORNESLOV_SYSTEM_PROMPT["ru"])
-    return system_prompt_template.format(
+    prompt = system_prompt_template.format(
         book=book,
         chapter=chapter,
         verse=verses_str,
         level=level_str,
         level_sample=level_sample
     )
+    ## Markdown mode: answer is rendered to message entities locally (see utils.tgentities)
+    if AI_OUTPUT_FORMAT == "markdown":
+        prompt += tr("korneslov_py.markdown_format_prompt", lang=lang)
+    return prompt
 
 
-async def fetch_full_korneslov_response(book, chapter, verses_str, uid, level="hard", max_loops=5):
+async def fetch_full_korneslov_response(book, chapter, verses_str, uid, level="hard", max_loops=5, on_delta=None, lane="paid", meta=None):
     """
-    Receives full response by Korneslov method and making follow-up requests if need. With verses ranges support.
+    Receives full response by Korneslov method and making continuation requests if need. With verses ranges support.
+    If `on_delta` function is given, the first generation is streamed into it piece by piece; it must not block
+    (e.g. StreamingAnswer.feed only buffers), the provider stream is read without waiting for Telegram.
+    Generation waits for a slot of LLM scheduler in the given priority lane ("unlimited" or "paid").
+    `meta` dict gets "error" (answer is provider error text), "truncated", "continuations" and "provider"
+    that answered (None if continuations came from another provider).
     """
+    async with llm_scheduler.slot(uid, lane):
+        return await _generate_korneslov_response(book, chapter, verses_str, uid, level=level, max_loops=max_loops, on_delta=on_delta, meta=meta)
+
+
+async def _generate_korneslov_response(book, chapter, verses_str, uid, level="hard", max_loops=5, on_delta=None, meta=None):
     state = get_user_state(uid)
     lang = state.get("lang", "ru")
+    if meta is None:
+        meta = {}
 
-    async def gen_func(book, chapter, verses_str, system_prompt, followup=None):
+    async def gen_func(system_prompt, followup=None, history=None, call_meta=None):
         ## Provider-agnostic dispatch: OpenAI or Gemini is selected by AI_PROVIDER in config
         from services.ai_provider import ask_ai  ## keep here to avoid circular imports during refactor stage
-        return await ask_ai(uid, book, chapter, verses_str, system_prompt=system_prompt, followup=followup)
+        return await ask_ai(uid, book, chapter, verses_str, system_prompt=system_prompt, followup=followup, history=history, meta=call_meta)
 
-    system_prompt = build_korneslov_prompt(book, chapter, verses_str, level, lang=lang)
-    answer = await gen_func(book, chapter, verses_str, system_prompt=system_prompt, followup=None)
+    async def stream_func(system_prompt, call_meta=None):
+        from services.ai_provider import ask_ai_stream
+        pieces = []
+        async for piece in ask_ai_stream(uid, book, chapter, verses_str, system_prompt=system_prompt, meta=call_meta):
+            pieces.append(piece)
+            on_delta(piece)
+        return "".join(pieces).strip()
 
-    ## Treat empty as truncated to allow a followup attempt
-    truncated = is_truncated(answer) or (not answer)
+    ## Overall budget of the generation with all its continuations
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + KORNESLOV_DEADLINE if KORNESLOV_DEADLINE > 0 else None
 
-    if not truncated:
-        return answer  ## full, return immediately
+    def time_left():
+        return None if deadline is None else deadline - loop.time()
 
-    all_answers = [answer]
+    system_prompt = build_korneslov_prompt(book, chapter, verses_str, level, lang=lang)
+    call_meta = {}
+    if on_delta is not None:
+        answer = await asyncio.wait_for(stream_func(system_prompt, call_meta=call_meta), time_left())
+    else:
+        answer = await asyncio.wait_for(gen_func(system_prompt, call_meta=call_meta), time_left())
+
+    meta["error"] = bool(call_meta.get("error"))
+    meta["provider"] = call_meta.get("provider")
+    body = call_meta.get("text", "")
+    truncated = not meta["error"] and is_answer_truncated(answer, call_meta)
+
+    ## Continuation: previous output goes back as assistant turn, the model goes on from where it stopped.
+    ## A stream broken on the way is already recorded as failure by ask_ai_stream(), so ask_ai() routes
+    ## the continuation by the updated provider health (and may switch provider - not cached then).
     loops = 0
     while truncated and loops < max_loops:
-        followup_prompt_template = FOLLOWUP_PROMPT.get(lang, FOLLOWUP_PROMPT["ru"])
-        followup_prompt = followup_prompt_template.format(book=book, chapter=chapter, verse=verses_str)
-        answer = await gen_func(book, chapter, verses_str, system_prompt=system_prompt, followup=followup_prompt)
-        all_answers.append(answer)
-        truncated = is_truncated(answer) or (not answer)
+        left = time_left()
+        if left is not None and left <= 0:
+            logging.warning(f"Korneslov deadline exceeded for {book} {chapter}:{verses_str}, returning truncated answer")
+            break
+        if body.strip():
+            history = [{"role": "assistant", "content": body}]
+            followup = tr("korneslov_py.continue_prompt", lang=lang)
+        else:
+            ## Nothing to continue - plain retry
+            history, followup = None, None
+        cont_meta = {}
+        try:
+            cont = await asyncio.wait_for(gen_func(system_prompt, followup=followup, history=history, call_meta=cont_meta), left)
+        except asyncio.TimeoutError:
+            logging.warning(f"Korneslov deadline exceeded during continuation of {book} {chapter}:{verses_str}")
+            break
         loops += 1
-
-    ## Return the best (longest) attempt to avoid spamming with all partials
-    best_answer = max(all_answers, key=lambda s: len(s) if isinstance(s, str) else 0)
-    return best_answer
+        if cont_meta.get("error"):
+            break
+        if cont_meta.get("provider") != meta["provider"]:
+            meta["provider"] = None
+        piece = cont_meta.get("text", "")
+        if history:
+            answer = stitch_continuation(answer, piece)
+            body = stitch_continuation(body, piece)
+        else:
+            answer, body = cont, piece
+        truncated = is_answer_truncated(cont, cont_meta)
+
+    meta["truncated"] = truncated
+    meta["continuations"] = loops
+    return answer
@@ -0,0 +1,34 @@
+import asyncio
+import json
+import logging
+
+
+## Metrics sources: name -> function returning JSON-serializable dict
+_sources = {}
+
+
+def register_metrics(name, func):
+    _sources[name] = func
+
+
+def collect_metrics():
+    """
+    Snapshot of all registered metrics sources.
+    """
+    result = {}
+    for name, func in _sources.items():
+        try:
+            result[name] = func()
+        except Exception as e:
+            logging.exception("Metrics source %s failed", name)
+            result[name] = {"error": repr(e)}
+    return result
+
+
+async def log_metrics_periodically(interval=300):
+    """
+    Background task: write metrics snapshot to log every `interval` seconds.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        logging.info("METRICS: %s", json.dumps(collect_metrics(), ensure_ascii=False, default=str))
@@ -44,3 +44,20 @@ def extract_text_from_openai_response(resp) -> str:
         except Exception:
             pass
         return ""
+
+
+def extract_finish_reason_from_openai_response(resp) -> str:
+    """
+    Normalized finish reason of choices[0]: "stop", "length" (hit max_tokens) or provider value.
+    Returns "" if not found.
+    """
+    try:
+        choices = getattr(resp, "choices", None) or (resp.get("choices") if isinstance(resp, dict) else None)
+        if not choices:
+            return ""
+        c0 = choices[0]
+        reason = getattr(c0, "finish_reason", None) or (c0.get("finish_reason") if isinstance(c0, dict) else None)
+        return str(reason or "").lower()
+    except Exception:
+        logging.exception("extract_finish_reason_from_openai_response failed")
+        return ""
@@ -0,0 +1,127 @@
+import asyncio
+import logging
+from collections import deque
+
+import aiogram.exceptions as aiogram_exceptions
+
+from config import OUTBOX_MAX_ATTEMPTS, OUTBOX_RETRY_BASE_DELAY, OUTBOX_RETRY_MAX_DELAY
+from db.requests import update_request_delivery
+from utils.safe_send import answer_safe_message
+from utils.metrics import register_metrics
+
+
+## Outbound delivery queue: chat_id -> deque of jobs, one worker task per chat with pending jobs.
+## Jobs of a chat are delivered strictly in order; different chats are delivered concurrently.
+_queues = {}
+_workers = {}
+_stats = {"delivered": 0, "failed": 0, "retries": 0}
+
+## Errors that retry won't fix (bot blocked, chat deleted)
+_PERMANENT_ERRORS = (aiogram_exceptions.TelegramForbiddenError, aiogram_exceptions.TelegramNotFound)
+
+
+def send_parts(target, parts, parse_mode="HTML", request_id=None, requested_at=None, **kwargs):
+    """
+    Enqueue multi-part message for background delivery to target's chat and return immediately.
+    Parts are HTML strings or (text, entities) tuples (see utils.tgentities).
+    Parts are sent in order with answer_safe_message() (rate-limited, HTML fallback); transient errors are
+    retried with exponential backoff, resuming from the failed part. If `request_id` is given, delivery
+    result is reported to `requests.status_tg` (`requested_at` - its `datetime_request`, see begin_request()).
+    Returns asyncio.Future resolved with True (delivered) or False.
+    """
+    future = asyncio.get_running_loop().create_future()
+    job = {
+        "target": target,
+        "parts": [p for p in parts if p],
+        "parse_mode": parse_mode,
+        "kwargs": kwargs,
+        "request_id": request_id,
+        "requested_at": requested_at,
+        "future": future,
+        "sent": 0,
+    }
+    chat_id = target.chat.id
+    _queues.setdefault(chat_id, deque()).append(job)
+    if chat_id not in _workers:
+        _workers[chat_id] = asyncio.create_task(_worker(chat_id))
+    return future
+
+
+async def _worker(chat_id):
+    queue = _queues[chat_id]
+    try:
+        while queue:
+            job = queue[0]
+            try:
+                delivered = await _deliver(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logging.exception("Outbox delivery to chat %s crashed", chat_id)
+                delivered = False
+            queue.popleft()
+            _stats["delivered" if delivered else "failed"] += 1
+            if not job["future"].done():
+                job["future"].set_result(delivered)
+            if job["request_id"] is not None:
+                try:
+                    await update_request_delivery(job["request_id"], delivered, job["requested_at"])
+                except Exception:
+                    logging.exception("Failed to report delivery of request %s", job["request_id"])
+    finally:
+        del _workers[chat_id]
+        if not queue:
+            del _queues[chat_id]
+
+
+async def _deliver(job):
+    target = job["target"]
+    while job["sent"] < len(job["parts"]):
+        part = job["parts"][job["sent"]]
+        text, entities = part if isinstance(part, tuple) else (part, None)
+        attempt = 0
+        while True:
+            try:
+                if await answer_safe_message(target, text, parse_mode=job["parse_mode"], entities=entities, **job["kwargs"]) is None:
+                    raise RuntimeError("message was not sent (plain text fallback failed)")
+                break
+            except _PERMANENT_ERRORS as e:
+                logging.warning("Outbox: chat %s is unreachable: %s", target.chat.id, e)
+                return False
+            except Exception as e:
+                attempt += 1
+                if attempt >= OUTBOX_MAX_ATTEMPTS:
+                    logging.error("Outbox: giving up part %s of message to chat %s: %r", job["sent"] + 1, target.chat.id, e)
+                    return False
+                _stats["retries"] += 1
+                delay = min(OUTBOX_RETRY_MAX_DELAY, OUTBOX_RETRY_BASE_DELAY * 2 ** (attempt - 1))
+                logging.warning("Outbox: send to chat %s failed (%r), retry in %.1f s", target.chat.id, e, delay)
+                await asyncio.sleep(delay)
+        job["sent"] += 1
+    return True
+
+
+async def drain_outbox(timeout=10.0):
+    """
+    Wait (on shutdown) until pending messages are delivered, at most `timeout` seconds.
+    """
+    workers = list(_workers.values())
+    if not workers:
+        return
+    done, pending = await asyncio.wait(workers, timeout=timeout)
+    if pending:
+        logging.warning("Outbox: %s chats still had undelivered messages on shutdown", len(pending))
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+
+def outbox_stats():
+    return {
+        "chats": len(_queues),
+        "queued": sum(len(q) for q in _queues.values()),
+        **_stats,
+    }
+
+
+register_metrics("outbox", outbox_stats)
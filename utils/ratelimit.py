@@ -0,0 +1,75 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    """
+    Token bucket in "theoretical arrival time" form: `rate` calls per second with bursts up to `burst` calls.
+    reserve() books the next call and returns how long the caller has to wait for it.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.tolerance = max(0, burst - 1) * self.interval
+        self.tat = 0.0
+        self.paused_until = 0.0
+
+    def reserve(self) -> float:
+        now = time.monotonic()
+        tat = max(self.tat, now)
+        allowed_at = max(tat - self.tolerance, self.paused_until)
+        self.tat = max(tat, allowed_at) + self.interval
+        return max(0.0, allowed_at - now)
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def idle(self) -> bool:
+        now = time.monotonic()
+        return self.tat <= now and self.paused_until <= now
+
+
+class TelegramRateLimiter:
+    """
+    Limits all outgoing Telegram calls: global bucket (bot-wide limit) plus one bucket per chat.
+    TelegramRetryAfter pauses the chat bucket for the time Telegram asked.
+    """
+
+    def __init__(self, global_rate: float, global_burst: int, chat_rate: float, chat_burst: int, max_chats: int = 10000):
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_chats = max_chats
+        self.chats = {}
+        self.waited = 0.0
+        self.retry_after = 0
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self.chats.get(chat_id)
+        if bucket is None:
+            if len(self.chats) >= self.max_chats:
+                ## Drop buckets of chats that are quiet now - they are at full burst anyway
+                self.chats = {k: b for k, b in self.chats.items() if not b.idle()}
+            bucket = self.chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def acquire(self, chat_id=None):
+        if chat_id is not None:
+            delay = self._chat_bucket(chat_id).reserve()
+            if delay > 0:
+                self.waited += delay
+                await asyncio.sleep(delay)
+        delay = self.global_bucket.reserve()
+        if delay > 0:
+            self.waited += delay
+            await asyncio.sleep(delay)
+
+    def pause(self, chat_id, seconds: float):
+        self.retry_after += 1
+        if chat_id is None:
+            self.global_bucket.pause(seconds)
+        else:
+            self._chat_bucket(chat_id).pause(seconds)
+
+    def stats(self):
+        return {"chats": len(self.chats), "waited_seconds": round(self.waited, 1), "retry_after": self.retry_after}
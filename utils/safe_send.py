@@ -1,31 +1,221 @@
+import asyncio
 import logging
 import html
+import re
 from typing import Optional
 
 from aiogram import types
 import aiogram.exceptions as aiogram_exceptions
 
+from config import TG_GLOBAL_RATE, TG_GLOBAL_BURST, TG_CHAT_RATE, TG_CHAT_BURST, TG_RETRY_AFTER_ATTEMPTS
+from utils.metrics import register_metrics
+from utils.workers import per_process
+from utils.ratelimit import TelegramRateLimiter
+from utils.tghtml import telegram_text_parts
+
+
+## Bot-wide limit is split between webhook worker processes; chat limit holds per process
+## (answers to a chat are normally sent by the process which handled its update)
+rate_limiter = TelegramRateLimiter(per_process(TG_GLOBAL_RATE), per_process(TG_GLOBAL_BURST), TG_CHAT_RATE, TG_CHAT_BURST)
+register_metrics("telegram_send", rate_limiter.stats)
+
+
+async def tg_call(chat_id, func, *args, **kwargs):
+    """
+    Rate-limited Telegram API call: waits for the chat and global limits and
+    retries after TelegramRetryAfter (up to TG_RETRY_AFTER_ATTEMPTS times).
+    """
+    attempt = 0
+    while True:
+        await rate_limiter.acquire(chat_id)
+        try:
+            return await func(*args, **kwargs)
+        except aiogram_exceptions.TelegramRetryAfter as e:
+            attempt += 1
+            if attempt > TG_RETRY_AFTER_ATTEMPTS:
+                raise
+            logging.warning("Telegram flood control for chat %s: retry in %s s", chat_id, e.retry_after)
+            rate_limiter.pause(chat_id, e.retry_after)
+
+
+def _chat_id(msg: types.Message):
+    chat = getattr(msg, "chat", None)
+    return getattr(chat, "id", None)
+
+
 ## helper to send replies safely when text may contain broken HTML
-async def answer_safe_message(target: types.Message | types.CallbackQuery, text: str, parse_mode: Optional[str] = "HTML", **kwargs):
+def _entities(entities):
+    return [e if isinstance(e, types.MessageEntity) else types.MessageEntity(**e) for e in entities]
+
+
+async def answer_safe_message(target: types.Message | types.CallbackQuery, text: str, parse_mode: Optional[str] = "HTML", entities=None, **kwargs):
     """
     target: types.Message or types.CallbackQuery (we'll send into .message for callback)
     try to send with parse_mode (HTML by default); on TelegramBadRequest fallback to escaped text w/o parse mode.
+    With `entities` (list of MessageEntity or dicts, see utils.tgentities) text is sent as is, without parse mode;
+    fallback drops the entities.
+    Sending is rate-limited (see tg_call()).
     """
     try:
         if isinstance(target, types.CallbackQuery):
             msg_target = target.message
         else:
             msg_target = target
+        chat_id = _chat_id(msg_target)
 
+        if entities is not None:
+            return await tg_call(chat_id, msg_target.answer, text, parse_mode=None, entities=_entities(entities), **kwargs)
         if parse_mode:
-            await msg_target.answer(text, parse_mode=parse_mode, **kwargs)
+            return await tg_call(chat_id, msg_target.answer, text, parse_mode=parse_mode, **kwargs)
         else:
-            await msg_target.answer(text, **kwargs)
+            return await tg_call(chat_id, msg_target.answer, text, **kwargs)
     except aiogram_exceptions.TelegramBadRequest as e:
         ## Could be "can't parse entities" or other parse errors. Fallback to escaped text without parse_mode.
         logging.warning("TelegramBadRequest while sending message; falling back to plain text: %s", e)
         try:
-            safe_text = html.escape(text)
-            await msg_target.answer(safe_text, **{k: v for k, v in kwargs.items() if k != "parse_mode"})
+            if entities is not None:
+                return await tg_call(chat_id, msg_target.answer, text, parse_mode=None, **kwargs)
+            ## Escaping makes text longer than the part it was split as - split again (last message is returned)
+            sent = None
+            for safe_text in telegram_text_parts(html.escape(text)):
+                sent = await tg_call(chat_id, msg_target.answer, safe_text, **{k: v for k, v in kwargs.items() if k != "parse_mode"})
+            return sent
         except Exception as e2:
             logging.exception("Failed to send fallback message: %s", e2)
+
+
+## helper to edit already sent message safely (same fallback as answer_safe_message)
+async def edit_safe_message(msg: types.Message, text: str, parse_mode: Optional[str] = "HTML", entities=None, **kwargs):
+    chat_id = _chat_id(msg)
+    try:
+        if entities is not None:
+            await tg_call(chat_id, msg.edit_text, text, parse_mode=None, entities=_entities(entities), **kwargs)
+        else:
+            await tg_call(chat_id, msg.edit_text, text, parse_mode=parse_mode, **kwargs)
+    except aiogram_exceptions.TelegramBadRequest as e:
+        if "message is not modified" in str(e):
+            return
+        if entities is not None:
+            logging.warning("TelegramBadRequest while editing message; falling back to plain text: %s", e)
+            await tg_call(chat_id, msg.edit_text, text, parse_mode=None, **kwargs)
+            return
+        if not parse_mode:
+            raise
+        logging.warning("TelegramBadRequest while editing message; falling back to plain text: %s", e)
+        await tg_call(chat_id, msg.edit_text, html.escape(text), parse_mode=None, **kwargs)
+
+
+def _html_to_preview(text: str) -> str:
+    """
+    Plain-text preview of partially generated HTML: <br> to newlines, tags (and unfinished tag at the end) removed.
+    """
+    text = re.sub(r"<br\s*/?>", "\n", text, flags=re.IGNORECASE)
+    text = re.sub(r"<[^>]*>", "", text)
+    text = re.sub(r"<[^>]*$", "", text)
+    return html.unescape(text)
+
+
+class StreamingAnswer:
+    """
+    Shows AI output while it is generated: posts a message and periodically edits it with new text,
+    starting a new message when the current one reaches `max_length`. Edits are throttled to
+    `edit_interval` seconds to respect Telegram edit limits.
+    feed() only buffers the text, so reading of the provider stream never waits for Telegram; edits are made
+    by a background flush task. Preview is sent as plain text (partial HTML can't be parsed); finish() replaces
+    it with final HTML parts, close() just stops previewing.
+    """
+
+    def __init__(self, target: types.Message, edit_interval: float = 2.0, max_length: int = 3800):
+        self.target = target
+        self.edit_interval = edit_interval
+        self.max_length = max_length
+        self.messages = []
+        self.shown = []
+        self.chunks = []
+        self.failed = False
+        self._pending = asyncio.Event()
+        self._task = None
+        self._flushing = False
+        self._closed = False
+
+    def feed(self, piece: str):
+        if not piece or self.failed or self._closed:
+            return
+        self.chunks.append(piece)
+        self._pending.set()
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        ## Edit when new text arrived, not more often than once per edit_interval
+        while not self.failed:
+            await self._pending.wait()
+            self._pending.clear()
+            self._flushing = True
+            try:
+                await self.flush()
+            finally:
+                self._flushing = False
+            if self._closed:
+                return
+            await asyncio.sleep(self.edit_interval)
+
+    async def close(self):
+        """Stop the flush task; an edit in progress is completed (finish() edits the same messages)."""
+        self._closed = True
+        task, self._task = self._task, None
+        if task is None:
+            return
+        if not self._flushing:
+            task.cancel()
+        await asyncio.wait([task])
+
+    async def flush(self):
+        preview = _html_to_preview("".join(self.chunks)).strip()
+        if not preview:
+            return
+        parts = [preview[i:i + self.max_length] for i in range(0, len(preview), self.max_length)]
+        chat_id = _chat_id(self.target)
+        try:
+            for i, part in enumerate(parts):
+                if i < len(self.messages):
+                    if self.shown[i] != part:
+                        await tg_call(chat_id, self.messages[i].edit_text, part, parse_mode=None)
+                        self.shown[i] = part
+                else:
+                    self.messages.append(await tg_call(chat_id, self.target.answer, part, parse_mode=None))
+                    self.shown.append(part)
+        except aiogram_exceptions.TelegramBadRequest as e:
+            if "message is not modified" not in str(e):
+                ## Stop previewing, final answer will be sent by finish()
+                logging.warning("Streaming preview disabled after Telegram error: %s", e)
+                self.failed = True
+        except Exception:
+            logging.exception("Streaming preview failed")
+            self.failed = True
+
+    async def finish(self, parts):
+        """
+        Replace preview messages with final HTML parts (or (text, entities) parts), send the rest as new messages,
+        drop unused previews.
+        Returns True if every part went out (sending errors are logged, not raised).
+        """
+        await self.close()
+        reused = 0 if self.failed else min(len(parts), len(self.messages))
+        delivered = True
+        for i, part in enumerate(parts):
+            text, entities = part if isinstance(part, tuple) else (part, None)
+            try:
+                if i < reused:
+                    await edit_safe_message(self.messages[i], text, parse_mode="HTML", entities=entities)
+                elif await answer_safe_message(self.target, text, parse_mode="HTML", entities=entities) is None:
+                    delivered = False
+            except Exception:
+                logging.exception("Failed to send final part %s of streamed answer", i + 1)
+                delivered = False
+        for msg in self.messages[reused:]:
+            try:
+                await tg_call(_chat_id(msg), msg.delete)
+            except Exception:
+                logging.exception("Failed to delete streaming preview message")
+        return delivered
@@ -0,0 +1,31 @@
+import asyncio
+import logging
+
+
+## In-flight registry: key -> asyncio.Task of the first caller
+_inflight = {}
+
+
+async def singleflight(key, func):
+    """
+    Run coroutine function `func()` once per key: concurrent callers with the same key
+    await the result (or exception) of the first call instead of starting their own.
+    Cancelling one waiter does not cancel the shared call.
+    """
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(func())
+        _inflight[key] = task
+
+        def _done(t, key=key):
+            if _inflight.get(key) is t:
+                del _inflight[key]
+
+        task.add_done_callback(_done)
+    else:
+        logging.info("Coalesced with in-flight request %s", key)
+    return await asyncio.shield(task)
+
+
+def inflight_count():
+    return len(_inflight)
@@ -0,0 +1,227 @@
+import re
+from bisect import bisect_right
+from itertools import accumulate
+
+from utils.tghtml import TELEGRAM_MAX_LENGTH
+
+
+## Restricted Markdown the model is asked for (AI_OUTPUT_FORMAT=markdown):
+##   **bold**  *italic* / _italic_  __underline__  ~~strike~~  ||spoiler||  `code`  [text](url)
+##   ```lang ... ``` code blocks, "> " quotes, "# " headings (rendered bold), "- " / "* " list items.
+## Anything else is plain text: unmatched markers are kept as is, nothing can be "unparseable".
+
+_INLINE_RE = re.compile(r"\\[\\`*_~|\[\]()#>+\-.!]|`|\*\*|__|~~|\|\||\*|_|\[")
+_LINK_RE = re.compile(r"\[([^\]\n]+)\]\(([^)\s]+)\)")
+_HEADING_RE = re.compile(r"#{1,6}\s+")
+_LIST_RE = re.compile(r"(\s*)[-*+]\s+")
+_BR_RE = re.compile(r"(\n?)((?:<br\s*/?>)+)(\n?)", re.IGNORECASE)
+_PAIRED = {"**": "bold", "__": "underline", "~~": "strikethrough", "||": "spoiler", "*": "italic", "_": "italic"}
+## Entities a part is never cut inside of (if they fit into one part)
+_ATOMIC = {"pre", "code", "text_link"}
+
+
+class _Renderer:
+    """
+    Builds plain text and entities. Offsets are in code points while rendering,
+    converted to UTF-16 units (what Telegram expects) per part.
+    """
+
+    def __init__(self):
+        self.out = []
+        self.length = 0
+        self.entities = []
+
+    def text(self, s):
+        if s:
+            self.out.append(s)
+            self.length += len(s)
+
+    def entity(self, kind, start, **extra):
+        if self.length > start:
+            self.entities.append({"type": kind, "offset": start, "length": self.length - start, **extra})
+
+    def inline(self, s):
+        i = 0
+        while i < len(s):
+            m = _INLINE_RE.search(s, i)
+            if not m:
+                self.text(s[i:])
+                return
+            self.text(s[i:m.start()])
+            marker = m.group(0)
+            i = m.end()
+            if marker[0] == "\\":
+                self.text(marker[1])
+                continue
+            if marker == "`":
+                end = s.find("`", i)
+                if end > i:
+                    start = self.length
+                    self.text(s[i:end])
+                    self.entity("code", start)
+                    i = end + 1
+                else:
+                    self.text(marker)
+                continue
+            if marker == "[":
+                link = _LINK_RE.match(s, m.start())
+                if link:
+                    start = self.length
+                    self.inline(link.group(1))
+                    self.entity("text_link", start, url=link.group(2))
+                    i = link.end()
+                else:
+                    self.text(marker)
+                continue
+            end = self._closing(s, marker, i)
+            if end is None:
+                self.text(marker)
+                continue
+            start = self.length
+            self.inline(s[i:end])
+            self.entity(_PAIRED[marker], start)
+            i = end + len(marker)
+
+    @staticmethod
+    def _closing(s, marker, i):
+        """Position of the closing marker or None. Markers must hug the text: "**x**", not "** x **"."""
+        if i >= len(s) or s[i].isspace():
+            return None
+        if len(marker) == 1 and i >= 2 and s[i - 2].isalnum():
+            ## snake_case word or 2*3, not italic
+            return None
+        end = s.find(marker, i)
+        while end != -1:
+            after = end + len(marker)
+            ok = not s[end - 1].isspace()
+            if len(marker) == 1 and s[after:after + 1] == marker:
+                ## "*" is a part of "**"
+                ok = False
+            if marker == "_" and s[after:after + 1].isalnum():
+                ok = False
+            if ok:
+                return end
+            end = s.find(marker, end + len(marker))
+        return None
+
+    def render(self, md):
+        md = _BR_RE.sub(lambda m: (m.group(1) + m.group(3)) or "\n", md)
+        lines = md.split("\n")
+        pre_start = pre_lang = None
+        quote_start = None
+        for n, line in enumerate(lines):
+            stripped = line.strip()
+            ## Fence lines are not shown, the block starts after the newline of its first line
+            if stripped.startswith("```"):
+                if pre_start is None:
+                    pre_start, pre_lang = self.length + 1, stripped[3:].strip()
+                else:
+                    self.entity("pre", pre_start, **({"language": pre_lang} if pre_lang else {}))
+                    pre_start = None
+                continue
+            if n:
+                self.text("\n")
+            if pre_start is not None:
+                self.text(line)
+                continue
+            if line.startswith(">"):
+                if quote_start is None:
+                    quote_start = self.length
+                self.inline(line[1:].lstrip())
+                continue
+            if quote_start is not None:
+                self._close_quote(quote_start)
+                quote_start = None
+            heading = _HEADING_RE.match(line)
+            if heading:
+                start = self.length
+                self.inline(line[heading.end():])
+                self.entity("bold", start)
+                continue
+            item = _LIST_RE.match(line)
+            if item:
+                self.text(f"{item.group(1)}• ")
+                line = line[item.end():]
+            self.inline(line)
+        if pre_start is not None:
+            self.entity("pre", pre_start, **({"language": pre_lang} if pre_lang else {}))
+        if quote_start is not None:
+            self._close_quote(quote_start)
+        return "".join(self.out), sorted(self.entities, key=lambda e: e["offset"])
+
+    def _close_quote(self, start):
+        ## Quote ends before the newline that separates it from the next line
+        length = self.length - 1 if self.out and self.out[-1] == "\n" else self.length
+        if length > start:
+            self.entities.append({"type": "blockquote", "offset": start, "length": length - start})
+
+
+def _utf16_prefix(text):
+    """utf16 offset of every code point position, or None if text has no astral chars (offsets are equal)."""
+    if all(ord(ch) <= 0xFFFF for ch in text):
+        return None
+    return [0] + list(accumulate(2 if ord(ch) > 0xFFFF else 1 for ch in text))
+
+
+def _part(text, entities, start, end, prefix):
+    """Text [start:end) with entities clipped to it, offsets converted to part-relative UTF-16."""
+    def u16(pos):
+        return prefix[pos] if prefix else pos
+
+    part_entities = []
+    for e in entities:
+        e_start, e_end = e["offset"], e["offset"] + e["length"]
+        if e_start >= end:
+            break
+        lo, hi = max(e_start, start), min(e_end, end)
+        if hi > lo:
+            part_entities.append({**e, "offset": u16(lo) - u16(start), "length": u16(hi) - u16(lo)})
+    return text[start:end], part_entities
+
+
+def render_markdown(md):
+    """Render restricted Markdown to (plain_text, entities); entity offsets are in UTF-16 units."""
+    text, entities = _Renderer().render(md or "")
+    return _part(text, entities, 0, len(text), _utf16_prefix(text))
+
+
+def render_markdown_parts(md, max_length=TELEGRAM_MAX_LENGTH):
+    """
+    Render restricted Markdown and split it into messages of at most `max_length` UTF-16 units.
+    Returns list of (text, entities). Parts are cut at line ends (whitespace if a line is too long),
+    never inside code / pre / link entities that fit into one message; other entities are clipped to parts.
+    """
+    text, entities = _Renderer().render(md or "")
+    prefix = _utf16_prefix(text)
+    atomic = [(e["offset"], e["offset"] + e["length"]) for e in entities if e["type"] in _ATOMIC]
+
+    def size(a, b):
+        return prefix[b] - prefix[a] if prefix else b - a
+
+    parts = []
+    start = 0
+    while start < len(text):
+        ## Skip blank lines / spaces at the beginning of a part
+        while start < len(text) and text[start].isspace():
+            start += 1
+        if start >= len(text):
+            break
+        if size(start, len(text)) <= max_length:
+            end = len(text)
+        else:
+            limit = (bisect_right(prefix, prefix[start] + max_length) - 1) if prefix else start + max_length
+            end = text.rfind("\n", start, limit) + 1
+            if end <= start:
+                cut = max(text.rfind(" ", start, limit), text.rfind("\t", start, limit))
+                end = cut + 1 if cut > start else limit
+            for a, b in atomic:
+                if a < end < b and a > start:
+                    ## Don't cut code / link in half - move whole entity to the next part
+                    end = a
+                    break
+        part_end = end
+        while part_end > start and text[part_end - 1].isspace():
+            part_end -= 1
+        parts.append(_part(text, entities, start, part_end, prefix))
+        start = end
+    return parts
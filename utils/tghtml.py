@@ -0,0 +1,235 @@
+import html
+import re
+
+
+## Tags Telegram-HTML understands; everything else is stripped (inner text is kept)
+TELEGRAM_TAGS = {
+    "b", "strong", "i", "em", "u", "ins", "s", "strike", "del",
+    "span", "tg-spoiler", "a", "code", "pre", "blockquote", "tg-emoji"
+}
+
+## Telegram limit for message text: 4096 UTF-16 code units of the parsed (visible) text
+TELEGRAM_MAX_LENGTH = 4096
+
+## Tag or HTML entity; text between matches is plain text
+_TOKEN_RE = re.compile(
+    r"<(/?)([a-zA-Z][a-zA-Z0-9-]*)([^<>]*)>"
+    r"|&(#[0-9]+|#[xX][0-9a-fA-F]+|[a-zA-Z][a-zA-Z0-9]*);"
+)
+## Newline right after a run of <br> tags
+_BR_THEN_NEWLINE_RE = re.compile(r"(?:<br\s*/?>)*\n", re.IGNORECASE)
+## Named entities Telegram accepts; numeric ones are all accepted
+_TELEGRAM_ENTITIES = {"lt", "gt", "amp", "quot"}
+## Any tag left in processed text (stray "<" are escaped by then)
+_TAG_RE = re.compile(r"<[^<>]*>")
+## Preferred cut points inside one long line: sentence end, then any whitespace
+_SENTENCE_END_RE = re.compile(r"[.!?…][\s)\]»\"']*\s")
+_WHITESPACE_RE = re.compile(r"\s")
+
+
+def utf16_len(text):
+    """Length of text in UTF-16 code units, as Telegram counts it."""
+    return len(text.encode("utf-16-le")) // 2
+
+
+def _entity_len(entity):
+    if entity[0] == "#":
+        try:
+            code = int(entity[2:], 16) if entity[1] in "xX" else int(entity[1:])
+        except ValueError:
+            return 1
+        return 2 if code > 0xFFFF else 1
+    return 1
+
+
+def _tokens(text):
+    """
+    Single pass over raw HTML. Yields (kind, value, visible_length):
+    ("text", escaped_text, n), ("open", (tag, raw_tag), 0), ("close", tag, 0).
+    <br> becomes a newline unless it stands next to a real newline (then it's dropped),
+    unsupported tags are dropped, stray "<", ">", "&" are escaped.
+    """
+    pos = 0
+    ## Last emitted visible char was a newline (or nothing was emitted yet)
+    at_newline = True
+    for m in _TOKEN_RE.finditer(text):
+        if m.start() > pos:
+            chunk = text[pos:m.start()]
+            yield "text", html.escape(chunk, quote=False), utf16_len(chunk)
+            at_newline = chunk.endswith("\n")
+        pos = m.end()
+        entity = m.group(4)
+        if entity is not None:
+            if entity[0] == "#" or entity in _TELEGRAM_ENTITIES:
+                yield "text", m.group(0), _entity_len(entity)
+            else:
+                ## Other named entities are decoded (unknown ones stay as escaped text)
+                chunk = html.unescape(m.group(0))
+                yield "text", html.escape(chunk, quote=False), utf16_len(chunk)
+            at_newline = False
+            continue
+        closing, tag = m.group(1), m.group(2).lower()
+        if tag == "br":
+            if not at_newline and not _BR_THEN_NEWLINE_RE.match(text, pos):
+                yield "text", "\n", 1
+                at_newline = True
+            continue
+        if tag not in TELEGRAM_TAGS:
+            continue
+        if closing:
+            yield "close", tag, 0
+        else:
+            yield "open", (tag, m.group(0)), 0
+    if pos < len(text):
+        chunk = text[pos:]
+        yield "text", html.escape(chunk, quote=False), utf16_len(chunk)
+
+
+def _lines(value, size):
+    """Split escaped text token at newlines (kept at line ends): yields (piece, visible_length)."""
+    if "\n" not in value:
+        yield value, size
+        return
+    pieces = value.split("\n")
+    for i, piece in enumerate(pieces):
+        if i < len(pieces) - 1:
+            piece += "\n"
+        elif not piece:
+            return
+        yield piece, _visible(piece)
+
+
+def _visible(piece):
+    """Visible UTF-16 length of an escaped text piece (entities count as their characters)."""
+    total = 0
+    pos = 0
+    for m in _TOKEN_RE.finditer(piece):
+        total += utf16_len(piece[pos:m.start()]) + _entity_len(m.group(4) or "")
+        pos = m.end()
+    return total + utf16_len(piece[pos:])
+
+
+def _cut_line(piece, room):
+    """
+    Longest head of escaped text `piece` that fits into `room` visible units, cut at sentence end or
+    whitespace if possible and never inside an entity. Returns (head, tail).
+    """
+    end = 0
+    size = 0
+    limit = 0
+    pos = 0
+    while pos < len(piece):
+        if piece[pos] == "&":
+            semi = piece.find(";", pos)
+            step = semi + 1 if semi != -1 else pos + 1
+            n = _visible(piece[pos:step])
+        else:
+            step = pos + 1
+            n = 2 if ord(piece[pos]) > 0xFFFF else 1
+        if size + n > room:
+            break
+        size += n
+        pos = step
+        limit = pos
+    head = piece[:limit]
+    for regex in (_SENTENCE_END_RE, _WHITESPACE_RE):
+        last = None
+        for last in regex.finditer(head):
+            pass
+        if last is not None and last.end() > 0:
+            end = last.end()
+            break
+    if not end:
+        end = limit
+    return piece[:end], piece[end:]
+
+
+def telegram_html_parts(text, max_length=TELEGRAM_MAX_LENGTH):
+    """
+    Turn LLM HTML into Telegram-HTML message parts in one pass: <br> normalization, unsupported tags
+    stripping, escaping of stray "<" and "&", splitting by visible UTF-16 length.
+    Open tags are tracked by a real stack: a part ends with closing tags for all open ones and the
+    next part reopens them (with their attributes). Parts are cut at line ends when possible,
+    otherwise at sentence end / whitespace of the overflowing line.
+    `max_length=None` - no splitting (sanitize only).
+    """
+    if not text:
+        return []
+    parts = []
+    out = []
+    size = 0
+    stack = []
+    ## Last line end in the current part: (index in `out`, visible size, copy of stack)
+    last_break = None
+
+    def close_tags(tags):
+        return "".join(f"</{tag}>" for tag, _ in reversed(tags))
+
+    def reopen_tags(tags):
+        return [raw for _, raw in tags]
+
+    def emit(head, tags):
+        part = ("".join(head) + close_tags(tags)).strip()
+        if _TAG_RE.sub("", part).strip():
+            parts.append(part)
+
+    for kind, value, n in _tokens(text):
+        if kind == "open":
+            stack.append(value)
+            out.append(value[1])
+            continue
+        if kind == "close":
+            ## Close everything opened after the matching tag; stray closing tags are dropped
+            for i in range(len(stack) - 1, -1, -1):
+                if stack[i][0] == value:
+                    out.append(close_tags(stack[i:]))
+                    del stack[i:]
+                    break
+            continue
+        for piece, n in _lines(value, n):
+            if max_length is not None:
+                while size + n > max_length:
+                    if last_break is not None:
+                        ## Cut after the last complete line of this part
+                        idx, at_size, tags = last_break
+                        emit(out[:idx], tags)
+                        out = reopen_tags(tags) + out[idx:]
+                        size -= at_size
+                        last_break = None
+                        continue
+                    head, piece = _cut_line(piece, max_length - size)
+                    if not head and not size:
+                        ## Not even one char fits - can't happen with sane max_length
+                        head, piece = piece, ""
+                    out.append(head)
+                    emit(out, stack)
+                    out = reopen_tags(stack)
+                    size = 0
+                    piece = piece.lstrip()
+                    n = _visible(piece)
+                if not size:
+                    ## New part does not start with blank lines
+                    piece = piece.lstrip()
+                    n = _visible(piece)
+                    if not piece:
+                        continue
+            out.append(piece)
+            size += n
+            if piece.endswith("\n"):
+                last_break = (len(out), size, list(stack))
+    emit(out, stack)
+    return parts
+
+
+def sanitize_telegram_html(text):
+    """Telegram-safe HTML of the whole text (no splitting)."""
+    parts = telegram_html_parts(text, max_length=None)
+    return parts[0] if parts else ""
+
+
+def telegram_text_parts(text, max_length=TELEGRAM_MAX_LENGTH):
+    """
+    Split plain text (sent without parse mode, where every char counts) by UTF-16 length,
+    with the same cut points as telegram_html_parts().
+    """
+    return [html.unescape(part) for part in telegram_html_parts(html.escape(text, quote=False), max_length)]
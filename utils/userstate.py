@@ -1,15 +1,219 @@
-## User-state: user_id -> dict
-## Store current method, direction, level and language for separate user.
-user_state = {}
+import asyncio
+import json
+import logging
+from collections import OrderedDict
+
+from aiogram import BaseMiddleware
+
+from config import USER_STATE_CACHE_SIZE, USER_STATE_FLUSH_INTERVAL
+from db.userstates import load_user_state, save_user_states
+from utils.metrics import register_metrics
+
+
+## Marker of a key that is not set (state.get() returns default for it)
+_MISSING = object()
+
+## Known state keys: current method, direction, level and language, plus payment flow flags
+FIELDS = ("method", "direction", "level", "lang", "currency", "await_amount", "amount", "koreshoks", "invoice_amount_cents")
+_FIELDS = frozenset(FIELDS)
+DEFAULTS = {
+    "method": "korneslov",
+    "direction": "masoret",
+    "level": "hard",
+    "lang": "ru",
+    "currency": "UAH",
+}
+
+
+class UserState:
+    """
+    Compact state record of one user with dict-like API (get, [], pop, update, in, dict(state)).
+    Reads are attribute lookups - no allocations on the hot path (router filters call it on every message).
+    Any change marks the user dirty for write-behind to `user_states`.
+    """
+    __slots__ = ("user_id", "_extra") + FIELDS
+
+    def __init__(self, user_id, data=None):
+        self.user_id = user_id
+        self._extra = None
+        for key in FIELDS:
+            setattr(self, key, DEFAULTS.get(key, _MISSING))
+        if data:
+            for key, value in data.items():
+                self._set(key, value)
+
+    def _set(self, key, value):
+        if key in _FIELDS:
+            setattr(self, key, value)
+        else:
+            ## Rare keys not known in advance
+            if self._extra is None:
+                self._extra = {}
+            if value is _MISSING:
+                self._extra.pop(key, None)
+            else:
+                self._extra[key] = value
+
+    def get(self, key, default=None):
+        if key in _FIELDS:
+            value = getattr(self, key)
+        elif self._extra is not None:
+            value = self._extra.get(key, _MISSING)
+        else:
+            value = _MISSING
+        return default if value is _MISSING else value
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._set(key, value)
+        _dirty.add(self.user_id)
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def pop(self, key, default=None):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            return default
+        self[key] = _MISSING
+        return value
+
+    def update(self, data):
+        for key, value in data.items():
+            self[key] = value
+
+    def keys(self):
+        keys = [key for key in FIELDS if getattr(self, key) is not _MISSING]
+        if self._extra:
+            keys += list(self._extra)
+        return keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def __repr__(self):
+        return f"UserState({self.user_id}, {self.to_dict()!r})"
+
+
+## In-process LRU of user states: user_id -> UserState
+_cache = OrderedDict()
+## Users with changes not yet written to DB
+_dirty = set()
+## Dirty states pushed out of LRU - kept until flushed
+_evicted = {}
+
+
+def _put(state):
+    _cache[state.user_id] = state
+    while len(_cache) > USER_STATE_CACHE_SIZE:
+        user_id, old = _cache.popitem(last=False)
+        if user_id in _dirty:
+            _evicted[user_id] = old
+
 
 def get_user_state(user_id):
-    default = {
-        "method": "korneslov",
-        "direction": "masoret",
-        "level": "hard",
-        "lang": "ru",
-        "currency": "UAH"
-    }
-    if user_id not in user_state:
-        user_state[user_id] = default.copy()
-    return user_state[user_id]
+    """
+    O(1) sync access to user's state. Normally preloaded from DB by UserStateMiddleware;
+    unknown user gets defaults.
+    """
+    state = _cache.get(user_id)
+    if state is not None:
+        _cache.move_to_end(user_id)
+        return state
+    state = _evicted.pop(user_id, None) or UserState(user_id)
+    _put(state)
+    return state
+
+
+async def preload_user_state(user_id, force=False):
+    """
+    Load user's state from DB into cache if it's not there (or always with `force`, when
+    other processes may have changed it). Local unsaved changes are never overwritten.
+    """
+    if user_id in _dirty or (not force and (user_id in _cache or user_id in _evicted)):
+        return get_user_state(user_id)
+    try:
+        data = await load_user_state(user_id)
+    except Exception:
+        logging.exception("Failed to load state of user %s", user_id)
+        return get_user_state(user_id)
+    if user_id in _dirty:
+        ## Changed while we were loading
+        return get_user_state(user_id)
+    state = UserState(user_id, data)
+    _put(state)
+    return state
+
+
+async def flush_user_states():
+    """
+    Write all dirty states to DB with one multi-row upsert. Returns number of written states.
+    """
+    if not _dirty:
+        return 0
+    user_ids = list(_dirty)
+    _dirty.clear()
+    rows = []
+    for user_id in user_ids:
+        state = _cache.get(user_id) or _evicted.get(user_id)
+        if state is not None:
+            rows.append((user_id, json.dumps(state.to_dict(), ensure_ascii=False, default=str)))
+    try:
+        await save_user_states(rows)
+    except Exception:
+        logging.exception("Failed to save %s user states", len(rows))
+        _dirty.update(user_ids)
+        return 0
+    for user_id in user_ids:
+        if user_id not in _dirty:
+            _evicted.pop(user_id, None)
+    return len(rows)
+
+
+async def flush_user_states_periodically(interval=USER_STATE_FLUSH_INTERVAL):
+    """
+    Background task: write-behind of changed user states.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        await flush_user_states()
+
+
+def user_states_stats():
+    return {"cached": len(_cache), "dirty": len(_dirty), "evicted_unsaved": len(_evicted)}
+
+
+register_metrics("user_states", user_states_stats)
+
+
+class UserStateMiddleware(BaseMiddleware):
+    """
+    Outer update middleware: preloads user's state from `user_states` before router filters run.
+    In `shared` mode (several worker processes) the state is reloaded on every update and
+    written through right after the handler, so all processes see the same state.
+    """
+
+    def __init__(self, shared=False):
+        self.shared = shared
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+        await preload_user_state(user.id, force=self.shared)
+        try:
+            return await handler(event, data)
+        finally:
+            if self.shared and user.id in _dirty:
+                await flush_user_states()
@@ -1,81 +1,51 @@
-import re
-import json
-from db.books import find_book_by_name_or_synonym, increment_book_hits
-
-
-
-## Dummy for Statistika button
-def get_statistics_text(state, id) -> str:
-    return f"Statistics:\n______________\nCurrent user_id: <code>{id}</code>\n<b>Current state:</b>\n<code>{json.dumps(state, ensure_ascii=False)}</code>"
-
-
-
-## Improved heuristics - tracks allowed pair tags, count all tags using dict. In case of unclosed tag force set close tag at the end of part, and force set open tag at the beginning of the next part. No errors were observed.
-def split_message(text, max_length=4000):
-    ## Only paired tags and allowed for telegram API
-    TELEGRAM_PAIR_TAGS = {
-        "b", "strong", "i", "em", "u", "ins", "s", "strike", "del",
-        "span", "a", "code", "pre"
-    }
-
-    def get_tag_counts(s):
-        ## Count every tags
-        tags = re.findall(r'<(/?)(\w+)[^>]*?>', s)
-        counts = dict.fromkeys(TELEGRAM_PAIR_TAGS, 0)
-        for slash, tag in tags:
-            tag = tag.lower()
-            if tag not in TELEGRAM_PAIR_TAGS:
-                continue
-            if not slash:
-                counts[tag] += 1
-            else:
-                counts[tag] -= 1
-        return counts
-
-    parts = []
-    while len(text) > max_length:
-        ## Search for closest \n or <br> before limit
-        split_pos = text.rfind('<br>', 0, max_length)
-        if split_pos == -1:
-            split_pos = text.rfind('\n', 0, max_length)
-        if split_pos == -1:
-            split_pos = text.rfind('.', 0, max_length)
-        if split_pos == -1:
-            split_pos = max_length
-        else:
-            split_pos += 4 if text[split_pos:split_pos+4] == '<br>' else 1
-
-        part = text[:split_pos].strip()
-        counts = get_tag_counts(part)
-        ## Force close unclosed tag
-        for tag, count in counts.items():
-            if count % 2 == 1:
-                part += f'</{tag}>'
-        parts.append(part)
-        text = text[split_pos:].lstrip()
-        ## Force set open tag at beginning of next part
-        for tag, count in counts.items():
-            if count % 2 == 1:
-                text = f'<{tag}>' + text
-    if text:
-        parts.append(text)
-    return parts
-
-
-def is_truncated(answer: str, min_length=3500, ending_punct=('.','…','!','?', '>')):
-    """
-    Heuristics: if response length is close to max_tokens * 4 (about 3000 tokens = 4000–4500 symbols), ans response doesnt end on any sentence ending sign then the response is probably cutted.
-    """
-    answer = answer.strip()
-    ## Dirty hack - to permit false repeates and unneeded followups
-    ##if re.search(tr("utils_py.is_truncated_regexp"), answer):
-    ##Swithed to more universal marker
-    if re.search("<b>\u200b\u200b\u200b\u200b</b>", answer):
-        return False
-
-    long_enough = len(answer) >= min_length
-    truncated = long_enough and not answer.endswith(ending_punct)
-    return truncated
+from db.books import find_book_by_name_or_synonym, increment_book_hits, get_book_by_id
+from db.stats import delay_percentile
+from i18n.messages import tr
+from utils.tghtml import telegram_html_parts, TELEGRAM_MAX_LENGTH
+from utils.continuation import is_truncated
+
+
+
+def _stats_block(title, stats, lang, top=5):
+    lines = [tr(f"statistics.{title}", lang=lang)]
+    if not stats["requests"]:
+        return lines + [tr("statistics.empty", lang=lang)]
+    lines.append(tr(
+        "statistics.requests", requests=stats["requests"], ok=stats["ok"],
+        ok_rate=round(100 * stats["ok"] / stats["requests"]), lang=lang
+    ))
+    if stats["delay_n"]:
+        p50, p95 = delay_percentile(stats, 0.5), delay_percentile(stats, 0.95)
+        lines.append(tr("statistics.delay", p50=f"{p50:.1f}", p95=f"{p95:.1f}", lang=lang))
+    lines.append(tr("statistics.credits", credits=stats["credits"], lang=lang))
+    levels = []
+    for level, n in sorted(stats["levels"].items(), key=lambda item: -item[1]):
+        name = tr(f"masoret_menu.{level}", lang=lang)
+        levels.append(f"{tr('statistics.unknown', lang=lang) if name == 'PUSTO' else name} - {n}")
+    lines.append(tr("statistics.levels", levels=", ".join(levels), lang=lang))
+    books = []
+    for book_id, n in sorted(stats["books"].items(), key=lambda item: -item[1])[:top]:
+        book = get_book_by_id(int(book_id))
+        name = book.get("bookname_en" if lang == "en" else "bookname_ru") if book else tr("statistics.unknown", lang=lang)
+        books.append(f"{name} - {n}")
+    if books:
+        lines.append(tr("statistics.books", books=", ".join(books), lang=lang))
+    return lines
+
+
+## Statistics button: user's and whole bot's rollups, see db/stats.py
+def get_statistics_text(user_stats, global_stats, lang="ru") -> str:
+    lines = _stats_block("user_title", user_stats, lang)
+    lines += [""] + _stats_block("global_title", global_stats, lang)
+    lines += ["", tr("statistics.footer", lang=lang)]
+    return "\n".join(lines)
+
+
+
+## Single pass over HTML with a real tag stack, see utils.tghtml: unclosed tags are closed at the end of part
+## and reopened at the beginning of the next one, length is counted in visible UTF-16 units as Telegram does.
+def split_message(text, max_length=TELEGRAM_MAX_LENGTH):
+    return telegram_html_parts(text, max_length)
 
 
 def _normalize_book(book):
@@ -131,7 +101,7 @@ async def parse_references(text, lang="ru", hits=False):
     if not verses:
         return []
 
-    ## Check book in the `books` table
+    ## Check book in the books catalog (in-memory, no DB round-trip)
     book_entry = await find_book_by_name_or_synonym(book)
     if not book_entry:
         return []
@@ -142,11 +112,7 @@ async def parse_references(text, lang="ru", hits=False):
         return []
 
     ## Is verses are correct??
-    max_verses_str = book_entry.get('max_verses')
-    try:
-        max_verses = eval(max_verses_str)
-    except Exception:
-        return []
+    max_verses = book_entry.get('max_verses')
     if chapter > len(max_verses):
         return []
     max_verse = max_verses[chapter - 1]
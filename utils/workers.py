@@ -0,0 +1,18 @@
+from config import BOT_MODE, WEBHOOK_WORKERS
+
+
+## Processes serving updates: WEBHOOK_WORKERS in webhook mode, one with polling
+WORKER_PROCESSES = max(1, WEBHOOK_WORKERS) if BOT_MODE == "webhook" else 1
+
+
+def per_process(limit, minimum=1):
+    """
+    Share of a bot-wide `limit` for one worker process, so that all processes together stay within it
+    (but not below `minimum`). Non-positive limits (unlimited / unbounded) are returned as is.
+    """
+    if limit <= 0 or WORKER_PROCESSES == 1:
+        return limit
+    share = limit / WORKER_PROCESSES
+    if isinstance(limit, int):
+        share = int(share)
+    return max(minimum, share)